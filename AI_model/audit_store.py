@@ -0,0 +1,307 @@
+import argparse
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from pathlib import Path
+
+# ==============================================================================
+# KHO SỰ KIỆN AUDIT (SQLITE, CÓ INDEX)
+# ==============================================================================
+# Mỗi ảnh audit được ghi thành 1 dòng: nguồn (camera), thời điểm, vi phạm hay
+# không, đường dẫn ảnh và toàn bộ box (toạ độ, confidence, nhãn, track id).
+# - record(): chỉ đưa vào hàng đợi, thread riêng insert theo batch (executemany
+#   trong 1 transaction) -> không chặn luồng video
+# - query(): lọc theo nguồn / khoảng thời gian / vi phạm qua index (source, ts)
+# - prune(): xoá ảnh + dòng cũ hơn thời hạn lưu trữ cùng lúc; start_retention()
+#   chạy định kỳ trên thread nền
+# Không còn phải liệt kê và parse tên file trong 2_Detect_Helmet / 3_Detect_No_Helmet.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    id         INTEGER PRIMARY KEY,
+    ts         REAL    NOT NULL,
+    source     TEXT    NOT NULL,
+    violation  INTEGER NOT NULL,
+    image_path TEXT    NOT NULL,
+    frame      INTEGER,
+    n_boxes    INTEGER NOT NULL,
+    boxes      TEXT    NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_events_source_ts ON events (source, ts);
+CREATE INDEX IF NOT EXISTS idx_events_ts ON events (ts);
+CREATE INDEX IF NOT EXISTS idx_events_violation_ts ON events (violation, ts);
+"""
+
+
+def parse_time(value):
+    """Epoch (số) hoặc ISO 8601 ('2026-01-04T14:00') -> epoch giây. None giữ nguyên."""
+    if value is None or value == "":
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+
+def _connect(db_path):
+    conn = sqlite3.connect(str(db_path), timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")     # đọc không chặn ghi
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+class AuditStore:
+    def __init__(self, db_path="audit_events.db", batch_size=100, flush_interval_s=1.0, max_pending=10000):
+        self.db_path = Path(db_path)
+        self.batch_size = batch_size
+        self.flush_interval_s = flush_interval_s
+        self.max_pending = max_pending
+
+        self.recorded = 0
+        self.inserted = 0
+        self.dropped = 0
+        self.errors = 0
+        self.pruned_rows = 0
+        self.pruned_files = 0
+
+        conn = _connect(self.db_path)
+        conn.executescript(SCHEMA)
+        conn.close()
+
+        self._pending = deque()
+        self._busy = False
+        self._cond = threading.Condition()
+        self._running = True
+        self._retention_stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="audit-store", daemon=True)
+        self._thread.start()
+
+    # ---------------------------------------------------------------- ghi
+    def record(self, image_path, violation, source, ts=None, frame=None, boxes=()):
+        """Đưa 1 sự kiện vào hàng đợi insert. boxes: list dict (xyxy, conf, label, ...)."""
+        row = (ts if ts is not None else time.time(), str(source), int(bool(violation)),
+               # Đường dẫn tuyệt đối: prune() chạy từ thư mục khác vẫn tìm được file
+               str(Path(image_path).resolve()), frame, len(boxes), json.dumps(list(boxes), ensure_ascii=False))
+        with self._cond:
+            self.recorded += 1
+            if len(self._pending) >= self.max_pending:
+                self._pending.popleft()
+                self.dropped += 1
+            self._pending.append(row)
+            if len(self._pending) >= self.batch_size:
+                self._cond.notify()
+
+    def _run(self):
+        conn = _connect(self.db_path)
+        try:
+            while True:
+                with self._cond:
+                    if self._running and len(self._pending) < self.batch_size:
+                        self._cond.wait(self.flush_interval_s)
+                    rows = list(self._pending)
+                    self._pending.clear()
+                    self._busy = bool(rows)
+                    running = self._running
+                if rows:
+                    try:
+                        with conn:
+                            conn.executemany(
+                                "INSERT INTO events (ts, source, violation, image_path, frame, n_boxes, boxes)"
+                                " VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+                        self.inserted += len(rows)
+                    except sqlite3.Error as e:
+                        self.errors += 1
+                        print(f"   ❌ Lỗi ghi audit DB: {e}")
+                    with self._cond:
+                        self._busy = False
+                        self._cond.notify_all()
+                if not running:
+                    return
+        finally:
+            conn.close()
+
+    def flush(self, timeout=5.0):
+        """Chờ mọi sự kiện đang chờ được insert (dùng trước khi query ngay sau khi ghi)."""
+        with self._cond:
+            self._cond.notify_all()
+            return self._cond.wait_for(lambda: not self._pending and not self._busy, timeout)
+
+    # ---------------------------------------------------------------- đọc
+    @staticmethod
+    def _where(source, start, end, violation):
+        where, params = [], []
+        if source is not None:
+            where.append("source = ?")
+            params.append(str(source))
+        start, end = parse_time(start), parse_time(end)
+        if start is not None:
+            where.append("ts >= ?")
+            params.append(start)
+        if end is not None:
+            where.append("ts < ?")
+            params.append(end)
+        if violation is not None:
+            where.append("violation = ?")
+            params.append(int(bool(violation)))
+        return (" WHERE " + " AND ".join(where) if where else ""), params
+
+    def _fetch(self, sql, params):
+        conn = _connect(self.db_path)
+        try:
+            return conn.execute(sql, params).fetchall()
+        finally:
+            conn.close()
+
+    def query(self, source=None, start=None, end=None, violation=None, limit=100, offset=0):
+        """Sự kiện mới nhất trước; start/end nhận epoch hoặc ISO 8601."""
+        where, params = self._where(source, start, end, violation)
+        rows = self._fetch("SELECT id, ts, source, violation, image_path, frame, n_boxes, boxes FROM events"
+                           + where + " ORDER BY ts DESC LIMIT ? OFFSET ?", params + [int(limit), int(offset)])
+        return [{
+            "id": r[0],
+            "ts": r[1],
+            "time": datetime.fromtimestamp(r[1]).isoformat(timespec="seconds"),
+            "source": r[2],
+            "violation": bool(r[3]),
+            "image_path": r[4],
+            "frame": r[5],
+            "n_boxes": r[6],
+            "boxes": json.loads(r[7]),
+        } for r in rows]
+
+    def query_params(self, params):
+        """query() từ query string của HTTP (source, start, end, violation=0/1, limit, offset)."""
+        violation = params.get("violation")
+        return self.query(
+            source=params.get("source") or None,
+            start=params.get("start"),
+            end=params.get("end"),
+            violation=None if violation in (None, "") else violation in ("1", "true"),
+            limit=min(int(params.get("limit", 100)), 1000),
+            offset=int(params.get("offset", 0)),
+        )
+
+    def count(self, source=None, start=None, end=None, violation=None):
+        where, params = self._where(source, start, end, violation)
+        return self._fetch("SELECT COUNT(*) FROM events" + where, params)[0][0]
+
+    # ---------------------------------------------------------------- lưu trữ
+    def prune(self, older_than_s, batch=1000, vacuum=False):
+        """Xoá ảnh + dòng có ts cũ hơn older_than_s giây. Trả về (số dòng, số file) đã xoá."""
+        cutoff = time.time() - older_than_s
+        rows_deleted = files_deleted = 0
+        conn = _connect(self.db_path)
+        last_id = 0
+        try:
+            while True:
+                # Đi theo id: dòng giữ lại (file lỗi) không bị SELECT lại trong lần chạy này
+                rows = conn.execute("SELECT id, image_path FROM events WHERE ts < ? AND id > ? ORDER BY id LIMIT ?",
+                                    (cutoff, last_id, batch)).fetchall()
+                if not rows:
+                    break
+                last_id = rows[-1][0]
+                # Xoá file trước: bị dừng giữa chừng thì chỉ còn dòng trỏ tới file không tồn tại,
+                # lần prune sau sẽ xoá tiếp (không bao giờ còn file mồ côi không có dòng).
+                # File không xoá được (quyền, đĩa lỗi...) -> giữ dòng để lần sau thử lại.
+                done = []
+                for event_id, image_path in rows:
+                    try:
+                        os.remove(image_path)
+                        files_deleted += 1
+                    except FileNotFoundError:
+                        pass
+                    except OSError as e:
+                        print(f"   ⚠️ Không xoá được {image_path}: {e}")
+                        continue
+                    done.append((event_id,))
+                with conn:
+                    conn.executemany("DELETE FROM events WHERE id = ?", done)
+                rows_deleted += len(done)
+            if vacuum and rows_deleted:
+                conn.execute("VACUUM")
+        finally:
+            conn.close()
+        self.pruned_rows += rows_deleted
+        self.pruned_files += files_deleted
+        if rows_deleted:
+            print(f"🧹 Audit retention: xoá {rows_deleted} sự kiện, {files_deleted} ảnh")
+        return rows_deleted, files_deleted
+
+    def start_retention(self, retention_days, interval_s=3600, vacuum=True):
+        """Thread nền chạy prune() mỗi interval_s giây."""
+        def loop():
+            while not self._retention_stop.is_set():
+                try:
+                    self.prune(retention_days * 86400, vacuum=vacuum)
+                except Exception as e:
+                    print(f"   ❌ Lỗi audit retention: {e}")
+                self._retention_stop.wait(interval_s)
+
+        t = threading.Thread(target=loop, name="audit-retention", daemon=True)
+        t.start()
+        return t
+
+    def stats(self):
+        with self._cond:
+            pending = len(self._pending)
+        return {
+            "db": str(self.db_path),
+            "pending": pending,
+            "recorded": self.recorded,
+            "inserted": self.inserted,
+            "dropped": self.dropped,
+            "errors": self.errors,
+            "pruned_rows": self.pruned_rows,
+            "pruned_files": self.pruned_files,
+        }
+
+    def close(self):
+        """Insert nốt các sự kiện còn trong hàng đợi rồi dừng."""
+        self._retention_stop.set()
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        self._thread.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Truy vấn / dọn kho sự kiện audit")
+    parser.add_argument("--db", default=os.getenv("AUDIT_DB", "audit_events.db"))
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    q = sub.add_parser("query", help="Liệt kê sự kiện")
+    q.add_argument("--source", default=None, help="Nguồn, vd. camera-0")
+    q.add_argument("--start", default=None, help="Epoch hoặc ISO, vd. 2026-01-04T14:00")
+    q.add_argument("--end", default=None)
+    q.add_argument("--violation", action="store_true", help="Chỉ sự kiện vi phạm")
+    q.add_argument("--limit", type=int, default=50)
+
+    p = sub.add_parser("prune", help="Xoá ảnh + sự kiện cũ")
+    p.add_argument("--days", type=float, required=True)
+    p.add_argument("--vacuum", action="store_true")
+    args = parser.parse_args()
+
+    store = AuditStore(args.db)
+    try:
+        if args.cmd == "query":
+            events = store.query(args.source, args.start, args.end,
+                                 True if args.violation else None, args.limit)
+            for e in events:
+                icon = "❌" if e["violation"] else "✅"
+                print(f"{icon} {e['time']} | {e['source']} | {e['n_boxes']} box | {e['image_path']}")
+            print(f"\n{len(events)} sự kiện")
+        else:
+            rows, files = store.prune(args.days * 86400, vacuum=args.vacuum)
+            print(f"Đã xoá {rows} sự kiện, {files} ảnh")
+    finally:
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
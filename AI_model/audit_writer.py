@@ -0,0 +1,197 @@
+import os
+import threading
+import time
+from collections import deque
+
+import cv2
+
+from audit_store import AuditStore
+from metrics import observe_stage, register_collector
+
+# ==============================================================================
+# GHI ẢNH BẰNG CHỨNG (AUDIT) BẤT ĐỒNG BỘ
+# ==============================================================================
+# Hàng đợi có giới hạn + nhóm thread encode JPEG và ghi đĩa.
+# submit() không bao giờ block luồng video. Khi đĩa ghi không kịp và hàng đợi
+# đầy, bỏ bớt ảnh theo policy:
+# - "drop_oldest":     bỏ ảnh cũ nhất trong hàng đợi
+# - "drop_safe_first": ưu tiên bỏ ảnh AN TOÀN (giữ ảnh VI PHẠM lâu nhất có thể)
+# Có store (AuditStore): ảnh ghi xong thì metadata đi kèm (event) được ghi vào
+# kho sự kiện SQLite -> mỗi dòng luôn trỏ tới 1 ảnh đã có trên đĩa.
+
+POLICIES = ("drop_oldest", "drop_safe_first")
+
+
+class AuditWriter:
+    def __init__(self, max_queue=64, workers=2, jpeg_quality=90, policy="drop_safe_first", store=None):
+        if policy not in POLICIES:
+            raise ValueError(f"policy phải là một trong {POLICIES}")
+        self.max_queue = max_queue
+        self.jpeg_quality = jpeg_quality
+        self.policy = policy
+        self.store = store
+
+        self.submitted = 0
+        self.written = 0
+        self.dropped_violation = 0
+        self.dropped_safe = 0
+        self.errors = 0
+
+        self._queue = deque()
+        self._cond = threading.Condition()
+        self._running = True
+        self._threads = [
+            threading.Thread(target=self._run, name=f"audit-writer-{i}", daemon=True)
+            for i in range(workers)
+        ]
+        for t in self._threads:
+            t.start()
+
+    def submit(self, path, img, violation=False, event=None):
+        """
+        Đưa ảnh vào hàng đợi ghi. Trả về False nếu chính ảnh này bị bỏ.
+        event: dict source / ts / frame / boxes cho AuditStore.record().
+        """
+        item = (path, img, violation, event)
+        with self._cond:
+            self.submitted += 1
+            if len(self._queue) >= self.max_queue:
+                victim = self._pick_victim(item)
+                if victim is item:
+                    self._count_drop(item)
+                    return False
+                self._queue.remove(victim)
+                self._count_drop(victim)
+            self._queue.append(item)
+            self._cond.notify()
+        return True
+
+    def _pick_victim(self, new_item):
+        if self.policy == "drop_safe_first":
+            for queued in self._queue:
+                if not queued[2]:
+                    return queued
+            # Hàng đợi toàn ảnh vi phạm: ảnh mới là ảnh an toàn thì bỏ ảnh mới
+            if not new_item[2]:
+                return new_item
+        return self._queue[0]
+
+    def _count_drop(self, item):
+        if item[2]:
+            self.dropped_violation += 1
+        else:
+            self.dropped_safe += 1
+
+    def _run(self):
+        params = [int(cv2.IMWRITE_JPEG_QUALITY), int(self.jpeg_quality)]
+        while True:
+            with self._cond:
+                while not self._queue and self._running:
+                    self._cond.wait()
+                if not self._queue:
+                    return
+                path, img, violation, event = self._queue.popleft()
+
+            t0 = time.perf_counter()
+            try:
+                ok, buf = cv2.imencode(".jpg", img, params)
+                if not ok:
+                    raise RuntimeError("imencode thất bại")
+                # tofile() ghi được cả đường dẫn có tiếng Việt / khoảng trắng trên Windows
+                buf.tofile(str(path))
+                observe_stage("audit", "imwrite", time.perf_counter() - t0)
+                if self.store is not None and event is not None:
+                    self.store.record(path, violation, **event)
+                with self._cond:
+                    self.written += 1
+            except Exception as e:
+                with self._cond:
+                    self.errors += 1
+                print(f"   ❌ Lỗi lưu: {e}")
+
+    def stats(self):
+        with self._cond:
+            return {
+                "queued": len(self._queue),
+                "submitted": self.submitted,
+                "written": self.written,
+                "dropped_violation": self.dropped_violation,
+                "dropped_safe": self.dropped_safe,
+                "errors": self.errors,
+            }
+
+    def collect_metrics(self):
+        s = self.stats()
+        return [
+            ("helmet_audit_queue_depth", "gauge", "Số ảnh audit đang chờ ghi", [({}, s["queued"])]),
+            ("helmet_audit_written_total", "counter", "Số ảnh audit đã ghi", [({}, s["written"])]),
+            ("helmet_audit_dropped_total", "counter", "Số ảnh audit bị bỏ do hàng đợi đầy", [
+                ({"kind": "violation"}, s["dropped_violation"]),
+                ({"kind": "safe"}, s["dropped_safe"]),
+            ]),
+            ("helmet_audit_errors_total", "counter", "Số lần ghi ảnh audit lỗi", [({}, s["errors"])]),
+        ] + ([
+            ("helmet_audit_events_pending", "gauge", "Số sự kiện audit chờ insert vào DB",
+             [({}, self.store.stats()["pending"])]),
+            ("helmet_audit_events_inserted_total", "counter", "Số sự kiện audit đã insert vào DB",
+             [({}, self.store.inserted)]),
+            ("helmet_audit_events_pruned_total", "counter", "Số sự kiện audit bị xoá do hết hạn lưu trữ",
+             [({}, self.store.pruned_rows)]),
+        ] if self.store is not None else [])
+
+    def close(self, wait=True):
+        """Dừng nhận việc; wait=True thì ghi hết ảnh còn trong hàng đợi rồi mới trả về."""
+        with self._cond:
+            self._running = False
+            if not wait:
+                self._queue.clear()
+            self._cond.notify_all()
+        if wait:
+            for t in self._threads:
+                t.join()
+            if self.store is not None:
+                self.store.close()
+
+
+_default_writer = None
+_default_lock = threading.Lock()
+
+
+def get_audit_writer():
+    """AuditWriter dùng chung cho cả process (tạo khi cần lần đầu, cấu hình qua biến môi trường)."""
+    global _default_writer
+    with _default_lock:
+        if _default_writer is None:
+            # AUDIT_DB="" để tắt kho sự kiện
+            store = None
+            db_path = os.getenv("AUDIT_DB", "audit_events.db")
+            if db_path:
+                store = AuditStore(db_path)
+            _default_writer = AuditWriter(
+                max_queue=int(os.getenv("AUDIT_QUEUE_SIZE", "64")),
+                workers=int(os.getenv("AUDIT_WORKERS", "2")),
+                jpeg_quality=int(os.getenv("AUDIT_JPEG_QUALITY", "90")),
+                policy=os.getenv("AUDIT_DROP_POLICY", "drop_safe_first"),
+                store=store,
+            )
+            register_collector(_default_writer.collect_metrics)
+        return _default_writer
+
+
+_retention_thread = None
+
+
+def start_audit_retention():
+    """
+    Bật dọn dẹp định kỳ kho audit (AUDIT_RETENTION_DAYS, 0 = giữ mãi). Server gọi
+    1 lần lúc khởi động ở process chính; worker inference (chung DB) không gọi,
+    tránh N thread prune + VACUUM cùng lúc.
+    """
+    global _retention_thread
+    store = get_audit_writer().store
+    retention_days = float(os.getenv("AUDIT_RETENTION_DAYS", "30"))
+    with _default_lock:
+        if store is None or retention_days <= 0 or _retention_thread is not None:
+            return None
+        _retention_thread = store.start_retention(retention_days)
+        return _retention_thread
@@ -0,0 +1,208 @@
+import argparse
+import os
+import shutil
+import tempfile
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+from ultralytics import YOLO
+
+# ==============================================================================
+# BACKEND INFERENCE CHO MÁY CHỈ CÓ CPU
+# ==============================================================================
+# PyTorch eager là lựa chọn chậm nhất trên CPU. Module này export best.pt 1 lần
+# sang định dạng khác, cache file export ngay cạnh file weights (export lại khi
+# best.pt mới hơn) và load qua YOLO(...) nên predict() vẫn dùng y như cũ.
+#
+#   torch          : best.pt (mặc định, không export)
+#   onnx           : best.onnx                  (ONNX Runtime)
+#   onnx-int8      : best_int8.onnx             (ONNX Runtime, quantize động int8)
+#   openvino       : best_openvino_model/       (cần cài openvino)
+#   openvino-int8  : best_int8_openvino_model/  (openvino + dữ liệu calibration)
+#
+# Chọn backend qua biến môi trường INFER_BACKEND ở từng entry point.
+# openvino-int8 cần INT8_DATA = file data yaml của bộ ảnh mũ bảo hộ để calibration
+# (không có thì báo lỗi, không để ultralytics tải COCO qua mạng).
+#
+# Nhiều process cùng load (worker supervisor, worker uvicorn): export chạy dưới
+# file lock <artefact>.lock, vào thư mục tạm rồi os.replace sang tên thật ->
+# chỉ 1 process export, process khác không bao giờ đọc phải file ghi dở.
+
+BACKENDS = ("torch", "onnx", "onnx-int8", "openvino", "openvino-int8")
+
+
+def export_path(weights, backend):
+    weights = Path(weights)
+    if backend == "torch":
+        return weights
+    if backend == "onnx":
+        return weights.with_suffix(".onnx")
+    if backend == "onnx-int8":
+        return weights.with_name(f"{weights.stem}_int8.onnx")
+    if backend == "openvino":
+        return weights.with_name(f"{weights.stem}_openvino_model")
+    if backend == "openvino-int8":
+        return weights.with_name(f"{weights.stem}_int8_openvino_model")
+    raise ValueError(f"Backend không hỗ trợ: {backend} (chọn một trong {BACKENDS})")
+
+
+def _is_fresh(artefact, weights):
+    if not artefact.exists():
+        return False
+    weights = Path(weights)
+    return not weights.exists() or artefact.stat().st_mtime >= weights.stat().st_mtime
+
+
+def _quantize_onnx(src, dst):
+    try:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+    except ImportError as e:
+        raise ImportError("Backend onnx-int8 cần cài onnxruntime: pip install onnxruntime") from e
+    quantize_dynamic(str(src), str(dst), weight_type=QuantType.QUInt8)
+
+
+@contextmanager
+def _file_lock(path):
+    """Khoá độc quyền giữa các process (fcntl trên Linux / macOS, msvcrt trên Windows)."""
+    with open(path, "a+b") as f:
+        try:
+            import fcntl
+            fcntl.flock(f, fcntl.LOCK_EX)
+        except ImportError:
+            import msvcrt
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    # LK_LOCK chỉ thử lại 10 lần (~10s) rồi báo lỗi -> chờ tiếp
+                    continue
+        yield   # file đóng -> tự nhả khoá
+
+
+def _publish(src, dst):
+    """Đưa artefact từ thư mục tạm sang tên thật bằng os.replace (thư mục: xoá bản cũ trước)."""
+    if dst.is_dir():
+        shutil.rmtree(dst)
+    os.replace(src, dst)
+
+
+def _export(weights, backend, imgsz, int8_data, workdir):
+    """Export trong workdir (chứa bản copy weights), trả về đường dẫn artefact trong workdir."""
+    tmp_weights = workdir / weights.name
+    shutil.copy2(weights, tmp_weights)
+    if backend in ("onnx", "onnx-int8"):
+        onnx_path = export_path(weights, "onnx")
+        if not _is_fresh(onnx_path, weights):
+            YOLO(str(tmp_weights)).export(format="onnx", imgsz=imgsz, dynamic=True, simplify=True)
+            tmp_onnx = export_path(tmp_weights, "onnx")
+            if backend == "onnx":
+                return tmp_onnx
+            # onnx-int8 cần onnx gốc: giữ luôn cho backend onnx
+            _publish(tmp_onnx, onnx_path)
+        tmp_target = export_path(tmp_weights, backend)
+        _quantize_onnx(onnx_path, tmp_target)
+        return tmp_target
+
+    kwargs = {"format": "openvino", "imgsz": imgsz}
+    if backend == "openvino-int8":
+        kwargs["int8"] = True
+        kwargs["data"] = int8_data
+    YOLO(str(tmp_weights)).export(**kwargs)
+    return export_path(tmp_weights, backend)
+
+
+def ensure_exported(weights, backend, imgsz=640, int8_data=None):
+    """Export nếu chưa có (hoặc cũ hơn weights). Trả về đường dẫn artefact."""
+    weights = Path(weights)
+    target = export_path(weights, backend)
+    if backend == "torch" or _is_fresh(target, weights):
+        return target
+    if backend == "openvino-int8" and not int8_data:
+        raise ValueError("Backend openvino-int8 cần dữ liệu calibration: đặt INT8_DATA=<data.yaml> "
+                         "(bộ ảnh mũ bảo hộ, không dùng COCO mặc định tải qua mạng)")
+
+    with _file_lock(target.with_name(target.name + ".lock")):
+        # Process khác có thể vừa export xong trong lúc chờ khoá
+        if _is_fresh(target, weights):
+            return target
+        print(f"⏳ Đang export {weights.name} -> {target.name} ({backend})...")
+        t0 = time.perf_counter()
+        with tempfile.TemporaryDirectory(prefix=".export_", dir=weights.parent) as workdir:
+            _publish(_export(weights, backend, imgsz, int8_data, Path(workdir)), target)
+        print(f"✅ Export xong sau {time.perf_counter() - t0:.1f}s: {target}")
+    return target
+
+
+def load_model(weights, backend=None, imgsz=640, int8_data=None):
+    """
+    Load model theo backend (mặc định: biến môi trường INFER_BACKEND hoặc torch).
+    int8_data mặc định lấy từ biến môi trường INT8_DATA (openvino-int8).
+    """
+    backend = backend or os.getenv("INFER_BACKEND", "torch")
+    if backend not in BACKENDS:
+        raise ValueError(f"Backend không hỗ trợ: {backend} (chọn một trong {BACKENDS})")
+    path = ensure_exported(weights, backend, imgsz, int8_data or os.getenv("INT8_DATA"))
+    if backend == "torch":
+        return YOLO(str(path))
+    # Model export không lưu loại task trong tên file -> khai báo rõ
+    return YOLO(str(path), task="detect")
+
+
+def measure_latency(model, imgsz=640, runs=20, warmup=3):
+    """Đo latency predict (ms) trên ảnh giả kích thước imgsz x imgsz."""
+    img = np.random.randint(0, 255, (imgsz, imgsz, 3), dtype=np.uint8)
+    for _ in range(warmup):
+        model.predict(img, imgsz=imgsz, verbose=False)
+    times = []
+    for _ in range(runs):
+        t0 = time.perf_counter()
+        model.predict(img, imgsz=imgsz, verbose=False)
+        times.append((time.perf_counter() - t0) * 1000)
+    times = np.array(times)
+    return {
+        "mean_ms": round(float(times.mean()), 2),
+        "p50_ms": round(float(np.percentile(times, 50)), 2),
+        "p95_ms": round(float(np.percentile(times, 95)), 2),
+    }
+
+
+def benchmark_backends(weights, backends=BACKENDS, imgsz=640, runs=20, int8_data=None):
+    report = {}
+    for backend in backends:
+        try:
+            model = load_model(weights, backend, imgsz, int8_data)
+            report[backend] = measure_latency(model, imgsz, runs)
+        except Exception as e:
+            report[backend] = {"error": str(e)}
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export + đo latency các backend CPU")
+    parser.add_argument("weights", nargs="?", default="best.pt")
+    parser.add_argument("--backends", nargs="+", default=list(BACKENDS), choices=BACKENDS)
+    parser.add_argument("--imgsz", type=int, default=640)
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--int8-data", default=os.getenv("INT8_DATA"),
+                        help="File data yaml để calibration openvino-int8 (mặc định: INT8_DATA)")
+    args = parser.parse_args()
+
+    report = benchmark_backends(args.weights, args.backends, args.imgsz, args.runs, args.int8_data)
+    print(f"\n{'Backend':<15}{'mean':>10}{'p50':>10}{'p95':>10}")
+    for backend, r in report.items():
+        if "error" in r:
+            print(f"{backend:<15}❌ {r['error']}")
+        else:
+            print(f"{backend:<15}{r['mean_ms']:>8.1f}ms{r['p50_ms']:>8.1f}ms{r['p95_ms']:>8.1f}ms")
+    ok = {b: r for b, r in report.items() if "error" not in r}
+    if ok:
+        best = min(ok, key=lambda b: ok[b]["mean_ms"])
+        print(f"\n🚀 Nhanh nhất trên máy này: {best} -> đặt INFER_BACKEND={best}")
+
+
+if __name__ == "__main__":
+    main()
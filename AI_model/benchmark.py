@@ -0,0 +1,417 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+# ==============================================================================
+# BENCHMARK OFFLINE (CPU, KHÔNG CẦN MẠNG)
+# ==============================================================================
+# Đo latency p50 / p95 / p99 + throughput theo từng bước cho 3 luồng xử lý:
+#   detect       : POST /detect của frontend.py qua ASGI in-process (httpx), không mở cổng
+#   frame_path   : luồng frame của AIVideoTrack / CameraAITrack:
+#                  đọc frame -> HelmetFramePipeline.process -> VideoFrame
+#                  (nguồn: file video, thư mục ảnh, hoặc frame tổng hợp).
+#                  Có PyAV: frame vào là yuv420p như decoder, --yuv đo đường
+#                  YUV (yuv_frame.py) thay cho to_ndarray/from_ndarray bgr24,
+#                  vd. --source synthetic --size 1920x1080 [--yuv]
+#   folder_check : check_folder.run_check trên bản copy của thư mục ảnh mẫu
+# Kết quả lưu JSON (kèm commit git, backend, máy) để so sánh giữa các commit:
+#   python benchmark.py --model best.pt --out benchmarks/ketqua.json
+
+SAMPLE_DIRS = ("Z Pic test", "2_Detect_Helmet", "3_Detect_No_Helmet")
+IMAGE_EXTS = {".jpg", ".jpeg", ".png"}
+
+# Giống cấu hình test_camera.py
+CONF_VIOLATION = 0.4
+CONF_SAFE = 0.5
+IOU_THRESHOLD = 0.45
+KW_UNSAFE = ['no-helmet', 'head', 'face', 'person', 'no_helmet']
+KW_SAFE = ['helmet', 'hardhat', 'safety-cap']
+
+
+def summarize(samples_s):
+    """Thống kê latency (ms) của 1 list thời gian tính bằng giây."""
+    if not samples_s:
+        return {"count": 0}
+    ms = np.asarray(samples_s, dtype=np.float64) * 1000
+    return {
+        "count": int(ms.size),
+        "mean_ms": round(float(ms.mean()), 3),
+        "p50_ms": round(float(np.percentile(ms, 50)), 3),
+        "p95_ms": round(float(np.percentile(ms, 95)), 3),
+        "p99_ms": round(float(np.percentile(ms, 99)), 3),
+        "max_ms": round(float(ms.max()), 3),
+    }
+
+
+class StageTimer:
+    def __init__(self):
+        self.samples = {}
+
+    @contextmanager
+    def time(self, stage):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - t0)
+
+    def add(self, stage, seconds):
+        self.samples.setdefault(stage, []).append(seconds)
+
+    def summary(self):
+        return {stage: summarize(s) for stage, s in self.samples.items()}
+
+
+class _TimedModel:
+    """Bọc model để đo riêng thời gian predict bên trong pipeline."""
+
+    def __init__(self, model, timer, stage="infer"):
+        self._model = model
+        self._timer = timer
+        self._stage = stage
+
+    def predict(self, *args, **kwargs):
+        with self._timer.time(self._stage):
+            return self._model.predict(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._model, name)
+
+
+def list_images(folders, limit=None):
+    files = []
+    for folder in folders:
+        folder = Path(folder)
+        if folder.is_dir():
+            files.extend(sorted(p for p in folder.iterdir() if p.suffix.lower() in IMAGE_EXTS))
+    return files[:limit] if limit else files
+
+
+def iter_frames(source, count, size=(640, 480)):
+    """
+    Frame BGR cho luồng video/camera:
+    - file video: đọc tuần tự (lặp lại khi hết file)
+    - thư mục ảnh: đọc lần lượt các ảnh như các frame liên tiếp
+    - "synthetic": nền tĩnh + 1 khối chuyển động (không cần dữ liệu)
+    """
+    if source == "synthetic":
+        rng = np.random.default_rng(0)
+        background = rng.integers(0, 255, (size[1], size[0], 3), dtype=np.uint8)
+        for i in range(count):
+            frame = background.copy()
+            x = (i * 7) % (size[0] - 80)
+            cv2.rectangle(frame, (x, 150), (x + 80, 330), (40, 200, 220), -1)
+            yield frame
+        return
+
+    path = Path(source)
+    if path.is_dir():
+        files = list_images([path])
+        if not files:
+            raise FileNotFoundError(f"Không có ảnh trong {path}")
+        for i in range(count):
+            frame = cv2.imread(str(files[i % len(files)]))
+            if frame is not None:
+                yield frame
+        return
+
+    cap = cv2.VideoCapture(str(path))
+    if not cap.isOpened():
+        raise FileNotFoundError(f"Không mở được video {path}")
+    try:
+        produced = 0
+        while produced < count:
+            ok, frame = cap.read()
+            if not ok:
+                cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+                ok, frame = cap.read()
+                if not ok:
+                    break
+            produced += 1
+            yield frame
+    finally:
+        cap.release()
+
+# ==============================================================================
+# 1. /detect QUA ASGI IN-PROCESS
+# ==============================================================================
+async def _bench_detect_async(files, requests, concurrency, fmt):
+    import httpx
+    import frontend
+    from image_decode import decode_for_model
+
+    payloads = [(p.name, p.read_bytes()) for p in files]
+    timer = StageTimer()
+
+    # Decode riêng (không qua HTTP) để tách chi phí decode khỏi inference
+    for _, data in payloads:
+        with timer.time("decode"):
+            decode_for_model(data, frontend.DETECT_IMGSZ)
+
+    # Load + warm-up trước khi đo
+    await asyncio.get_running_loop().run_in_executor(None, frontend.get_model)
+
+    transport = httpx.ASGITransport(app=frontend.app)
+    sem = asyncio.Semaphore(concurrency)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        async def one(i):
+            name, data = payloads[i % len(payloads)]
+            async with sem:
+                t0 = time.perf_counter()
+                r = await client.post("/detect", params={"format": fmt},
+                                      files={"file": (name, data, "image/jpeg")})
+                timer.add("request", time.perf_counter() - t0)
+                r.raise_for_status()
+
+        t0 = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(requests)))
+        wall = time.perf_counter() - t0
+        server_stats = (await client.get("/detect/stats")).json()
+
+    await frontend.scheduler.stop()
+    return {
+        "requests": requests,
+        "concurrency": concurrency,
+        "format": fmt,
+        "throughput_rps": round(requests / wall, 2) if wall > 0 else None,
+        "stages": timer.summary(),
+        "server": server_stats,
+    }
+
+
+def bench_detect(files, requests, concurrency, fmt="json"):
+    return asyncio.run(_bench_detect_async(files, requests, concurrency, fmt))
+
+# ==============================================================================
+# 2. LUỒNG FRAME CỦA AIVideoTrack / CameraAITrack
+# ==============================================================================
+def bench_frame_path(model, source, frames, detect_every=1, motion_gate=False, yuv=False, size=(640, 480)):
+    from audit_writer import AuditWriter
+    from frame_pipeline import HelmetFramePipeline
+    from motion_gate import MotionGate
+    from yuv_frame import YuvFrame, YuvFramePool
+
+    try:
+        from av import VideoFrame
+    except ImportError:
+        VideoFrame = None
+    if yuv and VideoFrame is None:
+        raise SystemExit("--yuv cần PyAV (pip install av)")
+    pool = YuvFramePool() if yuv else None
+
+    timer = StageTimer()
+    workdir = Path(tempfile.mkdtemp(prefix="bench_frames_"))
+    writer = AuditWriter(policy="drop_oldest")
+    try:
+        path_helmet, path_no_helmet = workdir / "helmet", workdir / "no_helmet"
+        path_helmet.mkdir()
+        path_no_helmet.mkdir()
+        pipeline = HelmetFramePipeline(
+            _TimedModel(model, timer), CONF_VIOLATION, CONF_SAFE, IOU_THRESHOLD, KW_UNSAFE, KW_SAFE,
+            30, path_helmet, path_no_helmet, prefix="Bench", alert_tag="BENCH", audit_writer=writer,
+            detect_every=detect_every, motion_gate=MotionGate() if motion_gate else None,
+        )
+
+        # Warm-up (không tính)
+        model.predict(np.zeros((480, 640, 3), dtype=np.uint8), verbose=False)
+
+        it = iter_frames(source, frames, size)
+        t_start = time.perf_counter()
+        n = 0
+        while True:
+            t0 = time.perf_counter()
+            frame = next(it, None)
+            if frame is None:
+                break
+            timer.add("read", time.perf_counter() - t0)
+            if VideoFrame is not None:
+                # Giống decoder của PyAV: frame ra ở dạng yuv420p (không tính vào total)
+                t_sim = time.perf_counter()
+                frame = VideoFrame.from_ndarray(frame, format="bgr24").reformat(format="yuv420p")
+                t0 += time.perf_counter() - t_sim
+
+            img = frame
+            if pool is not None:
+                with timer.time("to_yuv"):
+                    img = pool.fill(frame)
+            if img is None or (VideoFrame is not None and img is frame):
+                # Không có --yuv, hoặc frame kích thước lẻ
+                with timer.time("to_ndarray"):
+                    img = frame.to_ndarray(format="bgr24")
+            with timer.time("process"):
+                out = pipeline.process(img)
+            if VideoFrame is not None:
+                with timer.time("to_video_frame"):
+                    if isinstance(out, YuvFrame):
+                        VideoFrame.from_ndarray(out.buf, format="yuv420p")
+                    else:
+                        VideoFrame.from_ndarray(out, format="bgr24")
+            timer.add("total", time.perf_counter() - t0)
+            n += 1
+        wall = time.perf_counter() - t_start
+    finally:
+        writer.close(wait=True)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        "source": str(source),
+        "frames": n,
+        "detect_every": detect_every,
+        "motion_gate": motion_gate,
+        "yuv": yuv,
+        "detector_runs": pipeline.detector_runs,
+        "throughput_fps": round(n / wall, 2) if wall > 0 else None,
+        "stages": timer.summary(),
+        "audit": writer.stats(),
+    }
+
+# ==============================================================================
+# 3. CHECK FOLDER (BATCH)
+# ==============================================================================
+def bench_folder_check(model_path, files, batch_size=16, workers=None):
+    from check_folder import run_check
+
+    workdir = Path(tempfile.mkdtemp(prefix="bench_check_"))
+    try:
+        check_dir = workdir / "1_Check"
+        check_dir.mkdir()
+        for p in files:
+            shutil.copy2(p, check_dir / p.name)
+
+        stage_times = {}
+        per_image = []
+        t_start = time.perf_counter()
+        t_first = None
+        t_prev = None
+        for _ in run_check(str(workdir), model_path, batch_size=batch_size, workers=workers,
+                           archive=False, stage_times=stage_times):
+            now = time.perf_counter()
+            if t_first is None:
+                t_first = now
+            else:
+                per_image.append(now - t_prev)
+            t_prev = now
+        wall = time.perf_counter() - t_start
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    n = len(per_image) + (1 if t_first is not None else 0)
+    steady = (t_prev - t_first) if n > 1 else 0.0
+    stages = {stage: summarize(s) for stage, s in stage_times.items()}
+    stages["per_image"] = summarize(per_image)
+    return {
+        "images": n,
+        "batch_size": batch_size,
+        "workers": workers,
+        "wall_s": round(wall, 3),
+        "first_result_s": round(t_first - t_start, 3) if t_first is not None else None,
+        "throughput_ips": round((n - 1) / steady, 2) if steady > 0 else None,
+        "stages": stages,
+    }
+
+# ==============================================================================
+# 4. CHẠY + LƯU KẾT QUẢ
+# ==============================================================================
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def environment(args):
+    return {
+        "commit": git_commit(),
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "backend": args.backend,
+        "model": str(args.model),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark offline các luồng detect (CPU)")
+    parser.add_argument("--model", default="best.pt")
+    parser.add_argument("--backend", default=os.getenv("INFER_BACKEND", "torch"))
+    parser.add_argument("--suites", nargs="+", default=["detect", "frame_path", "folder_check"],
+                        choices=["detect", "frame_path", "folder_check"])
+    parser.add_argument("--images", nargs="+", default=list(SAMPLE_DIRS),
+                        help="Thư mục ảnh mẫu dùng cho detect / folder_check")
+    parser.add_argument("--limit", type=int, default=None, help="Số ảnh mẫu tối đa")
+    parser.add_argument("--requests", type=int, default=200, help="Số request /detect")
+    parser.add_argument("--concurrency", type=int, default=8, help="Số request /detect đồng thời")
+    parser.add_argument("--format", default="json", choices=["json", "f32", "msgpack"])
+    parser.add_argument("--source", default="2_Detect_Helmet",
+                        help="Nguồn frame: file video, thư mục ảnh hoặc 'synthetic'")
+    parser.add_argument("--frames", type=int, default=300)
+    parser.add_argument("--detect-every", type=int, default=1)
+    parser.add_argument("--motion-gate", action="store_true")
+    parser.add_argument("--yuv", action="store_true", help="frame_path: đường frame yuv420p (yuv_frame.py)")
+    parser.add_argument("--size", default="640x480", help="frame_path: kích thước frame tổng hợp, vd. 1920x1080")
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--out", default=None, help="File JSON (mặc định: benchmarks/bench_<commit>_<time>.json)")
+    args = parser.parse_args()
+
+    model_path = Path(args.model)
+    if not model_path.exists():
+        raise SystemExit(f"Không tìm thấy model: {model_path.resolve()} (benchmark không tải model qua mạng)")
+    os.environ["INFER_BACKEND"] = args.backend
+
+    files = list_images(args.images, args.limit)
+    report = {"env": environment(args), "results": {}}
+
+    if "detect" in args.suites:
+        if not files:
+            raise SystemExit("Không có ảnh mẫu cho benchmark detect")
+        # Tắt cache kết quả để đo đúng decode + inference
+        os.environ["DETECT_MODEL"] = str(model_path)
+        os.environ["DETECT_CACHE_SIZE"] = "0"
+        print(f"⏱️ detect: {args.requests} request, {args.concurrency} đồng thời...")
+        report["results"]["detect"] = bench_detect(files, args.requests, args.concurrency, args.format)
+
+    if "frame_path" in args.suites:
+        from backends import load_model
+        print(f"⏱️ frame_path: {args.frames} frame từ {args.source}...")
+        report["results"]["frame_path"] = bench_frame_path(
+            load_model(model_path, args.backend), args.source, args.frames,
+            args.detect_every, args.motion_gate, args.yuv,
+            tuple(int(v) for v in args.size.lower().split("x")))
+
+    if "folder_check" in args.suites:
+        if not files:
+            raise SystemExit("Không có ảnh mẫu cho benchmark folder_check")
+        print(f"⏱️ folder_check: {len(files)} ảnh, batch {args.batch_size}...")
+        report["results"]["folder_check"] = bench_folder_check(
+            model_path, files, args.batch_size, args.workers)
+
+    out = Path(args.out) if args.out else Path("benchmarks") / (
+        f"bench_{report['env']['commit'] or 'nogit'}_{datetime.now():%Y%m%d_%H%M%S}.json")
+    out.parent.mkdir(parents=True, exist_ok=True)
+    out.write_text(json.dumps(report, indent=2, ensure_ascii=False), encoding="utf-8")
+
+    for suite, r in report["results"].items():
+        print(f"\n== {suite} ==")
+        for stage, s in r["stages"].items():
+            if s.get("count"):
+                print(f"  {stage:<16}p50 {s['p50_ms']:>9.2f}ms  p95 {s['p95_ms']:>9.2f}ms  p99 {s['p99_ms']:>9.2f}ms")
+    print(f"\n💾 Đã lưu kết quả: {out}")
+
+
+if __name__ == "__main__":
+    main()
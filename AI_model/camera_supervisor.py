@@ -0,0 +1,354 @@
+import json
+import multiprocessing as mp
+import os
+import threading
+import time
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from frame_ring import FrameRing
+
+# ==============================================================================
+# SUPERVISOR NHIỀU CAMERA: CAPTURE + INFERENCE TRÊN NHIỀU PROCESS
+# ==============================================================================
+# - Danh sách nguồn đọc từ file JSON (CAMERA_CONFIG): index thiết bị, RTSP, file local
+#     {"sources": [{"id": "cong-chinh", "source": "rtsp://..."},
+#                  {"id": "xuong-1", "source": 0},
+#                  {"id": "demo", "source": "test.mp4", "loop": true}]}
+#   "roi" (tuỳ chọn): vùng quan tâm của nguồn, cùng định dạng với ROI_CONFIG (roi.py)
+# - Mỗi nguồn 1 process capture (cv2.VideoCapture), không tranh GIL với nhau
+# - Pool process inference cỡ bằng số core: mỗi nguồn được gán cố định cho
+#   1 worker (nguồn i -> worker i % N) vì tracker / motion gate / bộ đếm frame
+#   là trạng thái riêng của từng nguồn. Worker load model 1 lần, chạy
+#   HelmetFramePipeline (detect + vẽ + audit) cho các nguồn của nó.
+# - Frame đã vẽ quay về process chính (latest()) cho track WebRTC; ảnh audit
+#   được ghi ngay trong worker (AuditWriter + kho sự kiện riêng của process đó).
+# - Frame đi giữa các process qua FrameRing (shared memory): capture ghi frame
+#   vào ring của nguồn, worker đọc view (không copy, không pickle), vẽ kết quả
+#   vào ring đầu ra, process chính copy frame mới nhất cho WebRTC.
+#   Ring ghi đè frame cũ nhất -> worker luôn lấy frame mới nhất, frame bị
+#   vượt qua được đếm là dropped.
+# - Thread giám sát khởi động lại process capture / worker bị chết (backoff
+#   tăng dần), các nguồn khác không bị ảnh hưởng.
+
+CAPTURE_SLOTS = 4
+RESULT_SLOTS = 3
+MAX_FRAME_SIZE = (720, 1280)   # (cao, rộng) mặc định của ô ring; frame lớn hơn bị thu nhỏ
+
+
+def load_sources(path):
+    """Đọc danh sách nguồn từ file JSON ({"sources": [...]} hoặc list)."""
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    items = data["sources"] if isinstance(data, dict) else data
+    sources = []
+    for i, item in enumerate(items):
+        if not isinstance(item, dict):
+            item = {"source": item}
+        src = item["source"]
+        # "0" trong JSON -> index thiết bị
+        if isinstance(src, str) and src.isdigit():
+            src = int(src)
+        sources.append({
+            "id": str(item.get("id", f"camera-{i}")),
+            "source": src,
+            "loop": bool(item.get("loop", True)),
+            # Kích thước tối đa của ô ring (RAM = cao x rộng x 3 x số ô x 2 ring)
+            "max_height": int(item.get("max_height", MAX_FRAME_SIZE[0])),
+            "max_width": int(item.get("max_width", MAX_FRAME_SIZE[1])),
+            # Vùng quan tâm (roi.py), dựng RegionSet trong worker; None = cả frame
+            "roi": item.get("roi"),
+        })
+    ids = [s["id"] for s in sources]
+    if len(set(ids)) != len(ids):
+        raise ValueError(f"Trùng id nguồn trong {path}: {ids}")
+    return sources
+
+
+def _capture_main(spec, ring, counters, stop):
+    """Process capture của 1 nguồn. Lỗi / mất kết nối -> thoát, supervisor mở lại."""
+    cv2.setNumThreads(1)
+    source = spec["source"]
+    is_file = isinstance(source, str) and Path(source).is_file()
+    cap = cv2.VideoCapture(source)
+    if not cap.isOpened():
+        raise RuntimeError(f"Không mở được nguồn {spec['id']}: {source}")
+    # File local: phát đúng FPS gốc thay vì đọc nhanh hết mức
+    interval = 1.0 / (cap.get(cv2.CAP_PROP_FPS) or 25.0) if is_file else 0.0
+    next_t = time.monotonic()
+    try:
+        while not stop.is_set():
+            ok, frame = cap.read()
+            if not ok:
+                if is_file and spec["loop"]:
+                    cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+                    continue
+                raise RuntimeError(f"Mất tín hiệu nguồn {spec['id']}")
+            if interval:
+                next_t += interval
+                delay = next_t - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    next_t = time.monotonic()
+            # 1 lần copy vào shared memory, không pickle / không qua pipe
+            ring.write(frame, time.time())
+            counters["captured"].value += 1
+    finally:
+        cap.release()
+
+
+def _inference_main(worker_id, assigned, model_cfg, pipeline_cfg, stop):
+    """
+    Process inference: load model 1 lần, mỗi nguồn được gán có 1 HelmetFramePipeline.
+    assigned: {source_id: (ring capture, ring kết quả, counters, cấu hình roi)}
+    """
+    # Chia core cho các worker, tránh mỗi worker mở thread bằng tổng số core
+    threads = max(1, (os.cpu_count() or 1) // model_cfg["workers"])
+    cv2.setNumThreads(threads)
+    try:
+        import torch
+        torch.set_num_threads(threads)
+    except ImportError:
+        pass
+
+    from audit_writer import get_audit_writer
+    from frame_pipeline import HelmetFramePipeline
+    from model_registry import get_model, registry
+    from motion_gate import MotionGate
+    from quality_controller import QualityController, default_levels
+    from roi import RegionSet
+
+    registry.register("default", model_cfg["weights"], backend=model_cfg["backend"],
+                      fallback=model_cfg.get("fallback"))
+    model = get_model()
+
+    cfg = dict(pipeline_cfg)
+    motion = cfg.pop("motion_gate", None)
+    prefix = cfg.pop("prefix", "Cam")
+    quality_fps = cfg.pop("quality_fps", 0)
+    pipelines = {
+        # Tên ảnh audit có id nguồn -> nhiều camera cùng giây không ghi đè nhau
+        sid: HelmetFramePipeline(model, **cfg, prefix=f"{prefix}_{sid}", source=sid,
+                                 copy_audit=True,   # frame nằm trong ring, sẽ bị ghi đè
+                                 motion_gate=MotionGate(*motion) if motion else None,
+                                 roi=RegionSet.from_config(job[3]) if job[3] else None)
+        for sid, job in assigned.items()
+    }
+    # Capture chạy ở process khác -> chỉ điều chỉnh imgsz + bước detect
+    controllers = {}
+    if quality_fps:
+        levels = default_levels(cfg.get("imgsz") or 640, cfg.get("detect_every", 1))
+        for sid, pipeline in pipelines.items():
+            def apply(settings, sid=sid, pipeline=pipeline):
+                pipeline.apply_quality(settings)
+                assigned[sid][2]["quality_level"].value = controllers[sid].level
+            controllers[sid] = QualityController(sid, quality_fps, levels, apply)
+    print(f"🧠 Worker {worker_id} (pid {os.getpid()}) xử lý: {', '.join(assigned)}")
+
+    last_seq = {sid: in_ring.last_seq() for sid, (in_ring, _, _, _) in assigned.items()}
+    while not stop.is_set():
+        idle = True
+        for sid, (in_ring, out_ring, counters, _) in assigned.items():
+            item = in_ring.latest(after=last_seq[sid])
+            if item is None:
+                continue
+            idle = False
+            seq, ts, view = item
+            if last_seq[sid]:
+                counters["dropped"].value += seq - last_seq[sid] - 1
+            last_seq[sid] = seq
+
+            # Copy thẳng từ ring capture sang ô của ring kết quả (cùng là shared
+            # memory), pipeline vẽ lên ô đó -> process chính đọc được ngay
+            out = out_ring.reserve(*view.shape[:2])
+            np.copyto(out, view)
+            if not in_ring.valid(seq):
+                # Capture đã quay vòng ghi đè trong lúc copy -> bỏ frame rách
+                counters["dropped"].value += 1
+                continue
+            t0 = time.perf_counter()
+            pipelines[sid].process(out)
+            out_ring.commit(ts)
+            if sid in controllers:
+                controllers[sid].observe(time.perf_counter() - t0)
+            counters["processed"].value += 1
+            counters["latency_ms"].value = (time.time() - ts) * 1000
+        if idle:
+            time.sleep(0.005)
+
+    # Ghi nốt ảnh audit còn trong hàng đợi trước khi thoát
+    get_audit_writer().close(wait=True)
+
+
+class _Managed:
+    """1 process được giám sát: tự khởi động lại với backoff khi bị chết."""
+
+    def __init__(self, name, target, args, ctx):
+        self.name = name
+        self.target = target
+        self.args = args
+        self.ctx = ctx
+        self.process = None
+        self.restarts = 0
+        self.failures = 0
+        self.next_start = 0.0
+        self.started_at = 0.0
+
+    def start(self):
+        self.process = self.ctx.Process(target=self.target, args=self.args, name=self.name, daemon=True)
+        self.process.start()
+        self.started_at = time.monotonic()
+
+    def check(self, now):
+        if self.process is not None and self.process.is_alive():
+            # Chạy ổn định > 60s thì reset backoff
+            if self.failures and now - self.started_at > 60:
+                self.failures = 0
+            return
+        if self.process is not None:
+            print(f"⚠️ {self.name} đã dừng (exit code {self.process.exitcode}), khởi động lại...")
+            self.process = None
+            self.failures += 1
+            self.next_start = now + min(30.0, 2.0 ** (self.failures - 1))
+        if now >= self.next_start:
+            self.restarts += 1
+            self.start()
+
+    def stop(self, timeout=5.0):
+        if self.process is not None:
+            self.process.join(timeout)
+            if self.process.is_alive():
+                self.process.terminate()
+            self.process = None
+
+
+class CameraSupervisor:
+    def __init__(self, sources, weights, backend=None, fallback=None, pipeline_cfg=None, workers=None):
+        self.ctx = mp.get_context("spawn")   # không fork process đang chạy thread / OpenMP
+        self.sources = sources
+        self.workers = max(1, min(workers or max(1, (os.cpu_count() or 2) - 1), len(sources)))
+        self.model_cfg = {"weights": str(weights), "backend": backend, "fallback": fallback,
+                          "workers": self.workers}
+        self.pipeline_cfg = pipeline_cfg or {}
+        self._stop = self.ctx.Event()
+
+        self._capture_ring, self._result_ring, self._counters = {}, {}, {}
+        for spec in sources:
+            sid = spec["id"]
+            size = (spec["max_height"], spec["max_width"])
+            self._capture_ring[sid] = FrameRing(CAPTURE_SLOTS, *size)
+            self._result_ring[sid] = FrameRing(RESULT_SLOTS, *size)
+            self._counters[sid] = {
+                name: self.ctx.Value(kind, 0, lock=False)
+                for name, kind in (("captured", "Q"), ("dropped", "Q"), ("processed", "Q"), ("latency_ms", "d"),
+                                   ("quality_level", "i"))
+            }
+
+        self._last_seen = {}   # source_id -> (seq, bản copy frame)
+        self._managed = []
+        self._threads = []
+        self._running = False
+
+    def _build(self):
+        for spec in self.sources:
+            sid = spec["id"]
+            self._managed.append(_Managed(f"capture-{sid}", _capture_main,
+                                          (spec, self._capture_ring[sid], self._counters[sid], self._stop),
+                                          self.ctx))
+        for w in range(self.workers):
+            assigned = {
+                spec["id"]: (self._capture_ring[spec["id"]], self._result_ring[spec["id"]],
+                              self._counters[spec["id"]], spec.get("roi"))
+                for i, spec in enumerate(self.sources) if i % self.workers == w
+            }
+            self._managed.append(_Managed(f"infer-{w}", _inference_main,
+                                          (w, assigned, self.model_cfg, self.pipeline_cfg, self._stop), self.ctx))
+
+    def start(self):
+        if self._running:
+            return
+        self._running = True
+        self._build()
+        for m in self._managed:
+            m.start()
+        t = threading.Thread(target=self._watch, name="supervisor-watch", daemon=True)
+        t.start()
+        self._threads.append(t)
+        print(f"🚀 Supervisor: {len(self.sources)} nguồn, {self.workers} worker inference")
+
+    def _watch(self):
+        while self._running:
+            now = time.monotonic()
+            for m in self._managed:
+                m.check(now)
+            time.sleep(1.0)
+
+    def latest(self, source_id):
+        """
+        Bản copy frame đã detect + vẽ mới nhất, None nếu chưa có. Ô của ring bị
+        worker ghi đè sau RESULT_SLOTS frame nên copy ra rồi kiểm tra valid(seq)
+        (như phía inference); mỗi seq chỉ copy 1 lần cho mọi người xem.
+        """
+        ring = self._result_ring.get(source_id)
+        if ring is None:
+            return None
+        last = self._last_seen.get(source_id)
+        item = ring.latest(after=last[0] if last else 0)
+        if item is not None:
+            seq, _, view = item
+            frame = view.copy()
+            if ring.valid(seq):
+                self._last_seen[source_id] = (seq, frame)
+                return frame
+        # Không có frame mới / worker đang ghi đè ô đó -> dùng lại frame trước
+        return last[1] if last else None
+
+    def source_ids(self):
+        return [s["id"] for s in self.sources]
+
+    def stats(self):
+        processes = {m.name: {"alive": m.process is not None and m.process.is_alive(),
+                              "restarts": m.restarts} for m in self._managed}
+        sources = {}
+        for sid, c in self._counters.items():
+            sources[sid] = {name: (round(v.value, 1) if name == "latency_ms" else v.value)
+                            for name, v in c.items()}
+        return {"workers": self.workers, "sources": sources, "processes": processes}
+
+    def collect_metrics(self):
+        captured, dropped, processed, latency, quality = [], [], [], [], []
+        for sid, c in self._counters.items():
+            labels = {"source": sid}
+            quality.append((labels, c["quality_level"].value))
+            captured.append((labels, c["captured"].value))
+            dropped.append((labels, c["dropped"].value))
+            processed.append((labels, c["processed"].value))
+            latency.append((labels, c["latency_ms"].value / 1000))
+        restarts = [({"process": m.name}, m.restarts) for m in self._managed]
+        return [
+            ("helmet_supervisor_frames_captured_total", "counter", "Frame capture theo nguồn", captured),
+            ("helmet_supervisor_frames_dropped_total", "counter",
+             "Frame bị bỏ vì inference chưa kịp lấy", dropped),
+            ("helmet_supervisor_frames_processed_total", "counter", "Frame đã inference theo nguồn", processed),
+            ("helmet_supervisor_latency_seconds", "gauge", "Capture -> xong inference của frame gần nhất", latency),
+            ("helmet_supervisor_restarts_total", "counter", "Số lần process được khởi động lại", restarts),
+            ("helmet_supervisor_quality_level", "gauge", "Mức chất lượng của nguồn (0 = đầy đủ)", quality),
+        ]
+
+    def stop(self):
+        if not self._running:
+            return
+        self._running = False
+        self._stop.set()
+        for m in self._managed:
+            m.stop()
+        for t in self._threads:
+            t.join(timeout=2)
+        self._managed.clear()
+        self._threads.clear()
+        self._last_seen.clear()
+        for ring in list(self._capture_ring.values()) + list(self._result_ring.values()):
+            ring.close()
@@ -0,0 +1,228 @@
+import argparse
+import json
+import os
+import shutil
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import cv2
+from ultralytics import YOLO
+
+from postprocess import build_category_lut, draw_detections, postprocess
+
+# ==============================================================================
+# 1. CẤU HÌNH
+# ==============================================================================
+# Bản dòng lệnh của notebook "AI Camera_Check Folder":
+#   1_Check -> detect -> 2_Detect_Helmet / 3_Detect_No_Helmet / 5_No Detect
+#   ảnh gốc -> 9_Archieve
+# - Decode ảnh song song trên nhiều process, đưa vào model theo batch cố định
+# - Dùng lại ảnh đã decode để vẽ (không cv2.imread lần 2)
+# - Kết quả chạy theo generator, chỉ giữ vài batch trong RAM
+# - Manifest (JSONL) ghi lại ảnh đã xử lý -> chạy lại sẽ tiếp tục chỗ bị dừng
+
+KEYWORDS_SAFE = ['helmet', 'hardhat', 'safety-cap']
+KEYWORDS_UNSAFE = ['no-helmet', 'head', 'face', 'person', 'no_helmet']
+
+CONF_VIOLATION = 0.1
+CONF_SAFE = 0.4
+IOU_THRESHOLD = 0.3
+IMAGE_EXTS = {".jpg", ".jpeg", ".png"}
+MANIFEST_NAME = "check_manifest.jsonl"
+
+
+def setup_system(base_path_str):
+    base_dir = Path(base_path_str)
+    paths = {
+        "check":      base_dir / "1_Check",
+        "helmet":     base_dir / "2_Detect_Helmet",
+        "no_helmet":  base_dir / "3_Detect_No_Helmet",
+        "no_detect":  base_dir / "5_No Detect",
+        "archive":    base_dir / "9_Archieve"
+    }
+    for p in paths.values():
+        p.mkdir(parents=True, exist_ok=True)
+    return base_dir, paths
+
+# ==============================================================================
+# 2. ĐỌC ẢNH SONG SONG
+# ==============================================================================
+def file_key(name, st):
+    """
+    Key của ảnh trong manifest: tên + kích thước + mtime. Camera đặt lại bộ đếm
+    (IMG_0001.jpg lần 2) -> ảnh mới trùng tên vẫn được xử lý.
+    """
+    return f"{name}|{st.st_size}|{st.st_mtime_ns}"
+
+
+def iter_image_files(folder, done):
+    """Duyệt thư mục kiểu streaming (os.scandir), bỏ qua ảnh đã có trong manifest."""
+    with os.scandir(folder) as it:
+        for entry in it:
+            if not entry.is_file():
+                continue
+            if os.path.splitext(entry.name)[1].lower() not in IMAGE_EXTS:
+                continue
+            if file_key(entry.name, entry.stat()) in done:
+                continue
+            yield Path(entry.path)
+
+
+def iter_batches(items, batch_size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def decode_batch(paths):
+    """Chạy trong process con: đọc 1 batch ảnh. Ảnh lỗi trả về None."""
+    return [(p, cv2.imread(str(p))) for p in paths]
+
+
+def iter_decoded_batches(files, batch_size, pool, prefetch=2):
+    """
+    Gửi tối đa `prefetch` batch cho pool decode trước, trả kết quả đúng thứ tự.
+    Không dùng pool.map trên cả danh sách để RAM không tăng theo số ảnh.
+    """
+    pending = deque()
+    for batch in iter_batches(files, batch_size):
+        pending.append(pool.submit(decode_batch, batch))
+        if len(pending) > prefetch:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+# ==============================================================================
+# 3. MANIFEST (CHẠY TIẾP KHI BỊ DỪNG)
+# ==============================================================================
+def load_manifest(path):
+    done = set()
+    if path.exists():
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    done.add(json.loads(line)["key"])
+                except (ValueError, KeyError):
+                    # Dòng cuối bị ghi dở khi process bị kill / dòng cũ chỉ có tên file -> bỏ qua
+                    continue
+    return done
+
+# ==============================================================================
+# 4. XỬ LÝ CHÍNH
+# ==============================================================================
+def _record(stage_times, stage, t0):
+    if stage_times is not None:
+        stage_times.setdefault(stage, []).append(time.perf_counter() - t0)
+
+
+def run_check(base_path_str, model_path=None, batch_size=16, workers=None,
+              archive=True, prefetch=2, stage_times=None):
+    """
+    Generator: yield kết quả từng ảnh (dict) ngay khi xử lý xong.
+    stage_times (dict): nếu có, ghi thời gian (s) từng bước decode_wait / predict
+    (mỗi batch), postprocess / write (mỗi ảnh) vào list theo tên bước.
+    """
+    base_dir, paths = setup_system(base_path_str)
+    model_path = Path(model_path) if model_path else base_dir / "best.pt"
+    if not model_path.exists():
+        raise FileNotFoundError(f"Không tìm thấy model tại {model_path}")
+
+    print(f"⏳ Đang tải model từ {model_path}...")
+    model = YOLO(str(model_path))
+    lut = build_category_lut(model.names, KEYWORDS_UNSAFE, KEYWORDS_SAFE)
+
+    manifest_path = base_dir / MANIFEST_NAME
+    done = load_manifest(manifest_path)
+    if done:
+        print(f"↩️ Manifest có {len(done)} ảnh đã xử lý, bỏ qua và chạy tiếp.")
+
+    files = iter_image_files(paths["check"], done)
+    with ProcessPoolExecutor(max_workers=workers) as pool, \
+            open(manifest_path, "a", encoding="utf-8") as manifest:
+        batches = iter_decoded_batches(files, batch_size, pool, prefetch)
+        while True:
+            t0 = time.perf_counter()
+            decoded = next(batches, None)
+            if decoded is None:
+                break
+            _record(stage_times, "decode_wait", t0)
+            ok = [(p, img) for p, img in decoded if img is not None]
+            for p, img in decoded:
+                if img is None:
+                    print(f"❌ Lỗi đọc file: {p.name}")
+
+            t0 = time.perf_counter()
+            results = model.predict([img for _, img in ok], conf=CONF_VIOLATION,
+                                    iou=IOU_THRESHOLD, verbose=False) if ok else []
+            _record(stage_times, "predict", t0)
+
+            for (origin_file, img), result in zip(ok, results):
+                t0 = time.perf_counter()
+                dets = postprocess(result, lut, CONF_VIOLATION, CONF_SAFE)
+                # Ảnh đã decode được dùng lại để vẽ
+                draw_detections(img, dets, labels=("NO-HELMET", "Helmet"),
+                                draw_safe_with_violation=False)
+
+                if dets.has_violation:
+                    target_folder, status = paths["no_helmet"], "violation"
+                elif dets.has_safe:
+                    target_folder, status = paths["helmet"], "safe"
+                else:
+                    target_folder, status = paths["no_detect"], "no_detect"
+
+                _record(stage_times, "postprocess", t0)
+
+                t0 = time.perf_counter()
+                filename = origin_file.name
+                # Lấy key trước khi ảnh gốc bị chuyển sang 9_Archieve
+                key = file_key(filename, origin_file.stat())
+                cv2.imwrite(str(target_folder / filename), img)
+                if archive:
+                    shutil.move(str(origin_file), str(paths["archive"] / filename))
+                _record(stage_times, "write", t0)
+
+                record = {"file": filename, "key": key, "status": status, "target": target_folder.name,
+                          "boxes": len(dets)}
+                manifest.write(json.dumps(record, ensure_ascii=False) + "\n")
+                yield record
+            # Flush theo batch: bị dừng giữa chừng thì chỉ mất tối đa 1 batch
+            manifest.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Kiểm tra mũ bảo hộ cho toàn bộ ảnh trong 1_Check")
+    parser.add_argument("base_dir", help="Thư mục gốc chứa 1_Check, best.pt ...")
+    parser.add_argument("--model", default=None, help="Đường dẫn model (mặc định: <base_dir>/best.pt)")
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--workers", type=int, default=None, help="Số process decode (mặc định: số core)")
+    parser.add_argument("--prefetch", type=int, default=2, help="Số batch decode trước")
+    parser.add_argument("--no-archive", action="store_true", help="Không chuyển ảnh gốc sang 9_Archieve")
+    args = parser.parse_args()
+
+    icons = {"violation": "❌ VI PHẠM", "safe": "✅ AN TOÀN", "no_detect": "⚪ KHÔNG DETECT"}
+    counts = {k: 0 for k in icons}
+    t0 = time.perf_counter()
+    n = 0
+    for record in run_check(args.base_dir, args.model, args.batch_size, args.workers,
+                            archive=not args.no_archive, prefetch=args.prefetch):
+        n += 1
+        counts[record["status"]] += 1
+        print(f"{icons[record['status']]} | {record['file']} -> {record['target']}")
+
+    elapsed = time.perf_counter() - t0
+    fps = n / elapsed if elapsed > 0 else 0.0
+    print(f"\n🎉 Hoàn tất {n} ảnh trong {elapsed:.1f}s ({fps:.1f} ảnh/s) | {counts}")
+
+
+if __name__ == "__main__":
+    main()
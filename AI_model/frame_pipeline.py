@@ -0,0 +1,205 @@
+import threading
+from datetime import datetime
+
+from audit_writer import get_audit_writer
+from image_decode import rescale_boxes
+from metrics import stage_timer
+from postprocess import build_category_lut, draw_detections, postprocess, postprocess_arrays
+from roi import predict_regions
+from tracking import IoUTracker, scene_change_score, small_gray
+from yuv_frame import YuvFrame, draw_frame
+
+# ==============================================================================
+# LOGIC AI DÙNG CHUNG CHO test_video.py / test_camera.py
+# ==============================================================================
+# Detect -> Vẽ khung -> Lưu ảnh bằng chứng (Audit).
+# Hàm process() là code CPU nặng, chỉ được gọi từ thread inference,
+# không gọi trực tiếp trong coroutine recv(). Ảnh audit được đẩy sang
+# AuditWriter (encode + ghi đĩa trên thread riêng) nên đĩa chậm không làm trễ video.
+#
+# detect_every > 1: chỉ chạy YOLO mỗi N frame (hoặc khi cảnh thay đổi mạnh hơn
+# scene_change_threshold), các frame giữa dùng IoUTracker dời box theo vận tốc.
+# Mỗi người có track ID, ảnh vi phạm lưu 1 lần khi track vi phạm mới xuất hiện.
+#
+# motion_gate (MotionGate): cảnh không đổi -> dùng lại kết quả cũ, không gọi model
+# (tracker giữ nguyên box, không dời theo vận tốc). Ảnh audit vẫn lưu theo save_interval trên kết quả cũ, để
+# người đứng yên vi phạm vẫn có ảnh bằng chứng định kỳ.
+#
+# img có thể là ndarray BGR hoặc YuvFrame (yuv_frame.py): model chạy trên ảnh
+# nhỏ model_input, motion gate / scene change dùng plane Y, khung vẽ lên plane YUV.
+#
+# process(img, draw=False): chỉ detect (+ audit), không vẽ lên img; kết quả lấy
+# qua last_detections (chế độ người xem tự vẽ overlay từ data channel).
+#
+# roi (RegionSet, roi.py): chỉ predict các crop quanh vùng giám sát, box ngoài
+# vùng bị bỏ trước khi phân loại / lưu audit.
+#
+# Thời gian từng bước (predict_wait, predict, postprocess, draw, audit_submit)
+# được ghi vào helmet_stage_seconds với nhãn pipeline=metrics_name (mặc định: prefix).
+
+# Predictor của ultralytics không an toàn khi nhiều thread gọi cùng 1 model
+# (nhiều camera / nguồn dùng chung model từ registry) -> gọi tuần tự.
+_predict_lock = threading.Lock()
+
+
+class HelmetFramePipeline:
+    def __init__(self, model, conf_violation, conf_safe, iou_threshold,
+                 kw_unsafe, kw_safe, save_interval, path_helmet, path_no_helmet,
+                 prefix="Log", alert_tag="ALERT", audit_writer=None,
+                 detect_every=1, scene_change_threshold=None, motion_gate=None, metrics_name=None,
+                 source=None, copy_audit=False, imgsz=None, roi=None):
+        self.model = model
+        self.conf_violation = conf_violation
+        self.conf_safe = conf_safe
+        self.iou_threshold = iou_threshold
+        self.kw_unsafe = kw_unsafe
+        self.kw_safe = kw_safe
+        self.save_interval = save_interval
+        self.path_helmet = path_helmet
+        self.path_no_helmet = path_no_helmet
+        self.prefix = prefix
+        self.alert_tag = alert_tag
+        self.metrics_name = metrics_name or prefix.lower()
+        # Tên nguồn ghi vào kho sự kiện audit (vd. camera-0, link video)
+        self.source = source or prefix
+        self.audit_writer = audit_writer or get_audit_writer()
+        # img nằm trong bộ nhớ bị ghi đè sau đó (vd. ô FrameRing) -> copy trước khi đẩy audit
+        self.copy_audit = copy_audit
+        # Kích thước ảnh vào model (None = mặc định của model), QualityController đổi lúc chạy
+        self.imgsz = imgsz
+        # Vùng quan tâm của nguồn (None = cả frame)
+        self.roi = roi
+        self.frame_cnt = 0
+        # Bảng tra class id -> SAFE / UNSAFE / IGNORE, tính 1 lần cho model
+        self.category_lut = build_category_lut(model.names, kw_unsafe, kw_safe)
+
+        self.scene_change_threshold = scene_change_threshold
+        self.tracker = None
+        self.set_detect_every(detect_every)
+        self.detector_runs = 0
+        # None: chưa detect lần nào -> frame đầu tiên của stream luôn chạy model
+        self._last_detect_frame = None
+        self._detect_small = None
+        self.motion_gate = motion_gate
+        self._last_dets = None
+
+    def set_detect_every(self, n):
+        """Đổi bước detect lúc chạy: > 1 thì dùng tracker, về 1 thì detect mọi frame như cũ."""
+        self.detect_every = max(1, int(n))
+        if self.detect_every > 1 and self.tracker is None:
+            self.tracker = IoUTracker()
+        elif self.detect_every == 1:
+            self.tracker = None
+
+    def apply_quality(self, settings):
+        """Áp mức chất lượng của QualityController (imgsz, detect_every)."""
+        self.imgsz = settings["imgsz"]
+        self.set_detect_every(settings["detect_every"])
+
+    def _detect(self, img):
+        scale = None
+        if isinstance(img, YuvFrame):
+            img, scale = img.model_input, img.scale
+        self.detector_runs += 1
+        with stage_timer(self.metrics_name, "predict_wait"):
+            _predict_lock.acquire()
+        try:
+            with stage_timer(self.metrics_name, "predict"):
+                kwargs = {"imgsz": self.imgsz} if self.imgsz else {}
+                if self.roi is not None:
+                    arrays = predict_regions(self.model, [(img, self.roi)], conf=self.conf_violation,
+                                             iou=self.iou_threshold, verbose=False, **kwargs)[0]
+                else:
+                    results = self.model.predict(img, conf=self.conf_violation, iou=self.iou_threshold,
+                                                 verbose=False, **kwargs)
+        finally:
+            _predict_lock.release()
+        with stage_timer(self.metrics_name, "postprocess"):
+            if self.roi is not None:
+                dets = postprocess_arrays(*arrays, self.category_lut, self.conf_violation, self.conf_safe)
+            else:
+                dets = postprocess(results[0], self.category_lut, self.conf_violation, self.conf_safe)
+            if scale is not None:
+                dets.xyxy = rescale_boxes(dets.xyxy, scale)
+            return dets
+
+    def _track(self, img):
+        """Trả về (Detections có track_ids, list ID vi phạm mới)."""
+        need_detect = (self._last_detect_frame is None
+                       or self.frame_cnt - self._last_detect_frame >= self.detect_every)
+        small = None
+        if self.scene_change_threshold is not None:
+            small = small_gray(img.y if isinstance(img, YuvFrame) else img)
+            if scene_change_score(self._detect_small, small) > self.scene_change_threshold:
+                need_detect = True
+
+        if not need_detect:
+            return self.tracker.step(), []
+        self._last_detect_frame = self.frame_cnt
+        self._detect_small = small
+        return self.tracker.update(self._detect(img))
+
+    def _save(self, img, violation, dets, drawn=True):
+        now = datetime.now()
+        img_name = f"{self.prefix}_{now:%Y%m%d_%H%M%S}_{self.frame_cnt}.jpg"
+        folder = self.path_no_helmet if violation else self.path_helmet
+        with stage_timer(self.metrics_name, "audit_submit"):
+            # Metadata (box, nhãn...) được ghi vào kho sự kiện sau khi ảnh ghi xong
+            event = {"source": self.source, "ts": now.timestamp(), "frame": self.frame_cnt,
+                     "boxes": dets.to_records(self.model.names)}
+            if isinstance(img, YuvFrame):
+                # Chỉ ảnh audit (lưu thưa) mới đổi cả frame sang BGR
+                img = img.to_bgr()
+                if not drawn:
+                    draw_detections(img, dets)
+            elif not drawn:
+                # Ảnh bằng chứng luôn có khung, kể cả khi người xem tự vẽ overlay
+                img = draw_detections(img.copy(), dets)
+            elif self.copy_audit:
+                img = img.copy()
+            self.audit_writer.submit(folder / img_name, img, violation=violation, event=event)
+        return img_name
+
+    @property
+    def last_detections(self):
+        """Detections của lần process() gần nhất (None nếu chưa có)."""
+        return self._last_dets
+
+    def process(self, img, draw=True):
+        """Chạy YOLO trên ảnh BGR / YuvFrame, vẽ khung lên chính ảnh đó (nếu draw) và trả về ảnh."""
+        self.frame_cnt += 1
+        new_violations = None
+        gated = (self.motion_gate is not None
+                 and not self.motion_gate.should_infer(img.y if isinstance(img, YuvFrame) else img))
+        if gated and self._last_dets is not None:
+            # Cảnh đứng yên: không gọi model, dùng lại kết quả lần trước. Tracker
+            # không step: box không trôi theo vận tốc cũ, lần update sau ghép IoU
+            # như thể các frame đứng yên không tồn tại (nhịp detect_every theo frame_cnt)
+            dets = self.tracker.current() if self.tracker is not None else self._last_dets
+        elif self.tracker is None:
+            dets = self._detect(img)
+        else:
+            dets, new_violations = self._track(img)
+        self._last_dets = dets
+        if draw:
+            with stage_timer(self.metrics_name, "draw"):
+                draw_frame(img, dets)
+        has_violation = dets.has_violation
+        has_safe = dets.has_safe
+
+        # img không bị sửa sau bước này nên không cần copy (trừ khi copy_audit)
+        if new_violations:
+            # Chế độ tracking: báo 1 lần cho mỗi track vi phạm
+            img_name = self._save(img, True, dets, drawn=draw)
+            ids = ", ".join(f"#{tid}" for tid in new_violations)
+            print(f"❌ [{self.alert_tag}] Vi phạm mới {ids} -> Lưu ảnh: {img_name}")
+        elif self.frame_cnt % self.save_interval == 0:
+            # new_violations is None: không tracking, hoặc frame bị motion gate bỏ qua
+            # (vi phạm đứng yên vẫn được lưu định kỳ)
+            if has_violation and new_violations is None:
+                img_name = self._save(img, True, dets, drawn=draw)
+                print(f"❌ [{self.alert_tag}] Lưu ảnh vi phạm: {img_name}")
+            elif has_safe and not has_violation:
+                self._save(img, False, dets, drawn=draw)
+
+        return img
@@ -0,0 +1,150 @@
+from multiprocessing import shared_memory
+
+import cv2
+import numpy as np
+
+# ==============================================================================
+# RING BUFFER FRAME TRÊN SHARED MEMORY (GIỮA CÁC PROCESS, KHÔNG PICKLE)
+# ==============================================================================
+# N ô frame cố định kích thước (max_height x max_width x 3, uint8) nằm trong 1
+# vùng multiprocessing.shared_memory. Mỗi ô có số thứ tự (seq) và timestamp.
+# - 1 producer: write() (copy/resize frame đã decode vào ô) hoặc reserve() ->
+#   ghi thẳng vào view -> commit(). Ô cũ nhất bị ghi đè, producer không bao giờ chờ.
+# - Consumer: latest() trả về (seq, ts, view NumPy trỏ thẳng vào shared memory),
+#   không copy. View dùng được tới khi producer quay vòng lại ô đó (N frame sau);
+#   valid(seq) cho biết ô còn giữ đúng frame đó không.
+# Giao thức theo kiểu seqlock: trong lúc ghi, seq của ô = -1; ghi xong mới đặt
+# seq thật rồi cập nhật bộ đếm chung, nên consumer không bao giờ lấy ô đang ghi dở.
+# Object FrameRing pickle được (chỉ gửi tên vùng nhớ), process con tự attach.
+
+_ALIGN = 64
+
+
+def _aligned(n):
+    return (n + _ALIGN - 1) // _ALIGN * _ALIGN
+
+
+def _attach(name):
+    # Python >= 3.13: process chỉ attach không đăng ký với resource_tracker.
+    # Bản cũ hơn: process con (spawn / forkserver) dùng chung tracker của process
+    # cha, đăng ký lại cùng tên là vô hại; không được unregister vì sẽ xoá luôn
+    # đăng ký của owner (owner unlink báo KeyError, bị kill thì /dev/shm rò rỉ).
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        return shared_memory.SharedMemory(name=name)
+
+
+class FrameRing:
+    def __init__(self, slots=4, max_height=720, max_width=1280, channels=3, name=None):
+        self.slots = int(slots)
+        self.frame_shape = (int(max_height), int(max_width), int(channels))
+        self._owner = name is None
+        self._layout()
+        if self._owner:
+            self.shm = shared_memory.SharedMemory(create=True, size=self._size)
+        else:
+            self.shm = _attach(name)
+        self._map()
+        if self._owner:
+            self._counter[0] = 0
+            self._slot_seq[:] = 0
+
+    def _layout(self):
+        n = self.slots
+        self._off_counter = 0
+        self._off_seq = _aligned(8)
+        self._off_ts = self._off_seq + _aligned(8 * n)
+        self._off_dims = self._off_ts + _aligned(8 * n)
+        self._off_frames = self._off_dims + _aligned(4 * 2 * n)
+        self._size = self._off_frames + n * int(np.prod(self.frame_shape))
+
+    def _map(self):
+        buf, n = self.shm.buf, self.slots
+        self._counter = np.ndarray((1,), np.int64, buf, self._off_counter)
+        self._slot_seq = np.ndarray((n,), np.int64, buf, self._off_seq)
+        self._slot_ts = np.ndarray((n,), np.float64, buf, self._off_ts)
+        self._slot_dims = np.ndarray((n, 2), np.int32, buf, self._off_dims)
+        self._frames = np.ndarray((n,) + self.frame_shape, np.uint8, buf, self._off_frames)
+        self._reserved = None
+
+    # Pickle: chỉ gửi tên + kích thước, bên nhận attach vào cùng vùng nhớ
+    def __getstate__(self):
+        return {"name": self.shm.name, "slots": self.slots, "frame_shape": self.frame_shape}
+
+    def __setstate__(self, state):
+        self.slots = state["slots"]
+        self.frame_shape = tuple(state["frame_shape"])
+        self._owner = False
+        self._layout()
+        self.shm = _attach(state["name"])
+        self._map()
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    # ---------------------------------------------------------------- producer
+    def reserve(self, height=None, width=None):
+        """View của ô kế tiếp (height x width, mặc định kích thước tối đa) để ghi trực tiếp."""
+        h = min(height or self.frame_shape[0], self.frame_shape[0])
+        w = min(width or self.frame_shape[1], self.frame_shape[1])
+        seq = int(self._counter[0]) + 1
+        i = seq % self.slots
+        self._slot_seq[i] = -1          # đang ghi: consumer bỏ qua ô này
+        self._slot_dims[i] = (h, w)
+        self._reserved = seq
+        return self._frames[i, :h, :w]
+
+    def commit(self, ts):
+        """Công bố ô vừa reserve(). Trả về seq của frame."""
+        seq = self._reserved
+        i = seq % self.slots
+        self._slot_ts[i] = ts
+        self._slot_seq[i] = seq
+        self._counter[0] = seq
+        self._reserved = None
+        return seq
+
+    def write(self, frame, ts):
+        """Copy frame vào ô kế tiếp (resize nếu lớn hơn kích thước tối đa). Trả về seq."""
+        h, w = frame.shape[:2]
+        max_h, max_w = self.frame_shape[:2]
+        if h <= max_h and w <= max_w:
+            np.copyto(self.reserve(h, w), frame)
+        else:
+            scale = min(max_h / h, max_w / w)
+            dst = self.reserve(int(h * scale), int(w * scale))
+            cv2.resize(frame, (dst.shape[1], dst.shape[0]), dst=dst, interpolation=cv2.INTER_AREA)
+        return self.commit(ts)
+
+    # ---------------------------------------------------------------- consumer
+    def last_seq(self):
+        return int(self._counter[0])
+
+    def latest(self, after=0):
+        """(seq, ts, view) của frame mới nhất có seq > after, hoặc None."""
+        seq = int(self._counter[0])
+        if seq <= after or seq == 0:
+            return None
+        i = seq % self.slots
+        ts = float(self._slot_ts[i])
+        h, w = (int(v) for v in self._slot_dims[i])
+        if int(self._slot_seq[i]) != seq:
+            # Producer đã quay vòng và đang ghi đè ô này
+            return None
+        return seq, ts, self._frames[i, :h, :w]
+
+    def valid(self, seq):
+        """View của frame seq còn nguyên vẹn (chưa bị producer ghi đè)?"""
+        return int(self._slot_seq[seq % self.slots]) == seq
+
+    def close(self):
+        self._counter = self._slot_seq = self._slot_ts = self._slot_dims = self._frames = None
+        try:
+            self.shm.close()
+        except BufferError:
+            # Còn view NumPy trỏ vào vùng nhớ: để GC đóng mapping, vẫn unlink tên
+            pass
+        if self._owner:
+            self.shm.unlink()
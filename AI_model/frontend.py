@@ -1,9 +1,47 @@
-from fastapi import FastAPI, UploadFile, File
+import asyncio
+import os
+import struct
+import time
+from fastapi import FastAPI, UploadFile, File, Header, HTTPException, Query, Response, WebSocket
 from fastapi.middleware.cors import CORSMiddleware # Thêm cái này
 from ultralytics import YOLOWorld
-import cv2
 import numpy as np
 
+try:
+    import msgpack  # Tuỳ chọn: response ?format=msgpack
+except ImportError:
+    msgpack = None
+
+import metrics
+from backends import load_model
+from image_decode import decode_for_model, rescale_boxes
+from inference_batcher import BatchScheduler
+from model_registry import registry, get_model
+from postprocess import boxes_to_numpy
+from result_cache import ResultCache, content_key, dhash_key
+from roi import load_roi_config, predict_regions, regions_for
+
+# Cấu hình micro-batching (có thể chỉnh qua biến môi trường)
+MAX_BATCH_SIZE = int(os.getenv("DETECT_MAX_BATCH_SIZE", "8"))
+MAX_WAIT_MS = float(os.getenv("DETECT_MAX_WAIT_MS", "10"))
+# Backend inference: torch (YOLOWorld gốc) / onnx / onnx-int8 / openvino / openvino-int8
+INFER_BACKEND = os.getenv("INFER_BACKEND", "torch")
+DETECT_MODEL = os.getenv("DETECT_MODEL", "best.pt")
+# Cache kết quả theo nội dung ảnh (DETECT_CACHE_SIZE=0 để tắt)
+# DETECT_CACHE_MODE: exact (hash bytes upload) / phash (thêm hash cảm nhận cho ảnh gần giống)
+CACHE_SIZE = int(os.getenv("DETECT_CACHE_SIZE", "1024"))
+CACHE_MAX_MB = float(os.getenv("DETECT_CACHE_MAX_MB", "32"))
+CACHE_TTL_S = float(os.getenv("DETECT_CACHE_TTL_S", "5"))
+CACHE_MODE = os.getenv("DETECT_CACHE_MODE", "exact")
+# WebSocket /ws/detect: số frame của 1 client được xử lý đồng thời (pipeline)
+WS_MAX_IN_FLIGHT = int(os.getenv("WS_MAX_IN_FLIGHT", "3"))
+# Kích thước input của model: JPEG lớn hơn nhiều được decode thẳng ở 1/2, 1/4, 1/8
+# (DETECT_IMGSZ=0 để luôn decode full)
+DETECT_IMGSZ = int(os.getenv("DETECT_IMGSZ", "640"))
+# Vùng quan tâm theo camera (roi.py): /detect?camera=<id> chỉ chạy model trên crop
+# quanh vùng của camera đó (key "<id>" hoặc "*"), box ngoài vùng bị bỏ
+ROI = load_roi_config(os.getenv("ROI_CONFIG"))
+
 # 1. Khởi tạo App với Metadata cho Swagger
 app = FastAPI(
     title="Helmet Detection API",
@@ -20,39 +58,305 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Load model (nên để ngoài function để tránh load lại mỗi lần gọi API)
-try:
-    model = YOLOWorld('best.pt')
-except Exception as e:
-    print(f"Lỗi load model: {e}")
+# Khai báo model (load lazy qua registry, không load lúc import)
+def _load_detector(weights, backend):
+    if backend == "torch":
+        return YOLOWorld(str(weights))
+    # File export (best.onnx, ...) được cache cạnh best.pt, chỉ export lần đầu
+    return load_model(weights, backend)
+
+registry.register("default", DETECT_MODEL, backend=INFER_BACKEND, loader=_load_detector)
+
+# Chạy nhiều worker: gunicorn -c gunicorn.conf.py frontend:app
+# PRELOAD_MODEL=1 -> load weights ngay ở process cha trước khi fork (dùng chung copy-on-write)
+if os.getenv("PRELOAD_MODEL") == "1":
+    registry.preload("default")
+
+def predict_batch(images):
+    """
+    Chạy predict cho cả batch, trả về list (xyxy, conf, cls) NumPy theo thứ tự ảnh.
+    Phần tử (ảnh, RegionSet) được gom vào 1 lần predict riêng trên các crop ROI.
+    """
+    model = get_model()
+    out = [None] * len(images)
+    full = [i for i, item in enumerate(images) if not isinstance(item, tuple)]
+    regional = [i for i, item in enumerate(images) if isinstance(item, tuple)]
+    with metrics.stage_timer("detect", "predict"):
+        if full:
+            results = model.predict([images[i] for i in full], conf=0.5, verbose=False)
+            # Lấy cả mảng 1 lần thay vì đổi tensor -> Python cho từng box
+            for i, r in zip(full, results):
+                out[i] = boxes_to_numpy(r)
+        if regional:
+            found = predict_regions(model, [images[i] for i in regional], imgsz=DETECT_IMGSZ or 640,
+                                    conf=0.5, verbose=False)
+            for i, dets in zip(regional, found):
+                out[i] = dets
+    return out
+
+def format_predictions(dets):
+    xyxy, confs, classes = dets
+    # dets chỉ có sau khi model đã predict -> model chắc chắn đã load, không
+    # gọi get_model() (có thể load / warm-up đồng bộ) trên event loop
+    names = registry.loaded().names
+    return [
+        {"box": coords, "label": names[cls], "confidence": conf}
+        for coords, conf, cls in zip(xyxy.tolist(), confs.tolist(), classes.tolist())
+    ]
+
+# ==============================================================================
+# ĐỊNH DẠNG RESPONSE CỦA /detect (?format=...)
+# ==============================================================================
+# json    : {"predictions": [{"box", "label", "confidence"}, ...]} (mặc định)
+# f32     : application/octet-stream, mảng float32 little-endian (N, 6):
+#           x1, y1, x2, y2, confidence, class_id (tên class: GET /detect/labels)
+# msgpack : {"boxes": [x1, y1, x2, y2, ...], "conf": [...], "cls": [...]} (float32, cần cài msgpack)
+RESPONSE_FORMATS = ("json", "f32", "msgpack")
+
+def render_predictions(response, dets, fmt, cache_status):
+    headers = {"X-Cache": cache_status}
+    if fmt == "json":
+        response.headers.update(headers)
+        return {"predictions": format_predictions(dets)}
+
+    xyxy, confs, classes = dets
+    headers["X-Box-Count"] = str(len(confs))
+    if fmt == "f32":
+        packed = np.empty((len(confs), 6), dtype="<f4")
+        packed[:, :4] = xyxy
+        packed[:, 4] = confs
+        packed[:, 5] = classes
+        return Response(packed.tobytes(), media_type="application/octet-stream", headers=headers)
+
+    body = msgpack.packb({
+        "boxes": xyxy.ravel().tolist(),
+        "conf": confs.tolist(),
+        "cls": classes.tolist(),
+    }, use_single_float=True)
+    return Response(body, media_type="application/msgpack", headers=headers)
+
+scheduler = BatchScheduler(predict_batch, max_batch_size=MAX_BATCH_SIZE, max_wait_ms=MAX_WAIT_MS)
+result_cache = ResultCache(max_entries=CACHE_SIZE, max_bytes=int(CACHE_MAX_MB * 1024 * 1024),
+                           ttl_s=CACHE_TTL_S, mode=CACHE_MODE)
+
+@app.on_event("startup")
+async def warmup_model():
+    # Load (nếu chưa) + warm-up trong chính worker này trước khi nhận request đầu tiên
+    try:
+        await asyncio.get_running_loop().run_in_executor(None, get_model)
+    except Exception as e:
+        print(f"Lỗi load model: {e}")
+
+@app.on_event("shutdown")
+async def stop_scheduler():
+    await scheduler.stop()
+
+def _scoped(key, camera, regions):
+    """Cùng ảnh nhưng khác vùng ROI -> kết quả khác, key cache phải kèm camera."""
+    return key if regions is None else f"{camera}|{key}"
 
 @app.post("/detect", tags=["Detection"]) # Thêm tags để nhóm trên Swagger
-async def detect_helmet(file: UploadFile = File(...)):
+async def detect_helmet(response: Response, file: UploadFile = File(...),
+                        fmt: str = Query("json", alias="format"),
+                        camera: str = Query(None),
+                        x_cache_bypass: str = Header(None)):
     """
     Endpoint nhận ảnh từ Camera và trả về tọa độ Bounding Box.
     - **file**: Ảnh chụp từ webcam (format .jpg hoặc .png)
+    - **format**: json (mặc định) / f32 / msgpack
+    - **camera**: id camera -> chỉ detect trong vùng ROI của camera (ROI_CONFIG)
+    - **X-Cache-Bypass: 1**: bỏ qua cache, luôn chạy model
     """
+    if fmt not in RESPONSE_FORMATS:
+        raise HTTPException(status_code=400, detail=f"format phải là một trong {RESPONSE_FORMATS}")
+    if fmt == "msgpack" and msgpack is None:
+        raise HTTPException(status_code=406, detail="Server chưa cài msgpack")
+
     contents = await file.read()
-    nparr = np.frombuffer(contents, np.uint8)
-    img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-
-    results = model.predict(img, conf=0.5)
-
-    predictions = []
-    for r in results:
-        for box in r.boxes:
-            coords = box.xyxy[0].tolist()
-            conf = float(box.conf[0])
-            cls = int(box.cls[0])
-            label = model.names[cls]
-
-            predictions.append({
-                "box": coords,
-                "label": label,
-                "confidence": conf
-            })
-
-    return {"predictions": predictions}
+    regions = regions_for(ROI, camera) if camera else None
+
+    use_cache = result_cache.enabled and x_cache_bypass not in ("1", "true")
+    keys = []
+    if use_cache:
+        keys.append(_scoped(content_key(contents), camera, regions))
+        cached = result_cache.get(keys[0])
+        if cached is not None:
+            return render_predictions(response, cached, fmt, "HIT")
+    elif result_cache.enabled:
+        result_cache.bypass()
+
+    # Ảnh lớn (4K) được decode thẳng ở độ phân giải giảm, box được đổi về toạ độ gốc
+    with metrics.stage_timer("detect", "decode"):
+        img, scale = decode_for_model(contents, DETECT_IMGSZ)
+    if img is None:
+        raise HTTPException(status_code=400, detail="Không đọc được ảnh")
+
+    if use_cache and result_cache.mode == "phash":
+        keys.append(_scoped(dhash_key(img), camera, regions))
+        cached = result_cache.get(keys[1])
+        if cached is not None:
+            # Ghi thêm key bytes để lần gửi lại y hệt không cần decode
+            result_cache.put(keys[:1], cached)
+            return render_predictions(response, cached, fmt, "HIT")
+
+    # Các request đồng thời được gom thành 1 batch, chạy ngoài event loop
+    # (inference = chờ batch + predict, xem thêm stage "predict" cho riêng model)
+    with metrics.stage_timer("detect", "inference"):
+        xyxy, confs, classes = await scheduler.submit(img if regions is None else (img, regions))
+    dets = (rescale_boxes(xyxy, scale), confs, classes)
+
+    if use_cache:
+        result_cache.miss()
+        result_cache.put(keys, dets)
+    with metrics.stage_timer("detect", "render"):
+        return render_predictions(response, dets, fmt, "MISS" if use_cache else "BYPASS")
+
+@app.get("/detect/labels", tags=["Detection"])
+async def detect_labels():
+    """
+    Tên class theo class_id (dùng cho format f32 / msgpack).
+    """
+    model = registry.loaded()
+    if model is None:
+        # Warm-up chưa xong -> load trong executor, không chặn event loop
+        model = await asyncio.get_running_loop().run_in_executor(None, get_model)
+    names = model.names
+    return {"labels": names if isinstance(names, list) else [names[i] for i in sorted(names)]}
+
+# ==============================================================================
+# WEBSOCKET /ws/detect: STREAM FRAME LIÊN TỤC TRÊN 1 KẾT NỐI
+# ==============================================================================
+# Mỗi message nhị phân = header 9 byte (big-endian) + payload:
+#   seq (uint32) | format (uint8: 0 = JPEG/PNG, 1 = BGR raw) | width (uint16) | height (uint16)
+# width/height chỉ dùng cho BGR raw (payload = width * height * 3 byte).
+# Server trả JSON: {"seq", "predictions", "latency_ms"} hoặc {"seq", "skipped": true}.
+# Tối đa WS_MAX_IN_FLIGHT frame được decode / inference cùng lúc; khi client gửi
+# nhanh hơn khả năng xử lý, chỉ giữ frame mới nhất đang chờ, frame cũ bị bỏ.
+WS_HEADER = struct.Struct(">IBHH")
+WS_FORMAT_ENCODED = 0
+WS_FORMAT_BGR = 1
+
+ws_stats = {"sessions": 0, "active": 0, "frames": 0, "processed": 0, "skipped": 0, "errors": 0}
+
+
+def decode_ws_frame(message):
+    """Decode payload của 1 message WebSocket, trả về (ảnh BGR hoặc None, scale)."""
+    _, fmt, width, height = WS_HEADER.unpack_from(message)
+    if fmt == WS_FORMAT_ENCODED:
+        return decode_for_model(memoryview(message)[WS_HEADER.size:], DETECT_IMGSZ)
+    payload = np.frombuffer(message, np.uint8, offset=WS_HEADER.size)
+    if fmt == WS_FORMAT_BGR and payload.size == width * height * 3:
+        return payload.reshape(height, width, 3), (1.0, 1.0)
+    return None, (1.0, 1.0)
+
+
+@app.websocket("/ws/detect")
+async def detect_stream(websocket: WebSocket):
+    await websocket.accept()
+    loop = asyncio.get_running_loop()
+    waiting = asyncio.Queue(maxsize=1)   # frame mới nhất chưa được xử lý
+    send_lock = asyncio.Lock()
+    last_sent = -1
+
+    ws_stats["sessions"] += 1
+    ws_stats["active"] += 1
+
+    async def send(payload):
+        async with send_lock:
+            await websocket.send_json(payload)
+
+    async def worker():
+        nonlocal last_sent
+        while True:
+            seq, received_at, message = await waiting.get()
+            try:
+                img, scale = await loop.run_in_executor(None, decode_ws_frame, message)
+                if img is None:
+                    ws_stats["errors"] += 1
+                    await send({"seq": seq, "error": "Không đọc được ảnh"})
+                    continue
+
+                xyxy, confs, classes = await scheduler.submit(img)
+                if seq < last_sent:
+                    # Frame mới hơn đã có kết quả -> kết quả này đã cũ, vẫn báo cho client
+                    ws_stats["skipped"] += 1
+                    await send({"seq": seq, "skipped": True})
+                    continue
+                last_sent = seq
+                ws_stats["processed"] += 1
+                await send({
+                    "seq": seq,
+                    "predictions": format_predictions((rescale_boxes(xyxy, scale), confs, classes)),
+                    "latency_ms": round((time.perf_counter() - received_at) * 1000, 2),
+                })
+            except Exception as e:
+                ws_stats["errors"] += 1
+                print(f"Lỗi xử lý frame {seq} (/ws/detect): {e}")
+
+    workers = [asyncio.create_task(worker()) for _ in range(max(1, WS_MAX_IN_FLIGHT))]
+    try:
+        while True:
+            msg = await websocket.receive()
+            if msg["type"] == "websocket.disconnect":
+                break
+            message = msg.get("bytes")
+            if not message or len(message) < WS_HEADER.size:
+                continue
+            ws_stats["frames"] += 1
+            seq = WS_HEADER.unpack_from(message)[0]
+
+            if waiting.full():
+                stale_seq, _, _ = waiting.get_nowait()
+                ws_stats["skipped"] += 1
+                await send({"seq": stale_seq, "skipped": True})
+            waiting.put_nowait((seq, time.perf_counter(), message))
+    except Exception as e:
+        print(f"WebSocket /ws/detect đóng: {e}")
+    finally:
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        ws_stats["active"] -= 1
+
+@metrics.register_collector
+def collect_detect_metrics():
+    cache = result_cache.stats()
+    return [
+        ("helmet_detect_queue_depth", "gauge", "Số ảnh /detect đang chờ gom batch",
+         [({}, scheduler.queue_depth())]),
+        ("helmet_detect_cache_total", "counter", "Tra cache kết quả /detect", [
+            ({"result": "hit"}, cache["hits"]),
+            ({"result": "miss"}, cache["misses"]),
+            ({"result": "bypass"}, cache["bypassed"]),
+        ]),
+        ("helmet_ws_sessions", "gauge", "Số kết nối /ws/detect đang mở", [({}, ws_stats["active"])]),
+        ("helmet_ws_frames_total", "counter", "Frame nhận qua /ws/detect", [
+            ({"result": "processed"}, ws_stats["processed"]),
+            ({"result": "skipped"}, ws_stats["skipped"]),
+            ({"result": "error"}, ws_stats["errors"]),
+        ]),
+    ]
+
+@app.get("/metrics", tags=["Monitoring"])
+async def metrics_endpoint():
+    """
+    Metrics định dạng Prometheus (thời gian từng bước, hàng đợi, cache, WebSocket).
+    """
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+@app.get("/detect/stats", tags=["Detection"])
+async def detect_stats():
+    """
+    Thống kê latency / throughput theo kích thước batch.
+    """
+    return {
+        "max_batch_size": scheduler.max_batch_size,
+        "max_wait_ms": scheduler.max_wait_s * 1000,
+        "by_batch_size": scheduler.stats.snapshot(),
+        "model": registry.stats(),
+        "cache": result_cache.stats(),
+        "stream": dict(ws_stats),
+    }
 
 # 3. Chạy Server
 if __name__ == "__main__":
@@ -0,0 +1,26 @@
+import os
+
+# ==============================================================================
+# CHẠY frontend.py VỚI NHIỀU WORKER
+# ==============================================================================
+# Lệnh: gunicorn -c gunicorn.conf.py frontend:app
+# preload_app: import frontend.py (và load weights, PRELOAD_MODEL=1) 1 lần ở
+# process cha rồi mới fork -> các worker dùng chung weights (copy-on-write),
+# RAM không tăng theo số worker. Mỗi worker tự warm-up ở sự kiện startup.
+
+os.environ.setdefault("PRELOAD_MODEL", "1")
+
+bind = os.getenv("BIND", "127.0.0.1:8000")
+workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+worker_class = "uvicorn.workers.UvicornWorker"
+preload_app = True
+timeout = 120
+
+
+def post_fork(server, worker):
+    # Chia đều core CPU cho các worker, tránh mỗi worker tự mở thread bằng số core
+    try:
+        import torch
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // workers))
+    except ImportError:
+        pass
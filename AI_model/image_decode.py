@@ -0,0 +1,79 @@
+import cv2
+import numpy as np
+
+# ==============================================================================
+# DECODE ẢNH Ở ĐỘ PHÂN GIẢI GIẢM
+# ==============================================================================
+# YOLO resize mọi ảnh về imgsz (640) ngay sau khi decode -> decode full 4K là
+# phí CPU. libjpeg decode được thẳng ở 1/2, 1/4, 1/8 kích thước (IMREAD_REDUCED_*)
+# nhanh hơn nhiều. Kích thước gốc đọc từ header JPEG (không cần decode), chọn
+# hệ số lớn nhất mà cạnh dài vẫn >= imgsz, box trả về được nhân lại theo scale.
+
+_REDUCED_FLAGS = ((8, cv2.IMREAD_REDUCED_COLOR_8),
+                  (4, cv2.IMREAD_REDUCED_COLOR_4),
+                  (2, cv2.IMREAD_REDUCED_COLOR_2))
+
+# Marker SOF (start of frame) chứa kích thước ảnh; C4/C8/CC không phải SOF
+_JPEG_SOF = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+
+def jpeg_size(data):
+    """(width, height) đọc từ header JPEG, None nếu không phải JPEG / header lỗi."""
+    if data[:2] != b"\xff\xd8":
+        return None
+    i, n = 2, len(data)
+    while i + 9 <= n:
+        if data[i] != 0xFF:
+            i += 1
+            continue
+        marker = data[i + 1]
+        if marker == 0xFF:                      # byte đệm
+            i += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:   # marker không có độ dài
+            i += 2
+            continue
+        if marker in _JPEG_SOF:
+            height = int.from_bytes(data[i + 5:i + 7], "big")
+            width = int.from_bytes(data[i + 7:i + 9], "big")
+            return width, height
+        i += 2 + int.from_bytes(data[i + 2:i + 4], "big")
+    return None
+
+
+def reduce_factor(width, height, imgsz):
+    """Hệ số giảm lớn nhất (1, 2, 4, 8) mà cạnh dài sau khi giảm vẫn >= imgsz."""
+    longest = max(width, height)
+    for factor, _ in _REDUCED_FLAGS:
+        if longest // factor >= imgsz:
+            return factor
+    return 1
+
+
+def decode_for_model(data, imgsz=640):
+    """
+    Decode bytes ảnh cho model. Trả về (img, scale) với scale = (sx, sy) để đổi
+    toạ độ box trên img về toạ độ ảnh gốc; img = None nếu không đọc được.
+    """
+    buf = np.frombuffer(data, np.uint8)
+    size = jpeg_size(data) if imgsz else None
+    factor = reduce_factor(*size, imgsz) if size else 1
+    if factor == 1:
+        return cv2.imdecode(buf, cv2.IMREAD_COLOR), (1.0, 1.0)
+
+    img = cv2.imdecode(buf, dict(_REDUCED_FLAGS)[factor])
+    if img is None:
+        return None, (1.0, 1.0)
+    width, height = size
+    h, w = img.shape[:2]
+    if (w > h) != (width > height):
+        # Ảnh đã được xoay theo EXIF orientation
+        width, height = height, width
+    return img, (width / w, height / h)
+
+
+def rescale_boxes(xyxy, scale):
+    if scale == (1.0, 1.0) or len(xyxy) == 0:
+        return xyxy
+    sx, sy = scale
+    return xyxy * np.array([sx, sy, sx, sy], dtype=xyxy.dtype)
@@ -0,0 +1,126 @@
+import asyncio
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+# ==============================================================================
+# BATCH SCHEDULER CHO INFERENCE
+# ==============================================================================
+# Gom các request đồng thời thành 1 lần gọi predict (micro-batching).
+# - max_batch_size: số ảnh tối đa trong 1 batch
+# - max_wait_ms: thời gian tối đa chờ gom thêm ảnh sau ảnh đầu tiên
+# Model chạy trên 1 thread riêng nên event loop không bị block.
+
+
+class BatchStats:
+    """Thống kê latency / throughput theo từng kích thước batch."""
+
+    def __init__(self):
+        self._by_size = defaultdict(lambda: {
+            "batches": 0,
+            "images": 0,
+            "infer_s": 0.0,
+            "latency_s": 0.0,
+            "max_latency_s": 0.0,
+        })
+
+    def record(self, batch_size, infer_s, latencies):
+        s = self._by_size[batch_size]
+        s["batches"] += 1
+        s["images"] += batch_size
+        s["infer_s"] += infer_s
+        s["latency_s"] += sum(latencies)
+        s["max_latency_s"] = max(s["max_latency_s"], max(latencies))
+
+    def snapshot(self):
+        out = {}
+        for size, s in sorted(self._by_size.items()):
+            out[size] = {
+                "batches": s["batches"],
+                "images": s["images"],
+                "avg_infer_ms": round(s["infer_s"] / s["batches"] * 1000, 2),
+                "avg_latency_ms": round(s["latency_s"] / s["images"] * 1000, 2),
+                "max_latency_ms": round(s["max_latency_s"] * 1000, 2),
+                "throughput_fps": round(s["images"] / s["infer_s"], 2) if s["infer_s"] > 0 else None,
+            }
+        return out
+
+
+class BatchScheduler:
+    """
+    Nhận ảnh từ nhiều coroutine, gom thành batch rồi gọi `predict_fn(images)`.
+    `predict_fn` nhận list ảnh và phải trả về list kết quả cùng thứ tự.
+    """
+
+    def __init__(self, predict_fn, max_batch_size=8, max_wait_ms=10.0):
+        self.predict_fn = predict_fn
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait_s = max(0.0, max_wait_ms / 1000.0)
+        self.stats = BatchStats()
+        self._queue = None
+        self._task = None
+        # 1 worker duy nhất: model YOLO không an toàn khi gọi song song
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="yolo-batch")
+
+    def _ensure_started(self):
+        if self._task is None or self._task.done():
+            self._queue = asyncio.Queue()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def queue_depth(self):
+        """Số ảnh đang chờ được gom vào batch."""
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def submit(self, image):
+        """Đưa 1 ảnh vào hàng đợi và chờ kết quả của riêng ảnh đó."""
+        self._ensure_started()
+        fut = asyncio.get_running_loop().create_future()
+        await self._queue.put((image, fut, time.perf_counter()))
+        return await fut
+
+    async def _collect(self):
+        batch = [await self._queue.get()]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.max_wait_s
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        # Lấy thêm những ảnh đã có sẵn trong queue (không chờ)
+        while len(batch) < self.max_batch_size and not self._queue.empty():
+            batch.append(self._queue.get_nowait())
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            images = [item[0] for item in batch]
+            t0 = time.perf_counter()
+            try:
+                results = await loop.run_in_executor(self._executor, self.predict_fn, images)
+            except Exception as e:
+                for _, fut, _ in batch:
+                    if not fut.done():
+                        fut.set_exception(e)
+                continue
+            t1 = time.perf_counter()
+
+            self.stats.record(len(batch), t1 - t0, [t1 - enq for _, _, enq in batch])
+            for (_, fut, _), result in zip(batch, results):
+                if not fut.done():
+                    fut.set_result(result)
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self._executor.shutdown(wait=False)
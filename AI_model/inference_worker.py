@@ -0,0 +1,57 @@
+import threading
+
+# ==============================================================================
+# INFERENCE WORKER (LATEST-FRAME-WINS)
+# ==============================================================================
+# Thread riêng chạy model, nhận frame qua hàng đợi 1 ô:
+# - submit() không bao giờ block, frame mới ghi đè frame chưa xử lý (frame cũ bị bỏ)
+# - latest() trả về kết quả mới nhất đã xử lý xong (hoặc None nếu chưa có)
+# Nhờ vậy recv() luôn trả về ngay, model chậm chỉ làm giảm FPS của lớp AI
+# chứ không làm đứng event loop của aiohttp/aiortc.
+
+
+class LatestFrameWorker:
+    def __init__(self, process_fn, name="ai-worker"):
+        self.process_fn = process_fn
+        self.processed = 0
+        self.dropped = 0
+        self.errors = 0
+        self._cond = threading.Condition()
+        self._pending = None
+        self._latest = None
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(self, item):
+        with self._cond:
+            if self._pending is not None:
+                self.dropped += 1
+            self._pending = item
+            self._cond.notify()
+
+    def latest(self):
+        return self._latest
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._pending = None
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._pending is None and self._running:
+                    self._cond.wait()
+                if not self._running:
+                    return
+                item = self._pending
+                self._pending = None
+
+            try:
+                self._latest = self.process_fn(item)
+                self.processed += 1
+            except Exception as e:
+                self.errors += 1
+                print(f"❌ Lỗi inference worker: {e}")
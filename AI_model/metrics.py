@@ -0,0 +1,155 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# ==============================================================================
+# METRICS (ĐỊNH DẠNG TEXT CỦA PROMETHEUS) CHO /metrics
+# ==============================================================================
+# Không cần prometheus_client. Chi phí trên hot path chỉ là 1 bisect + 1 lock
+# mỗi lần observe, nên để bật thường trực ở production được.
+# - STAGE_SECONDS: histogram thời gian từng bước (pipeline, stage), ví dụ
+#   video/decode, camera/predict, detect/decode, audit/imwrite...
+# - Gauge / counter có sẵn ở chỗ khác (số peer connection, độ dài hàng đợi,
+#   frame bị bỏ...) được đọc lúc scrape qua register_collector(), hot path
+#   không phải làm gì thêm.
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra=None):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}   # label values -> [số đếm theo bucket (không cộng dồn), sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labelvalues):
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labelvalues)
+            if series is None:
+                series = self._series[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, *labelvalues):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - t0, *labelvalues)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = [(k, list(v[0]), v[1], v[2]) for k, v in sorted(self._series.items())]
+        for labelvalues, counts, total, count in series:
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), counts):
+                cumulative += n
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound!r}"'
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, labelvalues, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, labelvalues)} {total}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, labelvalues)} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._histograms = []
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        h = Histogram(name, documentation, labelnames, buckets)
+        with self._lock:
+            self._histograms.append(h)
+        return h
+
+    def register_collector(self, fn):
+        """
+        fn() -> list (name, type, help, [(dict labels, value), ...]); type là
+        "gauge" hoặc "counter". Được gọi lúc scrape, lỗi của 1 collector bị bỏ qua.
+        """
+        with self._lock:
+            self._collectors.append(fn)
+        return fn
+
+    def unregister_collector(self, fn):
+        with self._lock:
+            if fn in self._collectors:
+                self._collectors.remove(fn)
+
+    def render(self):
+        with self._lock:
+            histograms = list(self._histograms)
+            collectors = list(self._collectors)
+
+        lines = []
+        for h in histograms:
+            lines.extend(h.render())
+
+        # Gộp các series cùng tên từ nhiều collector (vd. nhiều StreamHub)
+        families = {}
+        for fn in collectors:
+            try:
+                metrics = fn()
+            except Exception as e:
+                print(f"⚠️ Lỗi collector metrics {getattr(fn, '__name__', fn)}: {e}")
+                continue
+            for name, kind, documentation, samples in metrics:
+                family = families.setdefault(name, (kind, documentation, []))
+                family[2].extend(samples)
+
+        for name, (kind, documentation, samples) in families.items():
+            lines.append(f"# HELP {name} {documentation}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                lines.append(f"{name}{_labels(labels.keys(), labels.values())} {value}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    "helmet_stage_seconds", "Thời gian từng bước xử lý (giây)", ("pipeline", "stage"))
+
+
+def stage_timer(pipeline, stage):
+    """with stage_timer("video", "predict"): ... -> ghi vào helmet_stage_seconds."""
+    return STAGE_SECONDS.time(pipeline, stage)
+
+
+def observe_stage(pipeline, stage, seconds):
+    STAGE_SECONDS.observe(seconds, pipeline, stage)
+
+
+def register_collector(fn):
+    return REGISTRY.register_collector(fn)
+
+
+def unregister_collector(fn):
+    REGISTRY.unregister_collector(fn)
+
+
+def render():
+    return REGISTRY.render()
@@ -0,0 +1,135 @@
+import os
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+
+from backends import load_model
+
+# ==============================================================================
+# MODEL REGISTRY: LOAD 1 LẦN, LAZY, AN TOÀN KHI FORK
+# ==============================================================================
+# - register(): khai báo model (đường dẫn, backend, model dự phòng), chưa load
+# - get(): load khi cần lần đầu + warm-up bằng 1 lần inference giả,
+#   các thread gọi cùng lúc chỉ load 1 lần
+# - preload(): load weights ở process cha TRƯỚC khi fork N worker
+#   (gunicorn preload_app) -> weights dùng chung copy-on-write giữa các worker.
+#   Process cha không warm-up (thread pool OpenMP/torch không an toàn khi fork),
+#   mỗi worker tự warm-up sau fork trước khi nhận request đầu tiên.
+# - loaded(): model nếu đã load, không bao giờ load / warm-up (dùng được trên event loop)
+# - stats(): thời gian load / warm-up, file weights thực sự được dùng
+
+
+class ModelEntry:
+    def __init__(self, name, weights, backend=None, fallback=None, loader=None, imgsz=640):
+        self.name = name
+        self.weights = Path(weights)
+        self.backend = backend
+        self.fallback = fallback
+        self.loader = loader
+        self.imgsz = imgsz
+        self.model = None
+        self.loaded_from = None
+        self.load_s = None
+        self.warmup_s = None
+        self.warm = False
+        self.lock = threading.Lock()
+
+
+class ModelRegistry:
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def register(self, name, weights, backend=None, fallback=None, loader=None, imgsz=640):
+        """
+        loader(weights, backend) -> model: mặc định backends.load_model.
+        fallback: weights dùng khi không có file `weights` (None = báo lỗi).
+        """
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None:
+                self._entries[name] = ModelEntry(name, weights, backend, fallback, loader, imgsz)
+
+    def _entry(self, name):
+        entry = self._entries.get(name)
+        if entry is None:
+            raise KeyError(f"Model '{name}' chưa được register")
+        return entry
+
+    def _load(self, entry):
+        weights = entry.weights
+        if not weights.exists():
+            if entry.fallback is None:
+                raise FileNotFoundError(f"Không tìm thấy model: {weights.resolve()}")
+            print(f"⚠️ Không tìm thấy {weights}, dùng model dự phòng {entry.fallback}!")
+            weights = Path(entry.fallback)
+
+        print(f"⏳ Đang tải model '{entry.name}' từ {weights}...")
+        t0 = time.perf_counter()
+        loader = entry.loader or load_model
+        entry.model = loader(weights, entry.backend)
+        entry.load_s = time.perf_counter() - t0
+        entry.loaded_from = str(weights)
+        print(f"✅ Model '{entry.name}' đã tải xong sau {entry.load_s:.2f}s.")
+
+    def _warmup(self, entry):
+        dummy = np.zeros((entry.imgsz, entry.imgsz, 3), dtype=np.uint8)
+        t0 = time.perf_counter()
+        entry.model.predict(dummy, verbose=False)
+        entry.warmup_s = time.perf_counter() - t0
+        entry.warm = True
+        print(f"🔥 Warm-up model '{entry.name}' (pid {os.getpid()}): {entry.warmup_s * 1000:.0f}ms")
+
+    def preload(self, name="default", warmup=False):
+        """Chỉ load weights (warmup=False) – gọi ở process cha trước khi fork."""
+        entry = self._entry(name)
+        with entry.lock:
+            if entry.model is None:
+                self._load(entry)
+            if warmup and not entry.warm:
+                self._warmup(entry)
+        return entry.model
+
+    def get(self, name="default"):
+        """Model đã load + warm-up. Lỗi load được raise ra (không exit())."""
+        entry = self._entry(name)
+        if entry.model is not None and entry.warm:
+            return entry.model
+        return self.preload(name, warmup=True)
+
+    def loaded(self, name="default"):
+        """Model đã load (chưa chắc đã warm-up) hoặc None; không load, không block."""
+        return self._entry(name).model
+
+    def stats(self):
+        out = {}
+        for name, e in self._entries.items():
+            out[name] = {
+                "loaded": e.model is not None,
+                "loaded_from": e.loaded_from,
+                "backend": e.backend or os.getenv("INFER_BACKEND", "torch"),
+                "load_s": round(e.load_s, 3) if e.load_s is not None else None,
+                "warmup_s": round(e.warmup_s, 3) if e.warmup_s is not None else None,
+                "warm": e.warm,
+                "pid": os.getpid(),
+            }
+        return out
+
+    def _after_fork(self):
+        # Process con: lock mới, warm-up lại trong chính worker này
+        self._lock = threading.Lock()
+        for e in self._entries.values():
+            e.lock = threading.Lock()
+            e.warm = False
+            e.warmup_s = None
+
+
+registry = ModelRegistry()
+
+
+def get_model(name="default"):
+    return registry.get(name)
@@ -0,0 +1,72 @@
+import cv2
+import numpy as np
+
+# ==============================================================================
+# MOTION GATE: BỎ QUA INFERENCE KHI CẢNH ĐỨNG YÊN
+# ==============================================================================
+# Chạy trước YOLO trên bản xám thu nhỏ của frame (rất rẻ so với model):
+# - mode="diff": so với frame ở lần inference gần nhất (không phải frame liền
+#   trước) -> thay đổi chậm dồn lại đủ lớn vẫn kích hoạt inference
+# - mode="mog2": background subtraction (MOG2), hợp với cảnh có ánh sáng dao động
+# Không có chuyển động -> dùng lại kết quả cũ, không gọi model.
+# max_skip: tối đa bao nhiêu frame liên tiếp được bỏ qua (bắt buộc chạy lại).
+
+
+class MotionGate:
+    def __init__(self, pixel_threshold=25, area_ratio=0.002, max_skip=150,
+                 size=(160, 90), mode="diff"):
+        if mode not in ("diff", "mog2"):
+            raise ValueError("mode phải là 'diff' hoặc 'mog2'")
+        self.pixel_threshold = pixel_threshold  # Độ nhạy: chênh lệch mức xám tối thiểu của 1 pixel
+        self.area_ratio = area_ratio            # Tỷ lệ diện tích thay đổi tối thiểu để coi là có chuyển động
+        self.max_skip = max_skip
+        self.size = size
+        self.mode = mode
+        self._reference = None
+        self._skipped_in_row = 0
+        self._mog2 = (cv2.createBackgroundSubtractorMOG2(history=300, varThreshold=pixel_threshold,
+                                                         detectShadows=False)
+                      if mode == "mog2" else None)
+
+        self.frames = 0
+        self.inferred = 0
+        self.skipped = 0
+
+    def _small(self, img):
+        # Ảnh 1 kênh (plane Y của frame YUV) đã là ảnh xám
+        gray = img if img.ndim == 2 else cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        small = cv2.resize(gray, self.size, interpolation=cv2.INTER_AREA)
+        return cv2.GaussianBlur(small, (5, 5), 0)
+
+    def motion_ratio(self, small):
+        if self._mog2 is not None:
+            mask = self._mog2.apply(small)
+            return float(np.count_nonzero(mask)) / mask.size
+        if self._reference is None:
+            return 1.0
+        diff = cv2.absdiff(self._reference, small)
+        return float(np.count_nonzero(diff > self.pixel_threshold)) / diff.size
+
+    def should_infer(self, img):
+        """True nếu cần chạy model cho frame này."""
+        self.frames += 1
+        small = self._small(img)
+        moved = self.motion_ratio(small) >= self.area_ratio
+
+        if moved or self._reference is None or self._skipped_in_row >= self.max_skip:
+            self._reference = small
+            self._skipped_in_row = 0
+            self.inferred += 1
+            return True
+
+        self._skipped_in_row += 1
+        self.skipped += 1
+        return False
+
+    def stats(self):
+        return {
+            "frames": self.frames,
+            "inferred": self.inferred,
+            "skipped": self.skipped,
+            "skip_ratio": round(self.skipped / self.frames, 4) if self.frames else 0.0,
+        }
@@ -0,0 +1,150 @@
+import cv2
+import numpy as np
+
+# ==============================================================================
+# HẬU XỬ LÝ KẾT QUẢ YOLO (VECTOR HÓA)
+# ==============================================================================
+# Thay vòng lặp `for box in result.boxes` (đổi tensor -> Python từng box, xử lý
+# chuỗi tên class cho từng box) bằng:
+# 1. Bảng tra class id -> IGNORE / SAFE / UNSAFE, tính 1 lần khi load model
+# 2. Lọc ngưỡng CONF_VIOLATION / CONF_SAFE bằng mask NumPy trên cả mảng
+# Kết quả trả về dạng cột (mảng xyxy, conf, cls, category).
+
+IGNORE = 0
+SAFE = 1
+UNSAFE = 2
+
+
+def classify_name(name, kw_unsafe, kw_safe):
+    """Giữ đúng logic cũ: chuẩn hóa tên, xét nhóm VI PHẠM trước rồi mới tới AN TOÀN."""
+    cls_name = name.lower().replace("_", "-")
+    if any(k in cls_name for k in kw_unsafe):
+        return UNSAFE
+    if any(k in cls_name for k in kw_safe):
+        return SAFE
+    return IGNORE
+
+
+def build_category_lut(names, kw_unsafe, kw_safe):
+    """names: dict {id: tên} hoặc list của model. Trả về mảng int8 tra theo class id."""
+    if not names:
+        return np.zeros(0, dtype=np.int8)
+    if not isinstance(names, dict):
+        names = dict(enumerate(names))
+    lut = np.zeros(max(names) + 1, dtype=np.int8)
+    for cls_id, name in names.items():
+        lut[cls_id] = classify_name(name, kw_unsafe, kw_safe)
+    return lut
+
+
+def boxes_to_numpy(result):
+    """Lấy toàn bộ box của 1 Result thành mảng NumPy (1 lần copy cho cả frame)."""
+    boxes = result.boxes
+    if boxes is None or len(boxes) == 0:
+        return (np.zeros((0, 4), dtype=np.float32), np.zeros(0, dtype=np.float32),
+                np.zeros(0, dtype=np.int64))
+    return (boxes.xyxy.cpu().numpy(), boxes.conf.cpu().numpy(),
+            boxes.cls.cpu().numpy().astype(np.int64))
+
+
+class Detections:
+    """
+    Kết quả dạng cột sau khi lọc: xyxy (N,4), conf (N,), cls (N,), category (N,).
+    track_ids (N,) chỉ có khi đi qua tracker.
+    """
+
+    __slots__ = ("xyxy", "conf", "cls", "category", "track_ids")
+
+    def __init__(self, xyxy, conf, cls, category, track_ids=None):
+        self.xyxy = xyxy
+        self.conf = conf
+        self.cls = cls
+        self.category = category
+        self.track_ids = track_ids
+
+    def __len__(self):
+        return len(self.conf)
+
+    @property
+    def has_violation(self):
+        return bool((self.category == UNSAFE).any())
+
+    @property
+    def has_safe(self):
+        return bool((self.category == SAFE).any())
+
+    def to_records(self, names):
+        """List dict từng box (để lưu / trả JSON): xyxy, conf, label, category, track_id."""
+        kinds = {IGNORE: "ignore", SAFE: "safe", UNSAFE: "violation"}
+        track_ids = self.track_ids.tolist() if self.track_ids is not None else [None] * len(self)
+        return [
+            {"xyxy": [round(v, 1) for v in box], "conf": round(conf, 4), "label": names[cls],
+             "category": kinds[cat], "track_id": tid}
+            for box, conf, cls, cat, tid in zip(self.xyxy.tolist(), self.conf.tolist(), self.cls.tolist(),
+                                                self.category.tolist(), track_ids)
+        ]
+
+    @property
+    def state(self):
+        """Trạng thái cả frame: VIOLATION / SAFE / NONE."""
+        if self.has_violation:
+            return "VIOLATION"
+        return "SAFE" if self.has_safe else "NONE"
+
+    def to_compact(self, names):
+        """
+        Dạng gọn cho client tự vẽ overlay: mỗi box là
+        [x1, y1, x2, y2, conf, nhãn, vi_phạm (0/1), track_id hoặc null], toạ độ pixel nguyên.
+        """
+        track_ids = self.track_ids.tolist() if self.track_ids is not None else [None] * len(self)
+        return [
+            [*box, round(conf, 3), names[cls], int(cat == UNSAFE), tid]
+            for box, conf, cls, cat, tid in zip(self.xyxy.astype(np.int32).tolist(), self.conf.tolist(),
+                                                self.cls.tolist(), self.category.tolist(), track_ids)
+        ]
+
+
+def postprocess(result, lut, conf_violation, conf_safe):
+    return postprocess_arrays(*boxes_to_numpy(result), lut, conf_violation, conf_safe)
+
+
+def postprocess_arrays(xyxy, conf, cls, lut, conf_violation, conf_safe):
+    """Như postprocess() nhưng nhận thẳng mảng (xyxy, conf, cls), vd. đã ghép từ các vùng ROI."""
+    if len(lut) == 0:
+        category = np.zeros(len(cls), dtype=np.int8)
+    else:
+        # Class id ngoài bảng tra (không nên xảy ra) -> IGNORE
+        in_range = cls < len(lut)
+        category = np.where(in_range, lut[np.minimum(cls, len(lut) - 1)], IGNORE).astype(np.int8)
+
+    keep = (((category == UNSAFE) & (conf >= conf_violation))
+            | ((category == SAFE) & (conf >= conf_safe)))
+    return Detections(xyxy[keep], conf[keep], cls[keep], category[keep])
+
+
+def overlay_items(dets, labels=("VIOLATION", "SAFE"), draw_safe_with_violation=True):
+    """(x1, y1, x2, y2, màu BGR, chữ) của từng khung cần vẽ, dùng chung cho ảnh BGR và YUV."""
+    skip_safe = not draw_safe_with_violation and dets.has_violation
+    ids = dets.track_ids.tolist() if dets.track_ids is not None else [None] * len(dets)
+    for (x1, y1, x2, y2), conf, cat, tid in zip(dets.xyxy.astype(np.int32).tolist(),
+                                                dets.conf.tolist(), dets.category.tolist(), ids):
+        if cat == UNSAFE:
+            color, text = (0, 0, 255), f"{labels[0]} {conf:.2f}"
+        elif skip_safe:
+            continue
+        else:
+            color, text = (0, 255, 0), f"{labels[1]} {conf:.2f}"
+        if tid is not None:
+            text = f"#{tid} {text}"
+        yield x1, y1, x2, y2, color, text
+
+
+def draw_detections(img, dets, labels=("VIOLATION", "SAFE"), draw_safe_with_violation=True):
+    """
+    Vẽ khung: VI PHẠM màu đỏ, AN TOÀN màu xanh. Chỉ lặp trên các box đã lọc.
+    draw_safe_with_violation=False: ảnh đã có vi phạm thì không vẽ khung xanh (tập trung vào lỗi).
+    """
+    for x1, y1, x2, y2, color, text in overlay_items(dets, labels, draw_safe_with_violation):
+        cv2.rectangle(img, (x1, y1), (x2, y2), color, 2)
+        cv2.putText(img, text, (x1, y1 - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.6, color, 2)
+    return img
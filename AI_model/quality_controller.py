@@ -0,0 +1,143 @@
+import threading
+import weakref
+from collections import deque
+from datetime import datetime
+
+from metrics import register_collector
+
+# ==============================================================================
+# ĐIỀU CHỈNH CHẤT LƯỢNG THEO TẢI (GIỮ FPS MỤC TIÊU)
+# ==============================================================================
+# Mỗi stream có 1 QualityController, đo thời gian xử lý mỗi frame (gồm cả thời
+# gian chờ model khi nhiều camera dùng chung) và so với ngân sách 1 / target_fps:
+# - EWMA vượt ngân sách down_after frame liên tiếp -> hạ 1 mức chất lượng
+# - EWMA dưới headroom * ngân sách up_after frame liên tiếp -> nâng lại 1 mức
+#   (up_after dài hơn nhiều để không dao động lên / xuống liên tục)
+# Mỗi mức là dict {imgsz, detect_every, capture (rộng, cao) hoặc None}; mức 0 là
+# cấu hình gốc. apply_fn(settings) do producer cung cấp, được gọi trên chính
+# thread inference. Mọi quyết định được in ra log và giữ lại trong decisions.
+
+
+def default_levels(imgsz=640, detect_every=1, capture=None):
+    """Thang chất lượng từ cấu hình gốc: giảm imgsz -> tăng bước detect -> giảm độ phân giải capture."""
+    def size(ratio):
+        return max(160, int(imgsz * ratio) // 32 * 32)
+
+    def cap(ratio):
+        if capture is None:
+            return None
+        return int(capture[0] * ratio) // 2 * 2, int(capture[1] * ratio) // 2 * 2
+
+    return [
+        {"imgsz": imgsz, "detect_every": detect_every, "capture": capture},
+        {"imgsz": size(0.8), "detect_every": detect_every, "capture": capture},
+        {"imgsz": size(0.8), "detect_every": max(detect_every, 2), "capture": capture},
+        {"imgsz": size(0.65), "detect_every": max(detect_every, 2), "capture": cap(0.75)},
+        {"imgsz": size(0.5), "detect_every": max(detect_every, 3), "capture": cap(0.5)},
+    ]
+
+
+class QualityController:
+    def __init__(self, name, target_fps, levels, apply_fn, down_after=5, up_after=60,
+                 headroom=0.6, alpha=0.2):
+        self.name = name
+        self.target_fps = target_fps
+        self.budget_s = 1.0 / target_fps
+        self.levels = levels
+        self.apply_fn = apply_fn
+        self.down_after = down_after
+        self.up_after = up_after
+        self.headroom = headroom
+        self.alpha = alpha
+
+        self.level = 0
+        self.ewma_s = None
+        self.frames = 0
+        self.decisions = deque(maxlen=100)
+        self._over = 0
+        self._under = 0
+        self._lock = threading.Lock()
+        _controllers.add(self)
+
+    @property
+    def settings(self):
+        return self.levels[self.level]
+
+    def observe(self, seconds):
+        """Gọi sau mỗi frame với thời gian xử lý (giây). Trả về True nếu vừa đổi mức."""
+        with self._lock:
+            self.frames += 1
+            self.ewma_s = seconds if self.ewma_s is None else self.alpha * seconds + (1 - self.alpha) * self.ewma_s
+            if self.ewma_s > self.budget_s:
+                self._over += 1
+                self._under = 0
+            elif self.ewma_s < self.budget_s * self.headroom:
+                self._under += 1
+                self._over = 0
+            else:
+                self._over = self._under = 0
+
+            if self._over >= self.down_after and self.level < len(self.levels) - 1:
+                change = (self.level + 1, "quá ngân sách")
+            elif self._under >= self.up_after and self.level > 0:
+                change = (self.level - 1, "còn dư")
+            else:
+                return False
+            decision = self._decide(*change)
+        # apply_fn chạy ngoài lock (vd. đổi độ phân giải camera)
+        self.apply_fn(decision["settings"])
+        return True
+
+    def _decide(self, level, reason):
+        decision = {
+            "time": datetime.now().isoformat(timespec="seconds"),
+            "stream": self.name,
+            "from": self.level,
+            "to": level,
+            "reason": reason,
+            "latency_ms": round(self.ewma_s * 1000, 1),
+            "budget_ms": round(self.budget_s * 1000, 1),
+            "settings": self.levels[level],
+        }
+        self.level = level
+        # Đo lại từ đầu ở mức mới
+        self.ewma_s = None
+        self._over = self._under = 0
+        self.decisions.append(decision)
+        icon = "🔻" if decision["to"] > decision["from"] else "🔺"
+        print(f"{icon} [{self.name}] Chất lượng mức {decision['from']} -> {level} ({reason}: "
+              f"{decision['latency_ms']} ms / ngân sách {decision['budget_ms']} ms) -> {decision['settings']}")
+        return decision
+
+    def close(self):
+        """Ngừng xuất metrics của stream (gọi khi stream dừng)."""
+        _controllers.discard(self)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "target_fps": self.target_fps,
+                "level": self.level,
+                "settings": self.settings,
+                "latency_ms": round(self.ewma_s * 1000, 1) if self.ewma_s is not None else None,
+                "decisions": list(self.decisions)[-10:],
+            }
+
+
+_controllers = weakref.WeakSet()
+
+
+@register_collector
+def collect_metrics():
+    controllers = list(_controllers)
+    level, imgsz, stride = [], [], []
+    for c in controllers:
+        labels = {"stream": c.name}
+        level.append((labels, c.level))
+        imgsz.append((labels, c.settings["imgsz"]))
+        stride.append((labels, c.settings["detect_every"]))
+    return [
+        ("helmet_quality_level", "gauge", "Mức chất lượng hiện tại (0 = đầy đủ)", level),
+        ("helmet_quality_imgsz", "gauge", "Kích thước ảnh vào model", imgsz),
+        ("helmet_quality_detect_every", "gauge", "Chạy model mỗi N frame", stride),
+    ]
@@ -0,0 +1,114 @@
+import hashlib
+import sys
+import time
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+# ==============================================================================
+# CACHE KẾT QUẢ /detect THEO NỘI DUNG ẢNH
+# ==============================================================================
+# Camera cố định hay gửi lại đúng (hoặc gần như đúng) cùng 1 ảnh: hình bị đứng,
+# cảnh tĩnh, client retry. Cache này trả kết quả cũ mà không decode / chạy model.
+# - mode="exact": key = blake2b(bytes upload) -> tra trước khi decode
+# - mode="phash": thêm key dHash 64-bit của ảnh đã decode -> bắt được ảnh gần
+#   giống (nén JPEG lại, nhiễu nhẹ) nhưng vẫn phải decode
+# Giới hạn theo số entry và dung lượng ước lượng (LRU), mỗi entry có TTL.
+
+
+def content_key(data):
+    return "b:" + hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def dhash_key(img, size=8):
+    """Difference hash: so sánh từng cặp pixel kề nhau trên ảnh xám (size+1) x size."""
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) if img.ndim == 3 else img
+    small = cv2.resize(gray, (size + 1, size), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).ravel()
+    return "p:" + np.packbits(bits).tobytes().hex()
+
+
+def _approx_size(value):
+    # Ước lượng đủ dùng cho giới hạn bộ nhớ: (xyxy, conf, cls) NumPy + overhead mỗi mảng
+    return sys.getsizeof(value) + sum(a.nbytes + 112 for a in value)
+
+
+class ResultCache:
+    def __init__(self, max_entries=1024, max_bytes=32 * 1024 * 1024, ttl_s=5.0, mode="exact"):
+        if mode not in ("exact", "phash"):
+            raise ValueError("mode phải là 'exact' hoặc 'phash'")
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_s = ttl_s
+        self.mode = mode
+        self._data = OrderedDict()   # key -> (expires_at, size, (xyxy, conf, cls))
+        self._bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.expired = 0
+        self.evicted = 0
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0
+
+    def get(self, key):
+        """Kết quả đã cache hoặc None. Chỉ đếm hit; miss được đếm bởi miss()."""
+        item = self._data.get(key)
+        if item is None:
+            return None
+        if item[0] < time.monotonic():
+            self._pop(key)
+            self.expired += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return item[2]
+
+    def miss(self):
+        self.misses += 1
+
+    def bypass(self):
+        self.bypassed += 1
+
+    def put(self, keys, dets):
+        if not self.enabled:
+            return
+        size = _approx_size(dets)
+        expires_at = time.monotonic() + self.ttl_s
+        for key in keys:
+            if key in self._data:
+                self._pop(key)
+            self._data[key] = (expires_at, size, dets)
+            self._bytes += size
+        while self._data and (len(self._data) > self.max_entries or self._bytes > self.max_bytes):
+            self._pop(next(iter(self._data)))
+            self.evicted += 1
+
+    def _pop(self, key):
+        _, size, _ = self._data.pop(key)
+        self._bytes -= size
+
+    def clear(self):
+        self._data.clear()
+        self._bytes = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "mode": self.mode,
+            "entries": len(self._data),
+            "approx_bytes": self._bytes,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "ttl_s": self.ttl_s,
+            "hits": self.hits,
+            "misses": self.misses,
+            "bypassed": self.bypassed,
+            "expired": self.expired,
+            "evicted": self.evicted,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
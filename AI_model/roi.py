@@ -0,0 +1,201 @@
+import json
+import math
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from postprocess import boxes_to_numpy
+
+# ==============================================================================
+# VÙNG QUAN TÂM (ROI) THEO CAMERA: CHỈ CHẠY MODEL TRÊN VÙNG CẦN GIÁM SÁT
+# ==============================================================================
+# Mỗi camera có thể khai báo các vùng đa giác (lối đi, cổng...). Thay vì predict
+# cả frame:
+# - Cắt hình chữ nhật bao của từng vùng (+ lề), các vùng chồng nhau được gộp
+#   thành 1 crop để không detect trùng
+# - Mọi crop (của 1 hoặc nhiều frame) chạy trong 1 lần predict, imgsz được thu
+#   theo tỷ lệ crop / frame -> cùng độ phân giải như khi chạy cả frame nhưng ít
+#   pixel hơn, chi phí giảm gần theo phần diện tích không giám sát
+# - Box được cộng lại toạ độ gốc của crop, box có điểm neo (tâm / đáy giữa) nằm
+#   ngoài mọi đa giác bị bỏ trước khi phân loại SAFE / VIOLATION và lưu audit
+#
+# File cấu hình (ROI_CONFIG), key là id camera / nguồn, "*" áp cho nguồn không có key:
+#   {
+#     "camera-0": {"size": [1280, 720], "zones": [
+#         {"name": "cong-chinh", "polygon": [[400, 200], [900, 200], [900, 720], [400, 720]]}]},
+#     "*": [{"name": "loi-di", "polygon": [[0.1, 0.3], [0.6, 0.3], [0.6, 1.0], [0.1, 1.0]]}]
+#   }
+# Toạ độ pixel cần "size" (kích thước frame lúc vẽ vùng); toạ độ trong [0, 1] là tỷ lệ.
+
+ANCHORS = ("center", "bottom")
+# Số kích thước frame giữ layout (crop + mask); kích thước do client gửi lên
+# (/detect) là tuỳ ý nên phải giới hạn, LRU bỏ kích thước lâu không dùng
+LAYOUT_CACHE_SIZE = 4
+
+
+def _empty():
+    return (np.zeros((0, 4), dtype=np.float32), np.zeros(0, dtype=np.float32),
+            np.zeros(0, dtype=np.int64))
+
+
+def _merge_rects(rects):
+    """Gộp các hình chữ nhật chồng nhau cho tới khi không còn cặp nào chồng."""
+    rects = list(rects)
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(rects)):
+            for j in range(i + 1, len(rects)):
+                a, b = rects[i], rects[j]
+                if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                    rects[i] = (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+                    del rects[j]
+                    merged = True
+                    break
+            if merged:
+                break
+    return rects
+
+
+class RegionSet:
+    def __init__(self, zones, size=None, margin=0.02, anchor="center"):
+        if anchor not in ANCHORS:
+            raise ValueError(f"anchor phải là một trong {ANCHORS}")
+        self.names = []
+        self.polygons = []   # toạ độ tỷ lệ [0, 1]
+        for i, zone in enumerate(zones):
+            pts = np.asarray(zone["polygon"], dtype=np.float64)
+            if pts.ndim != 2 or pts.shape[1] != 2 or len(pts) < 3:
+                raise ValueError(f"Vùng {zone.get('name', i)}: polygon cần >= 3 điểm [x, y]")
+            if pts.max() > 1.0:
+                if size is None:
+                    raise ValueError(f"Vùng {zone.get('name', i)} dùng toạ độ pixel, cần khai báo size")
+                pts = pts / np.asarray(size, dtype=np.float64)
+            self.names.append(str(zone.get("name", f"zone-{i}")))
+            self.polygons.append(np.clip(pts, 0.0, 1.0))
+        self.margin = margin
+        self.anchor = anchor
+        self._layouts = OrderedDict()   # (cao, rộng) -> (crops, mask), LRU
+        # RegionSet "*" dùng chung cho nhiều nguồn / thread
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, cfg):
+        """cfg: list vùng, hoặc dict {"zones", "size", "margin", "anchor"}."""
+        if isinstance(cfg, list):
+            return cls(cfg)
+        return cls(cfg["zones"], size=cfg.get("size"), margin=cfg.get("margin", 0.02),
+                   anchor=cfg.get("anchor", "center"))
+
+    def layout(self, shape):
+        """(list crop (x1, y1, x2, y2), mask uint8 của các đa giác) cho frame kích thước shape."""
+        h, w = shape[:2]
+        with self._lock:
+            cached = self._layouts.get((h, w))
+            if cached is not None:
+                self._layouts.move_to_end((h, w))
+                return cached
+        mask = np.zeros((h, w), dtype=np.uint8)
+        rects = []
+        pad_x, pad_y = int(self.margin * w), int(self.margin * h)
+        for poly in self.polygons:
+            pts = np.round(poly * (w - 1, h - 1)).astype(np.int32)
+            cv2.fillPoly(mask, [pts], 1)
+            x1, y1 = pts.min(axis=0)
+            x2, y2 = pts.max(axis=0) + 1
+            rects.append((max(0, x1 - pad_x), max(0, y1 - pad_y), min(w, x2 + pad_x), min(h, y2 + pad_y)))
+        layout = ([tuple(int(v) for v in r) for r in _merge_rects(rects)], mask)
+        with self._lock:
+            self._layouts[(h, w)] = layout
+            while len(self._layouts) > LAYOUT_CACHE_SIZE:
+                self._layouts.popitem(last=False)
+        return layout
+
+    def coverage(self, shape):
+        """Tỷ lệ diện tích frame được đưa vào model."""
+        crops, _ = self.layout(shape)
+        return sum((x2 - x1) * (y2 - y1) for x1, y1, x2, y2 in crops) / float(shape[0] * shape[1])
+
+    def crops(self, img):
+        """List (view ảnh crop, (x1, y1)) — view không copy."""
+        crops, _ = self.layout(img.shape)
+        return [(img[y1:y2, x1:x2], (x1, y1)) for x1, y1, x2, y2 in crops]
+
+    def keep(self, xyxy, shape):
+        """Mask bool: box có điểm neo nằm trong ít nhất 1 đa giác."""
+        if len(xyxy) == 0:
+            return np.zeros(0, dtype=bool)
+        _, mask = self.layout(shape)
+        h, w = mask.shape
+        cx = (xyxy[:, 0] + xyxy[:, 2]) / 2
+        cy = (xyxy[:, 1] + xyxy[:, 3]) / 2 if self.anchor == "center" else xyxy[:, 3] - 1
+        xs = np.clip(cx.astype(np.int64), 0, w - 1)
+        ys = np.clip(cy.astype(np.int64), 0, h - 1)
+        return mask[ys, xs].astype(bool)
+
+
+def crop_imgsz(jobs, imgsz):
+    """
+    imgsz cho lần predict các crop: giữ cùng tỷ lệ thu nhỏ như khi chạy cả frame
+    ở imgsz (crop lớn nhất quyết định), làm tròn lên bội 32.
+    """
+    size = 32
+    for img, regions in jobs:
+        scale = imgsz / max(img.shape[:2])
+        for x1, y1, x2, y2 in regions.layout(img.shape)[0]:
+            size = max(size, math.ceil(max(x2 - x1, y2 - y1) * scale / 32) * 32)
+    return min(size, imgsz)
+
+
+def predict_regions(model, jobs, imgsz=640, **predict_kwargs):
+    """
+    jobs: list (ảnh, RegionSet). Chạy 1 lần predict cho mọi crop của mọi ảnh,
+    trả về list (xyxy, conf, cls) NumPy theo toạ độ ảnh, đã bỏ box ngoài vùng.
+    """
+    crops, owners = [], []
+    for i, (img, regions) in enumerate(jobs):
+        for view, offset in regions.crops(img):
+            crops.append(view)
+            owners.append((i, offset))
+    if not crops:
+        return [_empty() for _ in jobs]
+
+    results = model.predict(crops, imgsz=crop_imgsz(jobs, imgsz), **predict_kwargs)
+    parts = [[] for _ in jobs]
+    for (i, (x, y)), result in zip(owners, results):
+        xyxy, conf, cls = boxes_to_numpy(result)
+        if len(conf):
+            xyxy = xyxy + np.array([x, y, x, y], dtype=xyxy.dtype)
+            parts[i].append((xyxy, conf, cls))
+
+    out = []
+    for (img, regions), found in zip(jobs, parts):
+        if not found:
+            out.append(_empty())
+            continue
+        xyxy = np.concatenate([p[0] for p in found])
+        conf = np.concatenate([p[1] for p in found])
+        cls = np.concatenate([p[2] for p in found])
+        keep = regions.keep(xyxy, img.shape)
+        out.append((xyxy[keep], conf[keep], cls[keep]))
+    return out
+
+
+def load_roi_config(path):
+    """Đọc file ROI_CONFIG -> {key: RegionSet}. path rỗng -> {}."""
+    if not path:
+        return {}
+    with open(Path(path), encoding="utf-8") as f:
+        data = json.load(f)
+    regions = {str(key): RegionSet.from_config(cfg) for key, cfg in data.items()}
+    for key, r in regions.items():
+        print(f"🎯 ROI {key}: {', '.join(r.names)}")
+    return regions
+
+
+def regions_for(config, key):
+    """RegionSet của nguồn key (hoặc của "*"), None = cả frame."""
+    return config.get(str(key), config.get("*"))
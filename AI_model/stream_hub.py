@@ -0,0 +1,372 @@
+import json
+import threading
+import time
+from collections import namedtuple
+
+from aiortc import VideoStreamTrack
+from av import VideoFrame
+
+from inference_worker import LatestFrameWorker
+from metrics import register_collector, stage_timer
+from yuv_frame import YuvFrame, draw_frame
+
+# ==============================================================================
+# FAN-OUT: 1 NGUỒN -> 1 LẦN CAPTURE + INFERENCE -> N NGƯỜI XEM
+# ==============================================================================
+# - FrameProducer: thread đọc frame từ nguồn, đẩy vào LatestFrameWorker để
+#   detect + vẽ đúng 1 lần, giữ lại frame đã xử lý mới nhất.
+# - StreamHub: quản lý producer theo key (camera id, url...) có đếm tham chiếu.
+#   Người xem đầu tiên -> start, người xem cuối cùng rời đi -> stop.
+# - HubVideoTrack: track WebRTC của từng người xem, chỉ đọc frame mới nhất
+#   của producer nên chi phí mỗi người xem gần như bằng 0.
+# StreamHub(name=...) đăng ký metrics: số người xem, frame đã xử lý / bị bỏ
+# theo từng nguồn; HubVideoTrack đo bước to_video_frame.
+#
+# Chế độ detections-only: HubVideoTrack có data channel -> nhận video gốc (không
+# vẽ) + mỗi frame 1 message JSON gọn qua channel, client tự vẽ overlay.
+# FrameProducer.annotate() chỉ làm phần việc mà người xem đang cần:
+# - chỉ có người xem overlay: vẽ thẳng lên frame như cũ
+# - chỉ có người xem detections: không vẽ, không copy
+# - cả hai: vẽ lên 1 bản copy cho người xem overlay
+# Message được encode 1 lần mỗi frame và dùng chung cho mọi người xem, mỗi
+# người chỉ ghép thêm pts của frame video mình vừa nhận:
+#   {"pts": 1234, "frame": 57, "w": 1280, "h": 720, "state": "VIOLATION",
+#    "boxes": [[x1, y1, x2, y2, conf, "no-helmet", 1, track_id], ...]}
+# Client bật chế độ này bằng "mode": "detections" trong body của /offer, và phải
+# tạo sẵn data channel thoả thuận trước createOffer (để SDP có m=application):
+#   pc.createDataChannel("detections", {negotiated: true, id: 0, ordered: false, maxRetransmits: 0})
+#
+# Producer có thread capture đã thoát (open / read lỗi, video hết) bị đánh dấu
+# dead: acquire() của người xem mới, hoặc recv() của người đang xem (sau backoff
+# tăng dần) thay bằng producer mới. Producer mới chờ producer cũ nhả thiết bị
+# ngay trên thread capture của nó, không bao giờ chờ trên event loop.
+#
+# FrameProducer.quality (QualityController, tuỳ chọn): annotate() báo thời gian
+# xử lý mỗi frame cho controller, controller gọi lại producer.apply_quality().
+
+DETECTION_CHANNEL_ID = 0
+# Thời gian tối đa chờ thread capture thoát khi dừng producer (read() có thể đang block)
+STOP_JOIN_TIMEOUT = 5.0
+# Backoff mở lại nguồn chết từ recv(): 1s, 2s, 4s... tối đa REVIVE_MAX_DELAY_S
+REVIVE_MAX_DELAY_S = 30.0
+
+# Kết quả của annotate(): drawn cho người xem overlay (None nếu không ai cần),
+# raw là frame không vẽ, message là phần JSON detection đã encode sẵn.
+AnnotatedFrame = namedtuple("AnnotatedFrame", ["drawn", "raw", "seq", "message"])
+
+
+def detection_message(seq, img, dets, names):
+    """Phần thân (không có ngoặc và pts) của message detection, encode 1 lần mỗi frame."""
+    body = json.dumps({"frame": seq, "w": img.shape[1], "h": img.shape[0], "state": dets.state,
+                       "boxes": dets.to_compact(names)}, separators=(",", ":"), ensure_ascii=False)
+    return body[1:-1]
+
+
+def open_detection_channel(pc, params):
+    """Mở data channel detections nếu body /offer có "mode": "detections", ngược lại None."""
+    if params.get("mode") != "detections":
+        return None
+    # Không gửi lại: message của frame cũ vô nghĩa khi frame sau đã tới
+    return pc.createDataChannel("detections", negotiated=True, id=DETECTION_CHANNEL_ID,
+                                ordered=False, maxRetransmits=0)
+
+
+class FrameProducer:
+    """Lớp cơ sở. Lớp con cài đặt open() / read() / close()."""
+
+    def __init__(self, key, process_fn, pipeline=None):
+        self.key = key
+        self.process_fn = process_fn
+        # HelmetFramePipeline của nguồn (None nếu AI chạy ở nơi khác, vd. supervisor)
+        self.pipeline = pipeline
+        self.worker = None
+        self.quality = None
+        self.overlay_viewers = 0
+        self.detection_viewers = 0
+        self._seq = 0
+        self._raw = None
+        self._running = False
+        self._thread = None
+        # Thread capture đã thoát (lỗi / hết nguồn) -> StreamHub thay producer mới
+        self.dead = False
+        self.died_at = None
+        # Số lần mở lại liên tiếp chưa đọc được frame nào (backoff của StreamHub)
+        self.restarts = 0
+        self._previous = None
+
+    def open(self):
+        pass
+
+    def read(self):
+        """Đọc 1 frame (được phép block). Trả về None nếu tạm thời chưa có."""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def apply_quality(self, settings):
+        """Áp mức chất lượng (imgsz, detect_every, capture); lớp con bổ sung phần capture."""
+        if self.pipeline is not None:
+            self.pipeline.apply_quality(settings)
+
+    def annotate(self, pipeline, img):
+        """Chạy pipeline trên img (thread inference), chỉ vẽ / copy khi có người xem cần."""
+        t0 = time.perf_counter()
+        out = self._annotate(pipeline, img)
+        if self.quality is not None:
+            self.quality.observe(time.perf_counter() - t0)
+        return out
+
+    def _annotate(self, pipeline, img):
+        if not self.detection_viewers:
+            return pipeline.process(img)
+        pipeline.process(img, draw=False)
+        dets = pipeline.last_detections
+        drawn = None
+        if self.overlay_viewers:
+            with stage_timer(pipeline.metrics_name, "draw"):
+                drawn = draw_frame(img.copy(), dets)
+        self._seq += 1
+        return AnnotatedFrame(drawn, img, self._seq,
+                              detection_message(self._seq, img, dets, pipeline.model.names))
+
+    def start(self, previous=None):
+        """previous: producer cũ của cùng nguồn, thread capture dừng nó trước khi open()."""
+        self._previous = previous
+        self.worker = LatestFrameWorker(self.process_fn, name=f"ai-{self.key}")
+        self._running = True
+        self._thread = threading.Thread(target=self._capture_loop, name=f"capture-{self.key}", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Dừng capture + worker, chờ thread capture đóng nguồn (không gọi khi giữ lock của hub)."""
+        self._running = False
+        if self.worker is not None:
+            self.worker.stop()
+        if self.quality is not None:
+            # producer -> controller -> apply_quality là vòng tham chiếu: gỡ ngay
+            # khỏi metrics thay vì chờ GC
+            self.quality.close()
+        self.join()
+
+    def join(self, timeout=STOP_JOIN_TIMEOUT):
+        """Chờ thread capture thoát (đã close() nguồn)."""
+        thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(timeout)
+            if thread.is_alive():
+                print(f"⚠️ Thread capture {self.key} chưa thoát sau {timeout}s")
+
+    def latest(self):
+        """Frame đã xử lý mới nhất, hoặc frame gốc nếu AI chưa xử lý xong frame nào."""
+        if self.worker is not None:
+            result = self.worker.latest()
+            if result is not None:
+                return result
+        return self._raw
+
+    def _capture_loop(self):
+        if self._previous is not None:
+            # Producer cũ có thể còn giữ thiết bị (vd. cv2.VideoCapture) -> chờ nó đóng
+            self._previous.stop()
+            self._previous = None
+        try:
+            self.open()
+            while self._running:
+                frame = self.read()
+                if frame is None:
+                    continue
+                self._raw = frame
+                self.restarts = 0
+                self.worker.submit(frame)
+        except Exception as e:
+            print(f"❌ Lỗi nguồn {self.key}: {e}")
+        finally:
+            self.close()
+            self.died_at = time.monotonic()
+            self.dead = True
+
+
+class StreamHub:
+    def __init__(self, producer_factory, name="stream"):
+        self.producer_factory = producer_factory
+        self.name = name
+        self._producers = {}
+        self._refs = {}
+        # Producer vừa bị release, đang chờ thread capture đóng thiết bị
+        self._stopping = {}
+        self._lock = threading.Lock()
+        register_collector(self.collect_metrics)
+
+    def acquire(self, key, overlay=True):
+        """
+        overlay=False: người xem nhận video gốc + detection qua data channel.
+        Không block: producer cũ đang dừng / đã chết được chờ trên thread capture mới.
+        """
+        with self._lock:
+            producer = self._producers.get(key)
+            if producer is not None and producer.dead:
+                producer = self._replace(key, producer)
+            elif producer is None:
+                producer = self.producer_factory(key)
+                # Người xem cuối vừa rời đi: producer mới chờ producer cũ nhả thiết bị
+                producer.start(previous=self._stopping.get(key))
+                self._producers[key] = producer
+                self._refs[key] = 0
+                print(f"▶️ Khởi động nguồn: {key}")
+            self._refs[key] += 1
+            if overlay:
+                producer.overlay_viewers += 1
+            else:
+                producer.detection_viewers += 1
+            return producer
+
+    def _replace(self, key, dead):
+        """(giữ lock) Thay producer đã chết, chuyển số người xem sang producer mới."""
+        producer = self.producer_factory(key)
+        producer.overlay_viewers = dead.overlay_viewers
+        producer.detection_viewers = dead.detection_viewers
+        producer.restarts = dead.restarts + 1
+        producer.start(previous=dead)
+        self._producers[key] = producer
+        print(f"🔄 Mở lại nguồn đã dừng: {key} (lần {producer.restarts})")
+        return producer
+
+    def revive(self, key, dead):
+        """
+        Gọi từ recv() khi producer của người xem đã chết: trả về producer hiện tại,
+        thay producer mới nếu đã qua thời gian backoff (không chờ, không block).
+        """
+        with self._lock:
+            producer = self._producers.get(key)
+            if producer is not dead:
+                return producer or dead
+            delay = min(REVIVE_MAX_DELAY_S, 2.0 ** dead.restarts)
+            if time.monotonic() - dead.died_at < delay:
+                return dead
+            return self._replace(key, dead)
+
+    def get(self, key):
+        """Producer hiện tại của key (None nếu không chạy)."""
+        with self._lock:
+            return self._producers.get(key)
+
+    def release(self, key, overlay=True):
+        with self._lock:
+            if key not in self._refs:
+                return
+            self._refs[key] -= 1
+            producer = self._producers[key]
+            if overlay:
+                producer.overlay_viewers -= 1
+            else:
+                producer.detection_viewers -= 1
+            if self._refs[key] > 0:
+                return
+            self._producers.pop(key)
+            del self._refs[key]
+            self._stopping[key] = producer
+        # release() được gọi từ event loop -> chờ thread capture đóng thiết bị
+        # trên thread riêng, ngoài lock (acquire của key khác không bị chặn)
+        threading.Thread(target=self._stop_producer, args=(key, producer),
+                         name=f"stop-{key}", daemon=True).start()
+
+    def _stop_producer(self, key, producer):
+        producer.stop()
+        with self._lock:
+            if self._stopping.get(key) is producer:
+                del self._stopping[key]
+        print(f"⏹️ Dừng nguồn (không còn người xem): {key}")
+
+    def producers(self):
+        """Bản sao {key: producer} của các nguồn đang chạy."""
+        with self._lock:
+            return dict(self._producers)
+
+    def viewers(self, key):
+        with self._lock:
+            return self._refs.get(key, 0)
+
+    def collect_metrics(self):
+        with self._lock:
+            items = [(producer, self._refs.get(key, 0)) for key, producer in self._producers.items()]
+        viewers, detection_viewers, processed, dropped, errors = [], [], [], [], []
+        for producer, refs in items:
+            labels = {"hub": self.name, "source": producer.key}
+            viewers.append((labels, refs))
+            detection_viewers.append((labels, producer.detection_viewers))
+            worker = producer.worker
+            if worker is not None:
+                processed.append((labels, worker.processed))
+                dropped.append((labels, worker.dropped))
+                errors.append((labels, worker.errors))
+        return [
+            ("helmet_hub_sources", "gauge", "Số nguồn đang chạy", [({"hub": self.name}, len(items))]),
+            ("helmet_stream_viewers", "gauge", "Số người xem theo nguồn", viewers),
+            ("helmet_detection_viewers", "gauge",
+             "Số người xem chế độ detections-only (tự vẽ overlay)", detection_viewers),
+            ("helmet_frames_processed_total", "counter", "Số frame AI đã xử lý", processed),
+            ("helmet_frames_dropped_total", "counter",
+             "Số frame bị bỏ vì AI chưa xử lý xong frame trước", dropped),
+            ("helmet_worker_errors_total", "counter", "Số lỗi của inference worker", errors),
+        ]
+
+
+class HubVideoTrack(VideoStreamTrack):
+    def __init__(self, hub, key, channel=None):
+        """channel: RTCDataChannel -> chế độ detections-only (video gốc + message detection)."""
+        super().__init__()
+        self.hub = hub
+        self.key = key
+        self.channel = channel
+        self.producer = hub.acquire(key, overlay=channel is None)
+        self._released = False
+        self._sent_seq = 0
+
+    def send_detections(self, item, pts):
+        """Gửi message detection của frame vừa phát (mỗi frame đã xử lý gửi 1 lần)."""
+        if item.seq == self._sent_seq or self.channel.readyState != "open":
+            return
+        self._sent_seq = item.seq
+        self.channel.send(f'{{"pts":{pts},{item.message}}}')
+
+    def to_video_frame(self, item):
+        """Chuyển frame của producer sang VideoFrame (ndarray BGR mặc định)."""
+        if isinstance(item, AnnotatedFrame):
+            # Người xem overlay vừa vào khi frame này chưa có bản vẽ -> tạm dùng frame gốc
+            item = item.raw if self.channel is not None or item.drawn is None else item.drawn
+        if isinstance(item, YuvFrame):
+            # Đường YUV: 1 lần memcpy, encoder nhận thẳng yuv420p (không đổi màu)
+            return VideoFrame.from_ndarray(item.buf, format="yuv420p")
+        if isinstance(item, VideoFrame):
+            # Frame gốc của nguồn PyAV (trước khi AI xử lý xong frame đầu tiên).
+            # Không trả thẳng object dùng chung vì mỗi người xem gán pts riêng.
+            item = item.to_ndarray(format="bgr24")
+        return VideoFrame.from_ndarray(item, format="bgr24")
+
+    async def recv(self):
+        pts, time_base = await self.next_timestamp()
+        if self.producer.dead:
+            # Nguồn chết: chuyển sang producer thay thế (hub mở lại sau backoff)
+            self.producer = self.hub.revive(self.key, self.producer)
+        item = self.producer.latest()
+        while item is None:
+            # Nguồn chưa có frame đầu tiên
+            pts, time_base = await self.next_timestamp()
+            if self.producer.dead:
+                self.producer = self.hub.revive(self.key, self.producer)
+            item = self.producer.latest()
+
+        with stage_timer(self.hub.name, "to_video_frame"):
+            new_frame = self.to_video_frame(item)
+        new_frame.pts = pts
+        new_frame.time_base = time_base
+        if self.channel is not None and isinstance(item, AnnotatedFrame):
+            self.send_detections(item, pts)
+        return new_frame
+
+    def stop(self):
+        if not self._released:
+            self._released = True
+            self.hub.release(self.key, overlay=self.channel is None)
+        super().stop()
@@ -192,22 +192,33 @@
 #     web.run_app(app, host="0.0.0.0", port=8080)
 import asyncio
 import os
+import time
 import cv2
 import numpy as np
 from pathlib import Path
-from datetime import datetime
-import time
 
 from aiohttp import web
 from aiohttp.web import Request, Response
-from aiortc import RTCPeerConnection, RTCSessionDescription, VideoStreamTrack
-from av import VideoFrame
-from ultralytics import YOLO
+from aiortc import RTCPeerConnection, RTCSessionDescription
+
+import metrics
+from audit_writer import get_audit_writer, start_audit_retention
+from camera_supervisor import CameraSupervisor, load_sources
+from frame_pipeline import HelmetFramePipeline
+from model_registry import registry, get_model
+from motion_gate import MotionGate
+from quality_controller import QualityController, default_levels
+from roi import load_roi_config, regions_for
+from stream_hub import FrameProducer, StreamHub, HubVideoTrack, open_detection_channel
 
 # ==============================================================================
 # 1. CẤU HÌNH
 # ==============================================================================
 CAMERA_ID = 0
+# Index thiết bị người xem được phép chọn qua trường "camera" (ngoài CAMERA_ID),
+# vd. CAMERA_IDS=0,1,2. Giá trị khác bị từ chối (không mở file / URL tuỳ ý từ client).
+CAMERA_IDS = sorted({CAMERA_ID, *(int(x) for x in os.getenv("CAMERA_IDS", "").split(",") if x.strip())})
+CAPTURE_SIZE = (640, 480)   # (rộng, cao) mặc định của camera, QualityController hạ khi quá tải
 MODEL_PATH = Path(r"./best.pt")
 PATH_HELMET = Path(r"./2_Detect_Helmet")
 PATH_NO_HELMET = Path(r"./3_Detect_No_Helmet")
@@ -217,81 +228,127 @@ CONF_VIOLATION = 0.4
 CONF_SAFE = 0.5
 IOU_THRESHOLD = 0.45
 
+# Backend inference: torch / onnx / onnx-int8 / openvino / openvino-int8 (xem backends.py)
+INFER_BACKEND = os.getenv("INFER_BACKEND", "torch")
+
 KW_UNSAFE = ['no-helmet', 'head', 'face', 'person', 'no_helmet']
 KW_SAFE = ['helmet', 'hardhat', 'safety-cap']
 
+# Chạy YOLO mỗi N frame, frame giữa dùng tracker (1 = chạy mọi frame như cũ).
+# SCENE_CHANGE_THRESHOLD: cảnh thay đổi mạnh (0..255) thì detect ngay, None = tắt
+DETECT_EVERY_N = int(os.getenv("DETECT_EVERY_N", "1"))
+SCENE_CHANGE_THRESHOLD = float(os.getenv("SCENE_CHANGE_THRESHOLD")) if os.getenv("SCENE_CHANGE_THRESHOLD") else None
+
+# Motion gate: camera nhìn cảnh trống thì bỏ qua YOLO, dùng lại kết quả cũ
+MOTION_GATE = os.getenv("MOTION_GATE", "1") == "1"
+MOTION_PIXEL_THRESHOLD = 25    # Độ nhạy: chênh lệch mức xám của 1 pixel (0..255)
+MOTION_AREA_RATIO = 0.002      # Tỷ lệ diện tích thay đổi để coi là có chuyển động
+MOTION_MAX_SKIP = 150          # Tối đa số frame liên tiếp được bỏ qua (~5s ở 30fps)
+
+# Giữ FPS mục tiêu khi nhiều người xem / camera: giảm imgsz, tăng bước detect rồi
+# giảm độ phân giải capture theo thời gian xử lý đo được, nâng lại khi dư tải
+# (quality_controller.py). Mặc định tắt (0): mức thấp làm ảnh audit kém đi, chỉ bật khi cần, vd. 15.
+QUALITY_TARGET_FPS = float(os.getenv("QUALITY_TARGET_FPS", "0"))
+MODEL_IMGSZ = 640
+
+# Vùng quan tâm theo camera (roi.py): ROI_CONFIG=roi.json, key "camera-<id>" hoặc "*".
+# Chỉ predict các crop quanh vùng, box ngoài vùng bị bỏ. Không đặt -> cả frame.
+ROI = load_roi_config(os.getenv("ROI_CONFIG"))
+
+# Nhiều camera: CAMERA_CONFIG=cameras.json (danh sách nguồn, xem camera_supervisor.py)
+# -> capture + inference chạy trên các process riêng, INFER_WORKERS = số process
+# inference (mặc định: số core - 1). Không đặt -> 1 camera CAMERA_ID như cũ.
+CAMERA_CONFIG = os.getenv("CAMERA_CONFIG")
+INFER_WORKERS = int(os.getenv("INFER_WORKERS", "0")) or None
+
 for p in [PATH_HELMET, PATH_NO_HELMET]:
     p.mkdir(parents=True, exist_ok=True)
 
 # Load Model
-print("⏳ Đang tải model YOLOv8...")
-try:
-    model = YOLO(str(MODEL_PATH)) if MODEL_PATH.exists() else YOLO("yolov8n.pt")
-    print("✅ Model đã tải xong.")
-except Exception as e:
-    print(f"❌ Lỗi tải model: {e}")
-    exit()
+# Model load lazy qua registry (lỗi load được báo ra, không exit() lúc import)
+registry.register("default", MODEL_PATH, backend=INFER_BACKEND, fallback="yolov8n.pt")
 
 # ==============================================================================
-# 2. CAMERA TRACK
+# 2. CAMERA PRODUCER + TRACK
 # ==============================================================================
-class CameraAITrack(VideoStreamTrack):
-    def __init__(self):
-        super().__init__()
-        self.cap = cv2.VideoCapture(CAMERA_ID)
-        self.frame_cnt = 0
-        self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, 640)
-        self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 480)
-
-    async def recv(self):
-        pts, time_base = await self.next_timestamp()
-        ret, frame = self.cap.read()
+class CameraProducer(FrameProducer):
+    """1 producer cho mỗi camera: mở thiết bị 1 lần, detect 1 lần, phát cho mọi người xem."""
+    def __init__(self, camera_id):
+        pipeline = HelmetFramePipeline(
+            get_model(), CONF_VIOLATION, CONF_SAFE, IOU_THRESHOLD, KW_UNSAFE, KW_SAFE,
+            SAVE_FRAME_INTERVAL, PATH_HELMET, PATH_NO_HELMET, prefix="Cam", alert_tag="CAM",
+            detect_every=DETECT_EVERY_N, scene_change_threshold=SCENE_CHANGE_THRESHOLD,
+            motion_gate=MotionGate(MOTION_PIXEL_THRESHOLD, MOTION_AREA_RATIO, MOTION_MAX_SKIP) if MOTION_GATE else None,
+            metrics_name="camera", source=f"camera-{camera_id}", imgsz=MODEL_IMGSZ,
+            roi=regions_for(ROI, f"camera-{camera_id}"),
+        )
+        super().__init__(f"camera-{camera_id}", self._process, pipeline)
+        self.camera_id = camera_id
+        self.cap = None
+        # Độ phân giải mong muốn; thread capture áp vào camera khi thay đổi
+        self.capture_size = CAPTURE_SIZE
+        self._applied_size = None
+        if QUALITY_TARGET_FPS > 0:
+            self.quality = QualityController(self.key, QUALITY_TARGET_FPS,
+                                             default_levels(MODEL_IMGSZ, DETECT_EVERY_N, CAPTURE_SIZE),
+                                             self.apply_quality)
+
+    def apply_quality(self, settings):
+        super().apply_quality(settings)
+        if settings["capture"] is not None:
+            self.capture_size = settings["capture"]
+
+    def _process(self, frame):
+        return self.annotate(self.pipeline, frame)
+
+    def open(self):
+        print(f"📷 Mở camera {self.camera_id}...")
+        self.cap = cv2.VideoCapture(self.camera_id)
+        self._apply_capture_size()
+
+    def _apply_capture_size(self):
+        width, height = self.capture_size
+        self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, width)
+        self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
+        self._applied_size = self.capture_size
+
+    def read(self):
+        if self.capture_size != self._applied_size:
+            self._apply_capture_size()
+        with metrics.stage_timer("camera", "capture"):
+            ret, frame = self.cap.read()
         if not ret:
-            frame = np.zeros((480, 640, 3), dtype=np.uint8)
-
-        self.frame_cnt += 1
-        results = model.predict(frame, conf=CONF_VIOLATION, iou=IOU_THRESHOLD, verbose=False)
-
-        has_violation = False
-        has_safe = False
-
-        for result in results:
-            for box in result.boxes:
-                cls_id = int(box.cls[0])
-                cls_name = model.names[cls_id].lower().replace("_", "-") if model.names else "unknown"
-                conf = float(box.conf[0])
-                x1, y1, x2, y2 = map(int, box.xyxy[0])
-
-                if any(k in cls_name for k in KW_UNSAFE) and conf >= CONF_VIOLATION:
-                    has_violation = True
-                    cv2.rectangle(frame, (x1, y1), (x2, y2), (0, 0, 255), 2)
-                    cv2.putText(frame, f"VIOLATION {conf:.2f}", (x1, y1 - 10),
-                                cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 0, 255), 2)
-                elif any(k in cls_name for k in KW_SAFE) and conf >= CONF_SAFE:
-                    if not has_violation:
-                        has_safe = True
-                    cv2.rectangle(frame, (x1, y1), (x2, y2), (0, 255, 0), 2)
-                    cv2.putText(frame, f"SAFE {conf:.2f}", (x1, y1 - 10),
-                                cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 255, 0), 2)
-
-        if self.frame_cnt % SAVE_FRAME_INTERVAL == 0:
-            time_str = datetime.now().strftime("%Y%m%d_%H%M%S")
-            img_name = f"Cam_{time_str}_{self.frame_cnt}.jpg"
-            if has_violation:
-                cv2.imwrite(str(PATH_NO_HELMET / img_name), frame)
-                print(f"❌ [CAM] Lưu ảnh vi phạm: {img_name}")
-            elif has_safe:
-                cv2.imwrite(str(PATH_HELMET / img_name), frame)
-
-        new_frame = VideoFrame.from_ndarray(frame, format="bgr24")
-        new_frame.pts = pts
-        new_frame.time_base = time_base
-        return new_frame
+            # Camera bị rút / lỗi -> màn hình đen, tránh vòng lặp quay tít
+            time.sleep(0.03)
+            frame = np.zeros((self.capture_size[1], self.capture_size[0], 3), dtype=np.uint8)
+        return frame
 
-    def stop(self):
-        if self.cap.isOpened():
+    def close(self):
+        if self.cap is not None and self.cap.isOpened():
             self.cap.release()
 
+supervisor = None   # CameraSupervisor, tạo ở on_startup khi có CAMERA_CONFIG
+
+class SupervisedProducer(FrameProducer):
+    """Nguồn do supervisor chạy sẵn (capture + AI ở process khác), chỉ đọc frame mới nhất."""
+    def __init__(self, source_id):
+        super().__init__(source_id, None)
+
+    def start(self, previous=None):
+        pass
+
+    def stop(self):
+        pass
+
+    def latest(self):
+        return supervisor.latest(self.key)
+
+camera_hub = StreamHub(SupervisedProducer if CAMERA_CONFIG else CameraProducer, name="camera")
+
+class CameraAITrack(HubVideoTrack):
+    def __init__(self, camera_id=CAMERA_ID, channel=None):
+        super().__init__(camera_hub, camera_id, channel=channel)
+
 # ==============================================================================
 # 3. CORS MIDDLEWARE (CRITICAL FIX)
 # ==============================================================================
@@ -321,17 +378,35 @@ async def offer(request):
     params = await request.json()
     offer = RTCSessionDescription(sdp=params["sdp"], type=params["type"])
 
+    # Chọn camera qua trường "camera" trong body (mặc định CAMERA_ID / nguồn đầu tiên)
+    if supervisor is not None:
+        camera_id = str(params.get("camera", supervisor.source_ids()[0]))
+        if camera_id not in supervisor.source_ids():
+            return web.Response(status=404, text=f"Không có camera {camera_id}")
+    else:
+        try:
+            camera_id = int(params.get("camera", CAMERA_ID))
+        except (TypeError, ValueError):
+            camera_id = None
+        if camera_id not in CAMERA_IDS:
+            return web.Response(status=404, text=f"Không có camera {params.get('camera')}")
+    if supervisor is not None and params.get("mode") == "detections":
+        # Frame đã được vẽ sẵn trong process inference, chưa có đường gửi detection về
+        return web.Response(status=400, text="Chế độ detections chưa hỗ trợ khi chạy CAMERA_CONFIG")
+
     pc = RTCPeerConnection()
     pcs.add(pc)
 
-    video_track = CameraAITrack()
+    # "mode": "detections" -> video gốc + detection qua data channel (client tự vẽ)
+    video_track = CameraAITrack(camera_id, channel=open_detection_channel(pc, params))
     pc.addTrack(video_track)
 
     @pc.on("iceconnectionstatechange")
     async def on_iceconnectionstatechange():
-        if pc.iceConnectionState == "failed":
+        if pc.iceConnectionState in ("failed", "closed"):
             await pc.close()
             pcs.discard(pc)
+            # Trả lại camera cho hub (người xem cuối cùng -> tắt camera)
             video_track.stop()
 
     await pc.setRemoteDescription(offer)
@@ -343,6 +418,86 @@ async def offer(request):
         "type": pc.localDescription.type
     })
 
+async def stats(request):
+    """Thống kê từng camera: số người xem, tỷ lệ frame được motion gate bỏ qua."""
+    cameras = {}
+    for key, producer in camera_hub.producers().items():
+        if producer.pipeline is None:
+            cameras[str(key)] = {"viewers": camera_hub.viewers(key)}
+            continue
+        gate = producer.pipeline.motion_gate
+        cameras[str(key)] = {
+            "viewers": camera_hub.viewers(key),
+            "detector_runs": producer.pipeline.detector_runs,
+            "motion_gate": gate.stats() if gate is not None else None,
+            "quality": producer.quality.stats() if producer.quality is not None else None,
+        }
+    return web.json_response({
+        "cameras": cameras,
+        "model": registry.stats(),
+        "supervisor": supervisor.stats() if supervisor is not None else None,
+    })
+
+@metrics.register_collector
+def collect_camera_metrics():
+    skipped = []
+    for producer in camera_hub.producers().values():
+        gate = producer.pipeline.motion_gate if producer.pipeline is not None else None
+        if gate is not None:
+            skipped.append(({"source": producer.key}, gate.skipped))
+    return [
+        ("helmet_peer_connections", "gauge", "Số RTCPeerConnection đang mở", [({"app": "camera"}, len(pcs))]),
+        ("helmet_motion_skipped_total", "counter", "Số frame motion gate bỏ qua inference", skipped),
+    ]
+
+async def events(request):
+    """Tra cứu sự kiện audit: ?source=...&start=2026-01-04T14:00&end=...&violation=1&limit=100"""
+    store = get_audit_writer().store
+    if store is None:
+        return web.json_response({"error": "Kho sự kiện đang tắt (AUDIT_DB rỗng)"}, status=404)
+    try:
+        rows = await asyncio.get_running_loop().run_in_executor(None, store.query_params, request.query)
+    except ValueError as e:
+        return web.json_response({"error": str(e)}, status=400)
+    return web.json_response({"events": rows})
+
+async def metrics_handler(request):
+    """Prometheus scrape: thời gian từng bước, peer connection, hàng đợi, frame bị bỏ."""
+    return web.Response(body=metrics.render().encode("utf-8"),
+                        headers={"Content-Type": metrics.CONTENT_TYPE})
+
+async def warmup_model(app):
+    # Load + warm-up trước khi viewer đầu tiên kết nối
+    # (chế độ supervisor: model chỉ load trong các process inference)
+    if not CAMERA_CONFIG:
+        await asyncio.get_running_loop().run_in_executor(None, get_model)
+
+async def start_retention(app):
+    # Dọn ảnh + sự kiện audit cũ ở process chính (cả chế độ supervisor, nơi
+    # process chính không tự tạo pipeline nào)
+    start_audit_retention()
+
+async def start_supervisor(app):
+    global supervisor
+    if not CAMERA_CONFIG:
+        return
+    pipeline_cfg = {
+        "conf_violation": CONF_VIOLATION, "conf_safe": CONF_SAFE, "iou_threshold": IOU_THRESHOLD,
+        "kw_unsafe": KW_UNSAFE, "kw_safe": KW_SAFE, "save_interval": SAVE_FRAME_INTERVAL,
+        "path_helmet": PATH_HELMET, "path_no_helmet": PATH_NO_HELMET, "prefix": "Cam", "alert_tag": "CAM",
+        "detect_every": DETECT_EVERY_N, "scene_change_threshold": SCENE_CHANGE_THRESHOLD,
+        "metrics_name": "camera", "imgsz": MODEL_IMGSZ, "quality_fps": QUALITY_TARGET_FPS,
+        "motion_gate": (MOTION_PIXEL_THRESHOLD, MOTION_AREA_RATIO, MOTION_MAX_SKIP) if MOTION_GATE else None,
+    }
+    supervisor = CameraSupervisor(load_sources(CAMERA_CONFIG), MODEL_PATH, INFER_BACKEND,
+                                  fallback="yolov8n.pt", pipeline_cfg=pipeline_cfg, workers=INFER_WORKERS)
+    supervisor.start()
+    metrics.register_collector(supervisor.collect_metrics)
+
+async def stop_supervisor(app):
+    if supervisor is not None:
+        await asyncio.get_running_loop().run_in_executor(None, supervisor.stop)
+
 async def on_shutdown(app):
     coros = [pc.close() for pc in pcs]
     await asyncio.gather(*coros)
@@ -354,7 +509,14 @@ async def on_shutdown(app):
 if __name__ == "__main__":
     app = web.Application(middlewares=[cors_middleware])  # ← CORS ENABLED
     app.router.add_post("/offer", offer)
+    app.router.add_get("/stats", stats)
+    app.router.add_get("/metrics", metrics_handler)
+    app.router.add_get("/events", events)
+    app.on_startup.append(warmup_model)
+    app.on_startup.append(start_supervisor)
+    app.on_startup.append(start_retention)
     app.on_shutdown.append(on_shutdown)
+    app.on_shutdown.append(stop_supervisor)
 
     print(f"🚀 AI Camera Server đang chạy tại: http://localhost:8080")
     web.run_app(app, host="0.0.0.0", port=8080)
\ No newline at end of file
@@ -213,23 +213,32 @@
 
 import asyncio
 import os
-import cv2
-import yt_dlp
-import numpy as np
+import time
+import av
 from pathlib import Path
-from datetime import datetime
 
 from aiohttp import web
 from aiohttp.web import Request, Response  # ← Needed for type hints
-from aiortc import RTCPeerConnection, RTCSessionDescription, VideoStreamTrack
-from aiortc.contrib.media import MediaPlayer
-from av import VideoFrame
-from ultralytics import YOLO
+from aiortc import RTCPeerConnection, RTCSessionDescription
+
+import metrics
+from audit_writer import get_audit_writer, start_audit_retention
+from frame_pipeline import HelmetFramePipeline
+from model_registry import registry, get_model
+from quality_controller import QualityController, default_levels
+from roi import load_roi_config, regions_for
+from source_resolver import SourceResolver, local_path
+from stream_hub import FrameProducer, StreamHub, HubVideoTrack, open_detection_channel
+from yuv_frame import YuvFramePool
 
 # ==============================================================================
 # 1. CẤU HÌNH
 # ==============================================================================
 YOUTUBE_URL = "https://www.youtube.com/watch?v=LCauiIO0Bt4"  # Change if needed
+# Nguồn phát: link YouTube, file video local hoặc file:// (để test offline)
+VIDEO_SOURCE = os.getenv("VIDEO_SOURCE", YOUTUBE_URL)
+VIDEO_LOOP = True           # File local: hết video thì phát lại từ đầu
+SOURCE_CACHE_TTL = 30 * 60  # Giây, link YouTube hết hạn sau vài giờ
 
 MODEL_PATH = Path(r"./best.pt")
 PATH_HELMET = Path(r"./2_Detect_Helmet")
@@ -240,70 +249,131 @@ CONF_VIOLATION = 0.25
 CONF_SAFE = 0.4
 IOU_THRESHOLD = 0.3
 
+# Backend inference: torch / onnx / onnx-int8 / openvino / openvino-int8 (xem backends.py)
+INFER_BACKEND = os.getenv("INFER_BACKEND", "torch")
+
 KW_UNSAFE = ['no-helmet', 'head', 'face', 'person', 'no_helmet']
 KW_SAFE = ['helmet', 'hardhat', 'safety-cap']
 
+# Chạy YOLO mỗi N frame, frame giữa dùng tracker (1 = chạy mọi frame như cũ).
+# SCENE_CHANGE_THRESHOLD: cảnh thay đổi mạnh (0..255) thì detect ngay, None = tắt
+DETECT_EVERY_N = int(os.getenv("DETECT_EVERY_N", "1"))
+SCENE_CHANGE_THRESHOLD = float(os.getenv("SCENE_CHANGE_THRESHOLD")) if os.getenv("SCENE_CHANGE_THRESHOLD") else None
+
+# Giữ frame ở dạng yuv420p của decoder (xem yuv_frame.py), model nhận ảnh đã thu
+# nhỏ về VIDEO_IMGSZ. VIDEO_YUV_PATH=0 -> đường BGR cũ.
+VIDEO_YUV_PATH = os.getenv("VIDEO_YUV_PATH", "1") == "1"
+VIDEO_IMGSZ = int(os.getenv("VIDEO_IMGSZ", "640"))
+
+# Giữ FPS mục tiêu khi quá tải: giảm imgsz / tăng bước detect theo thời
+# gian xử lý đo được, nâng lại khi dư tải (quality_controller.py). Mặc định tắt (0), vd. 15.
+QUALITY_TARGET_FPS = float(os.getenv("QUALITY_TARGET_FPS", "0"))
+
+# Vùng quan tâm (roi.py): ROI_CONFIG=roi.json, key là link / đường dẫn nguồn hoặc "*".
+# Chỉ predict các crop quanh vùng, box ngoài vùng bị bỏ. Không đặt -> cả frame.
+ROI = load_roi_config(os.getenv("ROI_CONFIG"))
+
 for p in [PATH_HELMET, PATH_NO_HELMET]:
     p.mkdir(parents=True, exist_ok=True)
 
-print("⏳ Đang tải model YOLOv8...")
-try:
-    model = YOLO(str(MODEL_PATH)) if MODEL_PATH.exists() else YOLO("yolov8n.pt")
-    print("✅ Model đã tải xong.")
-except Exception as e:
-    print(f"❌ Lỗi tải model: {e}")
-    exit()
+# Model load lazy qua registry (lỗi load được báo ra, không exit() lúc import)
+registry.register("default", MODEL_PATH, backend=INFER_BACKEND, fallback="yolov8n.pt")
 
 # ==============================================================================
-# 2. AI VIDEO TRACK
+# 2. VIDEO PRODUCER + AI VIDEO TRACK
 # ==============================================================================
-class AIVideoTrack(VideoStreamTrack):
-    def __init__(self, track):
-        super().__init__()
-        self.track = track
-        self.frame_cnt = 0
-
-    async def recv(self):
-        frame = await self.track.recv()
-        img = frame.to_ndarray(format="bgr24")
-        self.frame_cnt += 1
-
-        results = model.predict(img, conf=CONF_VIOLATION, iou=IOU_THRESHOLD, verbose=False)
-        has_violation = False
-        has_safe = False
-
-        for result in results:
-            for box in result.boxes:
-                cls_id = int(box.cls[0])
-                cls_name = model.names[cls_id].lower().replace("_", "-") if model.names else "unknown"
-                conf = float(box.conf[0])
-                x1, y1, x2, y2 = map(int, box.xyxy[0])
-
-                if any(k in cls_name for k in KW_UNSAFE) and conf >= CONF_VIOLATION:
-                    has_violation = True
-                    cv2.rectangle(img, (x1, y1), (x2, y2), (0, 0, 255), 2)
-                    cv2.putText(img, f"VIOLATION {conf:.2f}", (x1, y1 - 10),
-                                cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 0, 255), 2)
-                elif any(k in cls_name for k in KW_SAFE) and conf >= CONF_SAFE:
-                    if not has_violation:
-                        has_safe = True
-                    cv2.rectangle(img, (x1, y1), (x2, y2), (0, 255, 0), 2)
-                    cv2.putText(img, f"SAFE {conf:.2f}", (x1, y1 - 10),
-                                cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 255, 0), 2)
-
-        if self.frame_cnt % SAVE_FRAME_INTERVAL == 0:
-            time_str = datetime.now().strftime("%Y%m%d_%H%M%S")
-            img_name = f"Log_{time_str}_{self.frame_cnt}.jpg"
-            if has_violation:
-                cv2.imwrite(str(PATH_NO_HELMET / img_name), img)
-                print(f"❌ [ALERT] Lưu ảnh vi phạm: {img_name}")
-            elif has_safe:
-                cv2.imwrite(str(PATH_HELMET / img_name), img)
-
-        new_frame = VideoFrame.from_ndarray(img, format="bgr24")
-        new_frame.pts = frame.pts
-        new_frame.time_base = frame.time_base
-        return new_frame
+resolver = SourceResolver(ttl_s=SOURCE_CACHE_TTL)
+
+class VideoSourceProducer(FrameProducer):
+    """1 pipeline decode + AI cho mỗi nguồn, dùng chung cho mọi người xem."""
+    def __init__(self, source):
+        pipeline = HelmetFramePipeline(
+            get_model(), CONF_VIOLATION, CONF_SAFE, IOU_THRESHOLD, KW_UNSAFE, KW_SAFE,
+            SAVE_FRAME_INTERVAL, PATH_HELMET, PATH_NO_HELMET, prefix="Log", alert_tag="ALERT",
+            detect_every=DETECT_EVERY_N, scene_change_threshold=SCENE_CHANGE_THRESHOLD,
+            metrics_name="video", source=source, imgsz=VIDEO_IMGSZ, roi=regions_for(ROI, source),
+        )
+        super().__init__(f"video-{abs(hash(source))}", self._process, pipeline)
+        self.source = source
+        self.is_local = local_path(source) is not None
+        self.container = None
+        self.yuv_pool = YuvFramePool(imgsz=VIDEO_IMGSZ) if VIDEO_YUV_PATH else None
+        if QUALITY_TARGET_FPS > 0:
+            self.quality = QualityController(self.key, QUALITY_TARGET_FPS,
+                                             default_levels(VIDEO_IMGSZ, DETECT_EVERY_N), self.apply_quality)
+
+    def apply_quality(self, settings):
+        # Nguồn video không đổi được độ phân giải decode, chỉ đổi ảnh vào model
+        super().apply_quality(settings)
+        if self.yuv_pool is not None:
+            self.yuv_pool.imgsz = settings["imgsz"]
+
+    def _process(self, frame):
+        img = None
+        if self.yuv_pool is not None:
+            with metrics.stage_timer("video", "to_yuv"):
+                img = self.yuv_pool.fill(frame)
+        if img is None:
+            # Định dạng khác yuv420p / kích thước lẻ -> đường BGR
+            with metrics.stage_timer("video", "to_ndarray"):
+                img = frame.to_ndarray(format="bgr24")
+        return self.annotate(self.pipeline, img)
+
+    def open(self):
+        # Thường đã có trong cache (offer() resolve trước) -> không gọi lại yt_dlp
+        stream_url, title = resolver.resolve_sync(self.source)
+        if not stream_url:
+            raise RuntimeError("Could not resolve video source")
+        print(f"▶️ Bắt đầu stream: {title}")
+        try:
+            self.container = av.open(stream_url)
+        except Exception:
+            # Link đã resolve có thể hết hạn -> producer thay thế phải resolve lại
+            resolver.invalidate(self.source)
+            raise
+        self.stream = self.container.streams.video[0]
+        self.stream.thread_type = "AUTO"
+        self._frames = self.container.decode(self.stream)
+        self._t0 = None
+
+    def read(self):
+        try:
+            with metrics.stage_timer("video", "decode"):
+                frame = next(self._frames)
+        except StopIteration:
+            if self.is_local and VIDEO_LOOP:
+                self.container.seek(0)
+                self._frames = self.container.decode(self.stream)
+                self._t0 = None
+            else:
+                # Stream online kết thúc (thường do link hết hạn) -> lần mở sau resolve lại
+                resolver.invalidate(self.source)
+                self._running = False
+            return None
+        except Exception:
+            resolver.invalidate(self.source)
+            raise
+
+        # Phát đúng tốc độ thật của video (decode nhanh hơn thì chờ)
+        if frame.pts is not None and frame.time_base is not None:
+            t = float(frame.pts * frame.time_base)
+            now = time.monotonic()
+            if self._t0 is None:
+                self._t0 = now - t
+            delay = self._t0 + t - now
+            if delay > 0:
+                time.sleep(delay)
+        return frame
+
+    def close(self):
+        if self.container is not None:
+            self.container.close()
+
+video_hub = StreamHub(VideoSourceProducer, name="video")
+
+class AIVideoTrack(HubVideoTrack):
+    def __init__(self, source=VIDEO_SOURCE, channel=None):
+        super().__init__(video_hub, source, channel=channel)
 
 # ==============================================================================
 # 3. CORS MIDDLEWARE (THIS FIXES "Failed to fetch")
@@ -330,40 +400,29 @@ async def cors_middleware(app, handler):
 # ==============================================================================
 pcs = set()
 
-def get_youtube_stream_url(url):
-    print(f"📡 Đang lấy link stream từ YouTube: {url}...")
-    ydl_opts = {'format': 'best', 'quiet': True}
-    try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=False)
-            return info['url'], info.get('title', 'Unknown')
-    except Exception as e:
-        print(f"❌ Lỗi lấy link YouTube: {e}")
-        return None, None
-
 async def offer(request):
     params = await request.json()
     offer = RTCSessionDescription(sdp=params["sdp"], type=params["type"])
 
-    pc = RTCPeerConnection()
-    pcs.add(pc)
-
-    stream_url, title = get_youtube_stream_url(YOUTUBE_URL)
+    # Resolve link ngoài event loop, có cache -> các viewer sau gần như tức thì
+    stream_url, title = await resolver.resolve(VIDEO_SOURCE)
     if not stream_url:
         return web.Response(status=500, text="Could not get YouTube stream")
 
-    print(f"▶️ Bắt đầu stream: {title}")
-    player = MediaPlayer(stream_url)
+    pc = RTCPeerConnection()
+    pcs.add(pc)
 
-    if player.video:
-        ai_track = AIVideoTrack(player.video)
-        pc.addTrack(ai_track)
+    # Viewer đầu tiên khởi động pipeline, các viewer sau dùng chung.
+    # "mode": "detections" -> video gốc + detection qua data channel (client tự vẽ)
+    ai_track = AIVideoTrack(VIDEO_SOURCE, channel=open_detection_channel(pc, params))
+    pc.addTrack(ai_track)
 
     @pc.on("iceconnectionstatechange")
     async def on_iceconnectionstatechange():
-        if pc.iceConnectionState == "failed":
+        if pc.iceConnectionState in ("failed", "closed"):
             await pc.close()
             pcs.discard(pc)
+            ai_track.stop()
 
     await pc.setRemoteDescription(offer)
     answer = await pc.createAnswer()
@@ -374,6 +433,37 @@ async def offer(request):
         "type": pc.localDescription.type
     })
 
+@metrics.register_collector
+def collect_peer_metrics():
+    return [("helmet_peer_connections", "gauge", "Số RTCPeerConnection đang mở",
+             [({"app": "video"}, len(pcs))])]
+
+async def events(request):
+    """Tra cứu sự kiện audit: ?source=...&start=2026-01-04T14:00&end=...&violation=1&limit=100"""
+    store = get_audit_writer().store
+    if store is None:
+        return web.json_response({"error": "Kho sự kiện đang tắt (AUDIT_DB rỗng)"}, status=404)
+    try:
+        rows = await asyncio.get_running_loop().run_in_executor(None, store.query_params, request.query)
+    except ValueError as e:
+        return web.json_response({"error": str(e)}, status=400)
+    return web.json_response({"events": rows})
+
+async def metrics_handler(request):
+    """Prometheus scrape: thời gian từng bước, peer connection, hàng đợi, frame bị bỏ."""
+    return web.Response(body=metrics.render().encode("utf-8"),
+                        headers={"Content-Type": metrics.CONTENT_TYPE})
+
+async def on_startup(app):
+    # Resolve sẵn link khi khởi động để viewer đầu tiên không phải chờ yt_dlp
+    asyncio.get_running_loop().create_task(resolver.resolve(VIDEO_SOURCE))
+    # Dọn ảnh + sự kiện audit cũ (AUDIT_RETENTION_DAYS)
+    start_audit_retention()
+
+async def warmup_model(app):
+    # Load + warm-up trước khi viewer đầu tiên kết nối
+    await asyncio.get_running_loop().run_in_executor(None, get_model)
+
 async def on_shutdown(app):
     coros = [pc.close() for pc in pcs]
     await asyncio.gather(*coros)
@@ -385,6 +475,10 @@ async def on_shutdown(app):
 if __name__ == "__main__":
     app = web.Application(middlewares=[cors_middleware])  # ← THIS LINE FIXES CORS!
     app.router.add_post("/offer", offer)
+    app.router.add_get("/metrics", metrics_handler)
+    app.router.add_get("/events", events)
+    app.on_startup.append(on_startup)
+    app.on_startup.append(warmup_model)
     app.on_shutdown.append(on_shutdown)
 
     print(f"🚀 YouTube AI Monitor Server đang chạy tại: http://localhost:8080")
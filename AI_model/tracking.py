@@ -0,0 +1,148 @@
+import cv2
+import numpy as np
+
+from postprocess import UNSAFE, Detections
+
+# ==============================================================================
+# TRACKER NHẸ CHO CHẾ ĐỘ "DETECT MỖI N FRAME"
+# ==============================================================================
+# Giữa 2 lần chạy YOLO, box được dời theo vận tốc ước lượng (constant velocity).
+# Khi có kết quả detect mới: ghép với track cũ bằng IoU (greedy), track khớp giữ
+# nguyên ID -> mỗi người có ID ổn định, vi phạm chỉ báo 1 lần cho mỗi track.
+
+
+def iou_matrix(a, b):
+    """IoU giữa 2 tập box xyxy: a (N,4), b (M,4) -> (N,M)."""
+    if len(a) == 0 or len(b) == 0:
+        return np.zeros((len(a), len(b)), dtype=np.float32)
+    x1 = np.maximum(a[:, None, 0], b[None, :, 0])
+    y1 = np.maximum(a[:, None, 1], b[None, :, 1])
+    x2 = np.minimum(a[:, None, 2], b[None, :, 2])
+    y2 = np.minimum(a[:, None, 3], b[None, :, 3])
+    inter = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+    area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+    area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    union = area_a[:, None] + area_b[None, :] - inter
+    return inter / np.maximum(union, 1e-6)
+
+
+def small_gray(img, size=(64, 36)):
+    """Ảnh xám thu nhỏ, dùng để đo mức thay đổi cảnh (rất rẻ). img: BGR hoặc đã xám (plane Y)."""
+    gray = img if img.ndim == 2 else cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    return cv2.resize(gray, size, interpolation=cv2.INTER_AREA)
+
+
+def scene_change_score(prev_small, cur_small):
+    """Trung bình chênh lệch tuyệt đối (0..255) giữa 2 ảnh xám thu nhỏ."""
+    if prev_small is None:
+        return 255.0
+    return float(cv2.absdiff(prev_small, cur_small).mean())
+
+
+class IoUTracker:
+    def __init__(self, iou_threshold=0.3, max_misses=2):
+        self.iou_threshold = iou_threshold
+        self.max_misses = max_misses
+        self.next_id = 1
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.det_boxes = np.zeros((0, 4), dtype=np.float32)   # box tại lần detect gần nhất
+        self.velocity = np.zeros((0, 4), dtype=np.float32)    # pixel / frame
+        self.conf = np.zeros(0, dtype=np.float32)
+        self.cls = np.zeros(0, dtype=np.int64)
+        self.category = np.zeros(0, dtype=np.int8)
+        self.misses = np.zeros(0, dtype=np.int32)
+        self.frames_since_det = 0
+        self.reported = set()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _boxes_now(self):
+        return self.det_boxes + self.velocity * self.frames_since_det
+
+    def current(self):
+        """Các track đang thấy (không tính track vừa bị trượt) dưới dạng Detections có track_ids."""
+        visible = self.misses == 0
+        return Detections(self._boxes_now()[visible], self.conf[visible], self.cls[visible],
+                          self.category[visible], track_ids=self.ids[visible])
+
+    def step(self):
+        """Frame không chạy YOLO: dời box theo vận tốc, trả về Detections dự đoán."""
+        self.frames_since_det += 1
+        return self.current()
+
+    def update(self, dets):
+        """
+        Frame có chạy YOLO. Trả về (Detections có track_ids, list ID vi phạm mới).
+        """
+        elapsed = self.frames_since_det + 1
+        predicted = self.det_boxes + self.velocity * elapsed
+        ious = iou_matrix(predicted, dets.xyxy)
+
+        matched_tracks, matched_dets = [], []
+        if ious.size:
+            # Greedy: cặp IoU cao nhất trước
+            order = np.dstack(np.unravel_index(np.argsort(-ious, axis=None), ious.shape))[0]
+            used_t, used_d = set(), set()
+            for t, d in order:
+                if ious[t, d] < self.iou_threshold:
+                    break
+                if t in used_t or d in used_d:
+                    continue
+                used_t.add(t)
+                used_d.add(d)
+                matched_tracks.append(t)
+                matched_dets.append(d)
+
+        mt = np.array(matched_tracks, dtype=np.int64)
+        md = np.array(matched_dets, dtype=np.int64)
+
+        new_boxes = dets.xyxy.astype(np.float32)
+        self.velocity[mt] = (new_boxes[md] - self.det_boxes[mt]) / elapsed
+        self.det_boxes[mt] = new_boxes[md]
+        self.conf[mt] = dets.conf[md]
+        self.cls[mt] = dets.cls[md]
+        self.category[mt] = dets.category[md]
+
+        # Track không khớp: tăng số lần trượt, giữ vị trí dự đoán
+        unmatched = np.ones(len(self.ids), dtype=bool)
+        unmatched[mt] = False
+        self.det_boxes[unmatched] = predicted[unmatched]
+        self.misses[unmatched] += 1
+        self.misses[mt] = 0
+
+        keep = self.misses <= self.max_misses
+        for tid in self.ids[~keep].tolist():
+            self.reported.discard(tid)
+        self._select(keep)
+
+        # Detection không khớp -> track mới
+        new_mask = np.ones(len(dets), dtype=bool)
+        new_mask[md] = False
+        n_new = int(new_mask.sum())
+        if n_new:
+            self.ids = np.concatenate([self.ids, np.arange(self.next_id, self.next_id + n_new)])
+            self.next_id += n_new
+            self.det_boxes = np.concatenate([self.det_boxes, new_boxes[new_mask]])
+            self.velocity = np.concatenate([self.velocity, np.zeros((n_new, 4), dtype=np.float32)])
+            self.conf = np.concatenate([self.conf, dets.conf[new_mask]])
+            self.cls = np.concatenate([self.cls, dets.cls[new_mask]])
+            self.category = np.concatenate([self.category, dets.category[new_mask]])
+            self.misses = np.concatenate([self.misses, np.zeros(n_new, dtype=np.int32)])
+
+        self.frames_since_det = 0
+
+        new_violations = [tid for tid, cat in zip(self.ids.tolist(), self.category.tolist())
+                          if cat == UNSAFE and tid not in self.reported]
+        self.reported.update(new_violations)
+
+        return self.current(), new_violations
+
+    def _select(self, mask):
+        self.ids = self.ids[mask]
+        self.det_boxes = self.det_boxes[mask]
+        self.velocity = self.velocity[mask]
+        self.conf = self.conf[mask]
+        self.cls = self.cls[mask]
+        self.category = self.category[mask]
+        self.misses = self.misses[mask]
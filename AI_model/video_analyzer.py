@@ -0,0 +1,189 @@
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import cv2
+from ultralytics import YOLO
+
+from postprocess import UNSAFE, SAFE, build_category_lut, draw_detections, postprocess
+
+# ==============================================================================
+# 1. CẤU HÌNH
+# ==============================================================================
+# Phân tích video offline (thay cho "Video to Pic" / "Video to check_fast"):
+# - Đọc tuần tự, frame không cần phân tích chỉ grab() (không decode ra ảnh),
+#   không cap.set(CAP_PROP_POS_FRAMES) trước mỗi lần đọc (mỗi lần set = seek
+#   về keyframe + decode lại)
+# - Gom các frame lấy mẫu thành batch để predict
+# - File dài: chia thành nhiều đoạn thời gian, mỗi process xử lý 1 đoạn
+#   (chỉ seek 1 lần ở đầu đoạn), sau đó ghép kết quả theo đúng thứ tự
+
+KEYWORDS_SAFE = ['helmet', 'hardhat', 'safety-cap']
+KEYWORDS_UNSAFE = ['no-helmet', 'head', 'face', 'person', 'no_helmet']
+
+CONF_VIOLATION = 0.1
+CONF_SAFE = 0.4
+IOU_THRESHOLD = 0.3
+
+MODEL_PATH = Path(r"./best.pt")
+PATH_HELMET = Path(r"./2_Detect_Helmet")
+PATH_NO_HELMET = Path(r"./3_Detect_No_Helmet")
+
+# ==============================================================================
+# 2. PHÂN TÍCH 1 ĐOẠN VIDEO
+# ==============================================================================
+_model = None
+_lut = None
+
+
+def _init_worker(model_path):
+    """Mỗi process load model 1 lần duy nhất."""
+    global _model, _lut
+    _model = YOLO(str(model_path))
+    _lut = build_category_lut(_model.names, KEYWORDS_UNSAFE, KEYWORDS_SAFE)
+
+
+def video_info(source):
+    cap = cv2.VideoCapture(str(source))
+    if not cap.isOpened():
+        raise RuntimeError(f"Không mở được video: {source}")
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    if fps <= 0 or fps > 120:
+        fps = 30
+    total = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    cap.release()
+    return fps, total
+
+
+def _analyze_batch(frames, fps, save, prefix):
+    results = _model.predict([img for _, img in frames], conf=CONF_VIOLATION,
+                             iou=IOU_THRESHOLD, verbose=False)
+    records = []
+    for (idx, img), result in zip(frames, results):
+        dets = postprocess(result, _lut, CONF_VIOLATION, CONF_SAFE)
+        n_unsafe = int((dets.category == UNSAFE).sum())
+        n_safe = int((dets.category == SAFE).sum())
+        status = "violation" if n_unsafe else ("safe" if n_safe else "no_detect")
+        record = {"frame": idx, "time_s": round(idx / fps, 3), "status": status,
+                  "violations": n_unsafe, "safe": n_safe}
+
+        if save and status != "no_detect":
+            draw_detections(img, dets, labels=("NO-HELMET", "HELMET"))
+            folder = PATH_NO_HELMET if n_unsafe else PATH_HELMET
+            name = f"{prefix}_{idx:08d}.jpg"
+            cv2.imwrite(str(folder / name), img)
+            record["image"] = name
+        records.append(record)
+    return records
+
+
+def analyze_segment(source, start, end, step, fps, batch_size=8, save=False, prefix="Vid"):
+    """
+    Phân tích frame [start, end) (end=None: tới hết video), lấy mẫu các frame có
+    chỉ số chia hết cho `step` (tính theo cả video nên ghép các đoạn không lệch nhịp).
+    """
+    cap = cv2.VideoCapture(str(source))
+    if start > 0:
+        # Seek 1 lần duy nhất ở đầu đoạn, sau đó đọc tuần tự
+        cap.set(cv2.CAP_PROP_POS_FRAMES, start)
+
+    records = []
+    frames = []
+    idx = start
+    try:
+        while end is None or idx < end:
+            if idx % step == 0:
+                ret, img = cap.read()
+                if not ret:
+                    break
+                frames.append((idx, img))
+                if len(frames) == batch_size:
+                    records.extend(_analyze_batch(frames, fps, save, prefix))
+                    frames = []
+            elif not cap.grab():
+                # Frame bỏ qua: chỉ grab, không decode ra ảnh BGR
+                break
+            idx += 1
+        if frames:
+            records.extend(_analyze_batch(frames, fps, save, prefix))
+    finally:
+        cap.release()
+    return records
+
+
+def _run_segment(args):
+    return analyze_segment(*args)
+
+# ==============================================================================
+# 3. CHIA ĐOẠN + GHÉP KẾT QUẢ
+# ==============================================================================
+def analyze_video(source, interval_sec=1.0, batch_size=8, workers=1,
+                  model_path=MODEL_PATH, save=False, prefix=None):
+    fps, total = video_info(source)
+    step = max(1, int(round(fps * interval_sec)))
+    prefix = prefix or Path(str(source)).stem[:15]
+    if save:
+        for p in [PATH_HELMET, PATH_NO_HELMET]:
+            p.mkdir(parents=True, exist_ok=True)
+
+    is_local = os.path.exists(str(source))
+    if workers <= 1 or not is_local or total <= 0:
+        # Stream / không biết tổng số frame -> chỉ đọc tuần tự 1 process
+        _init_worker(model_path)
+        return analyze_segment(source, 0, None, step, fps, batch_size, save, prefix)
+
+    # Ranh giới đoạn làm tròn theo step để không lấy mẫu trùng / sót
+    seg_len = -(-total // workers)
+    seg_len = -(-seg_len // step) * step
+    segments = []
+    for start in range(0, total, seg_len):
+        end = min(start + seg_len, total)
+        segments.append((source, start, end, step, fps, batch_size, save, prefix))
+
+    print(f"🧩 Chia {total} frame thành {len(segments)} đoạn cho {workers} process...")
+    records = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(str(model_path),)) as pool:
+        # map() trả kết quả đúng thứ tự đoạn
+        for seg_records in pool.map(_run_segment, segments):
+            records.extend(seg_records)
+    return records
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Phân tích video offline (không cần xem trực tiếp)")
+    parser.add_argument("source", help="File video local (hoặc link stream, chỉ chạy tuần tự)")
+    parser.add_argument("--interval", type=float, default=1.0, help="Lấy mẫu mỗi N giây video")
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="Số process (mỗi process xử lý 1 đoạn video)")
+    parser.add_argument("--model", default=str(MODEL_PATH))
+    parser.add_argument("--save", action="store_true", help="Lưu frame có detect vào 2_/3_ folder")
+    parser.add_argument("--report", default=None, help="Ghi kết quả ra file JSON")
+    args = parser.parse_args()
+
+    t0 = time.perf_counter()
+    records = analyze_video(args.source, args.interval, args.batch_size, args.workers,
+                            args.model, args.save)
+    elapsed = time.perf_counter() - t0
+
+    fps, total = video_info(args.source)
+    video_len = total / fps if total > 0 else 0
+    n_violation = sum(1 for r in records if r["status"] == "violation")
+    print(f"🎉 Xong {len(records)} frame lấy mẫu trong {elapsed:.1f}s "
+          f"(video {video_len:.0f}s, x{video_len / elapsed if elapsed > 0 else 0:.1f} realtime) "
+          f"| ❌ {n_violation} frame vi phạm")
+
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump({"source": str(args.source), "interval_s": args.interval,
+                       "elapsed_s": round(elapsed, 2), "frames": records},
+                      f, ensure_ascii=False, indent=2)
+        print(f"📄 Đã ghi báo cáo: {args.report}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,338 @@
+import argparse
+import heapq
+import json
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+
+import cv2
+
+from postprocess import SAFE, UNSAFE, build_category_lut, draw_detections, postprocess
+
+# ==============================================================================
+# XUẤT VIDEO -> VIDEO CÓ KHUNG (THAY CHO NOTEBOOK "Video to Video")
+# ==============================================================================
+# Notebook cũ làm tuần tự trong 1 vòng lặp: đọc -> YOLO -> vẽ -> ghi, CPU rảnh
+# trong lúc mỗi bước chờ bước trước. Ở đây mỗi bước là 1 stage chạy song song,
+# nối với nhau bằng hàng đợi có giới hạn (bước nhanh chờ bước chậm, RAM không
+# phình):
+#   decode (1 thread) -> infer (batch) -> annotate (N thread) -> encode (1 thread)
+# decode / encode / predict của OpenCV + torch nhả GIL nên các stage chạy chồng
+# lên nhau thật -> tổng thời gian ~ stage chậm nhất thay vì tổng các stage.
+# Nhiều thread annotate có thể xong lệch thứ tự -> encode sắp lại theo số frame
+# trước khi ghi, video ra luôn đúng thứ tự.
+# In tiến độ định kỳ (fps, ETA, độ đầy hàng đợi, thời gian bận của từng stage ->
+# biết stage nào là nút thắt).
+#   python video_export.py "input.mp4" --batch-size 8 --save
+
+MODEL_PATH = Path(r"./best.pt")
+PATH_HELMET = Path(r"./2_Detect_Helmet")
+PATH_NO_HELMET = Path(r"./3_Detect_No_Helmet")
+PATH_VIDEO_OUT = Path(r"./8_Video output")
+
+# Giống notebook "Video to Video"
+SAVE_FRAME_INTERVAL = 6
+CONF_VIOLATION = 0.1
+CONF_SAFE = 0.4
+IOU_THRESHOLD = 0.3
+
+KW_UNSAFE = ['no-helmet', 'head', 'face', 'person', 'no_helmet']
+KW_SAFE = ['helmet', 'hardhat', 'safety-cap']
+
+STAGES = ("decode", "infer", "annotate", "encode")
+_END = None   # Báo hết frame cho stage sau
+
+
+class _Stage:
+    """Đếm frame + thời gian bận (không tính lúc chờ hàng đợi) của 1 stage."""
+
+    def __init__(self, name):
+        self.name = name
+        self.frames = 0
+        self.busy_s = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, frames, seconds):
+        with self._lock:
+            self.frames += frames
+            self.busy_s += seconds
+
+    def summary(self):
+        with self._lock:
+            return {"frames": self.frames, "busy_s": round(self.busy_s, 2),
+                    "fps": round(self.frames / self.busy_s, 1) if self.busy_s > 0 else None}
+
+
+class VideoExporter:
+    def __init__(self, model, source, out_path, batch_size=8, annotate_workers=2, queue_size=32,
+                 save=False, save_interval=SAVE_FRAME_INTERVAL, progress_s=5.0):
+        self.model = model
+        self.source = str(source)
+        self.out_path = Path(out_path)
+        self.batch_size = batch_size
+        self.annotate_workers = max(1, annotate_workers)
+        self.save = save
+        self.save_interval = save_interval
+        self.progress_s = progress_s
+        self.lut = build_category_lut(model.names, KW_UNSAFE, KW_SAFE)
+        self.prefix = Path(self.source).stem[:15]
+
+        self.stages = {name: _Stage(name) for name in STAGES}
+        self._decoded = queue.Queue(queue_size)
+        self._inferred = queue.Queue(queue_size)
+        self._annotated = queue.Queue(queue_size)
+        self._stop = threading.Event()
+        self._error = None
+        self._audit = None
+
+        cap = cv2.VideoCapture(self.source)
+        if not cap.isOpened():
+            raise RuntimeError(f"Không mở được video: {self.source}")
+        fps = cap.get(cv2.CAP_PROP_FPS)
+        self.fps = fps if 0 < fps <= 120 else 30
+        self.size = (int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+        self.total = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        self._cap = cap
+
+    # ---------------------------------------------------------------- tiện ích
+    def _put(self, q, item):
+        """put có giới hạn nhưng vẫn thoát được khi có stage khác bị lỗi."""
+        while not self._stop.is_set():
+            try:
+                q.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _get(self, q):
+        while not self._stop.is_set():
+            try:
+                return q.get(timeout=0.5)
+            except queue.Empty:
+                pass
+        return _END
+
+    def _guard(self, fn, *args):
+        try:
+            fn(*args)
+        except Exception as e:
+            if self._error is None:
+                self._error = e
+            self._stop.set()
+
+    # ---------------------------------------------------------------- stage
+    def _decode(self):
+        stage = self.stages["decode"]
+        idx = 0
+        try:
+            while not self._stop.is_set():
+                t0 = time.perf_counter()
+                ret, img = self._cap.read()
+                stage.add(1 if ret else 0, time.perf_counter() - t0)
+                if not ret:
+                    break
+                if not self._put(self._decoded, (idx, img)):
+                    return
+                idx += 1
+        finally:
+            self._cap.release()
+            self._put(self._decoded, _END)
+
+    def _infer(self):
+        stage = self.stages["infer"]
+        done = False
+        while not done:
+            item = self._get(self._decoded)
+            if item is _END:
+                break
+            batch = [item]
+            # Gom đủ batch (chờ decode nếu cần), hết video thì chạy nốt phần còn lại
+            while len(batch) < self.batch_size:
+                item = self._get(self._decoded)
+                if item is _END:
+                    done = True
+                    break
+                batch.append(item)
+
+            t0 = time.perf_counter()
+            results = self.model.predict([img for _, img in batch], conf=CONF_VIOLATION,
+                                         iou=IOU_THRESHOLD, verbose=False)
+            out = [(idx, img, postprocess(result, self.lut, CONF_VIOLATION, CONF_SAFE))
+                   for (idx, img), result in zip(batch, results)]
+            stage.add(len(batch), time.perf_counter() - t0)
+            for item in out:
+                if not self._put(self._inferred, item):
+                    return
+        # Mỗi thread annotate cần 1 tín hiệu kết thúc
+        for _ in range(self.annotate_workers):
+            self._put(self._inferred, _END)
+
+    def _annotate(self):
+        stage = self.stages["annotate"]
+        try:
+            while True:
+                item = self._get(self._inferred)
+                if item is _END:
+                    break
+                idx, img, dets = item
+                t0 = time.perf_counter()
+                draw_detections(img, dets, labels=("NO-HELMET", "HELMET"))
+                if self.save and idx % self.save_interval == 0:
+                    self._save(idx, img, dets)
+                stage.add(1, time.perf_counter() - t0)
+                if not self._put(self._annotated, (idx, img)):
+                    return
+        finally:
+            self._put(self._annotated, _END)
+
+    def _save(self, idx, img, dets):
+        violation = bool((dets.category == UNSAFE).any())
+        if not violation and not (dets.category == SAFE).any():
+            return
+        folder = PATH_NO_HELMET if violation else PATH_HELMET
+        event = {"source": self.source, "ts": time.time(), "frame": idx,
+                 "boxes": dets.to_records(self.model.names)}
+        # img không bị sửa sau bước này (encode chỉ đọc) nên không cần copy
+        self._audit.submit(folder / f"{self.prefix}_{idx:08d}.jpg", img, violation=violation, event=event)
+
+    def _encode(self):
+        stage = self.stages["encode"]
+        writer = cv2.VideoWriter(str(self.out_path), cv2.VideoWriter_fourcc(*'mp4v'), self.fps, self.size)
+        if not writer.isOpened():
+            raise RuntimeError(f"Không tạo được file video: {self.out_path}")
+        pending = []   # heap (idx, img) của frame xong sớm hơn thứ tự
+        next_idx = 0
+        ended = 0
+        try:
+            while ended < self.annotate_workers:
+                item = self._get(self._annotated)
+                if item is _END:
+                    if self._stop.is_set():
+                        return
+                    ended += 1
+                    continue
+                heapq.heappush(pending, item)
+                while pending and pending[0][0] == next_idx:
+                    _, img = heapq.heappop(pending)
+                    t0 = time.perf_counter()
+                    writer.write(img)
+                    stage.add(1, time.perf_counter() - t0)
+                    next_idx += 1
+            if pending:
+                raise RuntimeError(f"Thiếu frame {next_idx} khi ghi video")
+        finally:
+            writer.release()
+
+    # ---------------------------------------------------------------- chạy
+    def _progress(self, t_start):
+        done = self.stages["encode"].frames
+        elapsed = time.perf_counter() - t_start
+        fps = done / elapsed if elapsed > 0 else 0.0
+        line = f"⏳ {done}"
+        if self.total > 0:
+            eta = (self.total - done) / fps if fps > 0 else 0
+            line += f"/{self.total} ({done / self.total:.0%}, còn ~{eta:.0f}s)"
+        busy = " ".join(f"{s.name}={s.busy_s:.0f}s" for s in self.stages.values())
+        print(f"{line} | {fps:.1f} fps | hàng đợi {self._decoded.qsize()}/{self._inferred.qsize()}/"
+              f"{self._annotated.qsize()} | bận {busy}")
+
+    def run(self):
+        self.out_path.parent.mkdir(parents=True, exist_ok=True)
+        if self.save:
+            from audit_writer import get_audit_writer
+            for p in [PATH_HELMET, PATH_NO_HELMET]:
+                p.mkdir(parents=True, exist_ok=True)
+            self._audit = get_audit_writer()
+
+        threads = [threading.Thread(target=self._guard, args=(self._decode,), name="export-decode"),
+                   threading.Thread(target=self._guard, args=(self._infer,), name="export-infer"),
+                   threading.Thread(target=self._guard, args=(self._encode,), name="export-encode")]
+        threads += [threading.Thread(target=self._guard, args=(self._annotate,), name=f"export-annotate-{i}")
+                    for i in range(self.annotate_workers)]
+
+        print(f"🎬 {self.source}: {self.size[0]}x{self.size[1]} @ {self.fps:.1f} fps, "
+              f"{self.total if self.total > 0 else '?'} frame -> {self.out_path}")
+        t_start = time.perf_counter()
+        for t in threads:
+            t.start()
+        try:
+            encode = threads[2]
+            while encode.is_alive():
+                encode.join(self.progress_s)
+                if encode.is_alive():
+                    self._progress(t_start)
+        except KeyboardInterrupt:
+            print("\n⏹️ Dừng thủ công, video ra chỉ có phần đã ghi.")
+            self._stop.set()
+        finally:
+            for t in threads:
+                t.join()
+            if self._audit is not None:
+                self._audit.close(wait=True)
+        wall = time.perf_counter() - t_start
+        if self._error is not None:
+            raise self._error
+        return self.report(wall)
+
+    def report(self, wall):
+        stages = {name: s.summary() for name, s in self.stages.items()}
+        frames = stages["encode"]["frames"]
+        busiest = max(stages, key=lambda n: stages[n]["busy_s"])
+        return {
+            "source": self.source,
+            "output": str(self.out_path),
+            "frames": frames,
+            "wall_s": round(wall, 2),
+            "throughput_fps": round(frames / wall, 1) if wall > 0 else None,
+            "realtime_x": round(frames / self.fps / wall, 2) if wall > 0 else None,
+            # Tổng thời gian nếu chạy tuần tự như notebook cũ
+            "sequential_s": round(sum(s["busy_s"] for s in stages.values()), 2),
+            "bottleneck": busiest,
+            "stages": stages,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Xuất video có khung detect (decode / infer / encode song song)")
+    parser.add_argument("source", help="File video local")
+    parser.add_argument("--out", default=None, help=f"File .mp4 (mặc định: {PATH_VIDEO_OUT}/<tên>_<thời gian>.mp4)")
+    parser.add_argument("--model", default=str(MODEL_PATH))
+    parser.add_argument("--backend", default=os.getenv("INFER_BACKEND", "torch"))
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--annotate-workers", type=int, default=2)
+    parser.add_argument("--queue-size", type=int, default=32, help="Số frame tối đa giữa 2 stage")
+    parser.add_argument("--save", action="store_true", help="Lưu ảnh audit mỗi SAVE_FRAME_INTERVAL frame")
+    parser.add_argument("--report", default=None, help="Ghi thống kê ra file JSON")
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.source):
+        raise SystemExit(f"Không tìm thấy file video: {args.source}")
+    out = Path(args.out) if args.out else PATH_VIDEO_OUT / (
+        f"{Path(args.source).stem[:15]}_{datetime.now():%Y%m%d_%H%M%S}.mp4")
+
+    from backends import load_model
+    print(f"⏳ Đang tải model ({args.backend})...")
+    model = load_model(args.model, args.backend)
+
+    exporter = VideoExporter(model, args.source, out, args.batch_size, args.annotate_workers,
+                             args.queue_size, save=args.save)
+    report = exporter.run()
+    print(f"🎉 Xong {report['frames']} frame trong {report['wall_s']}s ({report['throughput_fps']} fps, "
+          f"x{report['realtime_x']} realtime) | chạy tuần tự ước tính {report['sequential_s']}s, "
+          f"nút thắt: {report['bottleneck']}")
+    for name, s in report["stages"].items():
+        print(f"   {name:9s} {s['frames']:7d} frame | bận {s['busy_s']:8.1f}s | {s['fps']} fps")
+    print(f"📂 Video đã lưu tại: {report['output']}")
+
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"📄 Đã ghi báo cáo: {args.report}")
+
+
+if __name__ == "__main__":
+    main()
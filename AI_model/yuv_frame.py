@@ -0,0 +1,151 @@
+from functools import lru_cache
+
+import cv2
+import numpy as np
+
+from postprocess import draw_detections, overlay_items
+
+# ==============================================================================
+# ĐƯỜNG FRAME YUV420P (KHÔNG ĐỔI MÀU CẢ FRAME)
+# ==============================================================================
+# Decoder (PyAV) trả frame yuv420p, encoder WebRTC cũng nhận yuv420p. Đường BGR
+# cũ: to_ndarray("bgr24") -> AI -> from_ndarray("bgr24") -> encoder đổi lại YUV,
+# tức 2 lần đổi màu + 2 lần cấp phát cả frame chỉ để vẽ vài khung.
+# Đường YUV:
+# - YuvFramePool.fill(): copy 3 plane vào buffer I420 cấp sẵn (vòng N ô, không
+#   cấp phát mỗi frame)
+# - Ảnh cho model: thu từng plane xuống cỡ imgsz rồi mới đổi sang BGR (ảnh nhỏ,
+#   buffer cấp sẵn); box được nhân lại theo tỷ lệ về toạ độ frame gốc
+# - Khung vẽ thẳng lên plane Y (độ sáng) và U/V (màu, nửa độ phân giải)
+# - Motion gate / scene change dùng thẳng plane Y (đã là ảnh xám)
+# - Người xem: VideoFrame.from_ndarray(buf, "yuv420p") = 1 lần memcpy, không đổi màu
+# Chỉ ảnh audit (lưu thưa) mới đổi cả frame sang BGR.
+
+FONT = cv2.FONT_HERSHEY_SIMPLEX
+
+
+@lru_cache(maxsize=16)
+def bgr_to_yuv(color):
+    """Màu BGR -> (Y, U, V) theo BT.601 limited range (giống cv2 YUV2BGR_I420 / swscale)."""
+    b, g, r = color
+    y = 16 + 0.257 * r + 0.504 * g + 0.098 * b
+    u = 128 - 0.148 * r - 0.291 * g + 0.439 * b
+    v = 128 + 0.439 * r - 0.368 * g - 0.071 * b
+    return tuple(int(round(min(max(c, 0), 255))) for c in (y, u, v))
+
+
+class YuvFrame:
+    """
+    Frame I420 trong 1 buffer liền (cao * 3/2, rộng): y (H, W), u / v (H/2, W/2)
+    là view vào buffer. model_input: ảnh BGR nhỏ cho model, scale: (sx, sy) để
+    đưa box từ model_input về toạ độ frame.
+    """
+
+    __slots__ = ("buf", "width", "height", "y", "u", "v", "model_input", "scale", "pts")
+
+    def __init__(self, buf, width, height):
+        self.buf = buf
+        self.width = width
+        self.height = height
+        n_y, n_c = width * height, (width // 2) * (height // 2)
+        flat = buf.reshape(-1)
+        self.y = buf[:height]
+        self.u = flat[n_y:n_y + n_c].reshape(height // 2, width // 2)
+        self.v = flat[n_y + n_c:n_y + 2 * n_c].reshape(height // 2, width // 2)
+        self.model_input = None
+        self.scale = (1.0, 1.0)
+        self.pts = None
+
+    @classmethod
+    def empty(cls, width, height):
+        return cls(np.empty((height * 3 // 2, width), dtype=np.uint8), width, height)
+
+    @property
+    def shape(self):
+        """Giống ndarray BGR (cao, rộng, 3) cho code chỉ cần kích thước."""
+        return self.height, self.width, 3
+
+    def copy(self):
+        frame = YuvFrame(self.buf.copy(), self.width, self.height)
+        frame.model_input, frame.scale, frame.pts = self.model_input, self.scale, self.pts
+        return frame
+
+    def to_bgr(self):
+        """Đổi cả frame sang BGR (chỉ dùng cho ảnh audit)."""
+        return cv2.cvtColor(self.buf, cv2.COLOR_YUV2BGR_I420)
+
+
+def draw_detections_yuv(frame, dets, labels=("VIOLATION", "SAFE"), draw_safe_with_violation=True):
+    """Vẽ khung giống draw_detections nhưng lên plane Y (nét đủ) và U/V (nửa độ phân giải)."""
+    for x1, y1, x2, y2, color, text in overlay_items(dets, labels, draw_safe_with_violation):
+        cy, cu, cv = bgr_to_yuv(color)
+        cv2.rectangle(frame.y, (x1, y1), (x2, y2), cy, 2)
+        cv2.putText(frame.y, text, (x1, y1 - 10), FONT, 0.6, cy, 2)
+        for plane, c in ((frame.u, cu), (frame.v, cv)):
+            cv2.rectangle(plane, (x1 // 2, y1 // 2), (x2 // 2, y2 // 2), c, 1)
+            cv2.putText(plane, text, (x1 // 2, (y1 - 10) // 2), FONT, 0.3, c, 1)
+    return frame
+
+
+def draw_frame(img, dets):
+    """Vẽ khung lên ndarray BGR hoặc YuvFrame."""
+    if isinstance(img, YuvFrame):
+        return draw_detections_yuv(img, dets)
+    return draw_detections(img, dets)
+
+
+class YuvFramePool:
+    """
+    Vòng `slots` YuvFrame cấp sẵn (cấp lại khi đổi độ phân giải). Frame trả về
+    bởi fill() được giữ nguyên tới khi pool quay vòng lại ô đó (slots frame sau),
+    đủ để người xem copy frame mới nhất trong lúc frame kế tiếp đang được xử lý.
+    """
+
+    def __init__(self, slots=3, imgsz=640):
+        self.slots = slots
+        self.imgsz = imgsz
+        self._size = None   # (rộng, cao, imgsz) của buffer hiện tại
+        self._frames = []
+        self._small = []
+        self._next = 0
+
+    def _ensure(self, width, height):
+        # imgsz có thể đổi lúc chạy (QualityController) -> cấp lại ảnh nhỏ
+        if self._size == (width, height, self.imgsz):
+            return
+        ratio = min(1.0, self.imgsz / max(width, height)) if self.imgsz else 1.0
+        # I420 cần kích thước chẵn
+        sw, sh = max(2, int(width * ratio) // 2 * 2), max(2, int(height * ratio) // 2 * 2)
+        self._frames = [YuvFrame.empty(width, height) for _ in range(self.slots)]
+        self._small = [YuvFrame.empty(sw, sh) if (sw, sh) != (width, height) else None
+                       for _ in range(self.slots)]
+        for frame in self._frames:
+            frame.model_input = np.empty((sh, sw, 3), dtype=np.uint8)
+            frame.scale = (width / sw, height / sh)
+        self._size = (width, height, self.imgsz)
+        self._next = 0
+
+    def fill(self, av_frame):
+        """Copy VideoFrame yuv420p của PyAV vào ô kế tiếp. None nếu không dùng được đường YUV."""
+        width, height = av_frame.width, av_frame.height
+        if av_frame.format.name != "yuv420p" or width % 2 or height % 2:
+            return None
+        self._ensure(width, height)
+        i = self._next
+        self._next = (i + 1) % self.slots
+        frame, small = self._frames[i], self._small[i]
+
+        # Plane của PyAV có padding cuối mỗi dòng (line_size >= rộng)
+        for plane, dst in zip(av_frame.planes, (frame.y, frame.u, frame.v)):
+            rows, cols = dst.shape
+            src = np.frombuffer(plane, np.uint8, count=rows * plane.line_size)
+            np.copyto(dst, src.reshape(rows, plane.line_size)[:, :cols])
+        frame.pts = av_frame.pts
+
+        if small is None:
+            cv2.cvtColor(frame.buf, cv2.COLOR_YUV2BGR_I420, dst=frame.model_input)
+        else:
+            for src, dst in ((frame.y, small.y), (frame.u, small.u), (frame.v, small.v)):
+                cv2.resize(src, (dst.shape[1], dst.shape[0]), dst=dst, interpolation=cv2.INTER_AREA)
+            cv2.cvtColor(small.buf, cv2.COLOR_YUV2BGR_I420, dst=frame.model_input)
+        return frame